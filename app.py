@@ -1,67 +1,363 @@
 import os
+import array
+import base64
+import binascii
+import bisect
+import click
+import collections
+import concurrent.futures
+import csv
 import flask
+import fractions
+import flask_sqlalchemy.session
 from flask_sqlalchemy import SQLAlchemy
+import functools
+import gzip
 import sqlalchemy
 import datetime
+import hashlib
+import hmac
+import http.client
+import io
+import json
+import math
+import multiprocessing
+import queue
 import random
+import re
+import sqlite3
+import sqlalchemy.dialects.sqlite
+import sys
+import threading
+import time
+import urllib.request
+
+try:
+    import brotli   # optional, lets the API answer with brotli instead of gzip
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image   # optional, for resized variants of uploaded photos
+except ImportError:
+    Image = None
 
 # Setup
 
-app = flask.Flask(__name__, template_folder="html")
-app.secret_key = "key"
+started_at = time.perf_counter()   # when this module started loading, for the startup time report
+
+def default_config(root_path):
+    """
+    Settings used unless create_app is given others.
+    """
+
+    database_path = os.environ.get("DATABASE_PATH", os.path.join(root_path, "databaseFiles", "recipes.db"))
+
+    return {
+        "SECRET_KEY": "key",
+
+        "DATABASE_PATH": database_path,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + database_path,
+
+        # how the SQLite engine is tuned, one of database_profiles below
+        "DATABASE_PROFILE": os.environ.get("DATABASE_PROFILE", "default"),
+
+        # read replicas (comma separated database URIs) used by read-only views instead of the primary database,
+        # and how long after a user's own write their reads keep going to the primary so they see it
+        "DATABASE_REPLICAS": [uri for uri in os.environ.get("DATABASE_REPLICAS", "").split(",") if len(uri) != 0],
+        "REPLICA_STICKY_SECONDS": 10,
+
+        # how often (in seconds) the home page's list of recipe ids is reloaded from the database
+        "SAMPLER_REFRESH_SECONDS": 300,
+
+        # search results per page, the most a single request can ask for, and how long browsers may cache a page
+        "SEARCH_PAGE_SIZE": 30,
+        "SEARCH_MAX_PAGE_SIZE": 100,
+        "SEARCH_CACHE_SECONDS": 60,
+
+        # cache for recipe pages: "memory" (per worker), "redis" (shared, needs the redis package) or "none"
+        "RECIPE_CACHE_BACKEND": "memory",
+        "RECIPE_CACHE_SIZE": 1000,
+        "RECIPE_CACHE_TTL": 300,
+        "REDIS_URL": "redis://localhost:6379/0",
+
+        # cache of search result ids, same backends as the recipe cache;
+        # entries are dropped as soon as a recipe, ingredient or (for rating filters) rating changes
+        "SEARCH_RESULTS_CACHE_BACKEND": "memory",
+        "SEARCH_RESULTS_CACHE_SIZE": 2000,
+        "SEARCH_RESULTS_CACHE_TTL": 300,
+
+        # rendered recipe cards (see render_card) kept per worker, and whether every template is compiled when the app starts
+        "CARD_CACHE_SIZE": 20000,
+        "CARD_CACHE_TTL": 3600,
+        "PRECOMPILE_TEMPLATES": True,
+
+        # keep every recipe in memory (see Catalog) and serve the home page, recipe pages and cached searches from it;
+        # other workers' changes are picked up from the change_log table every CATALOG_REFRESH_SECONDS
+        "CATALOG_ENABLED": os.environ.get("CATALOG", "0") != "0",
+        "CATALOG_REFRESH_SECONDS": 2,
+        "CHANGE_LOG_KEEP_SECONDS": 86400,
+
+        # similar recipes shown on a recipe page. Candidates are found through a recipe's rarest ingredients, looking at
+        # about SIMILAR_SCAN_LIMIT other recipes, and the SIMILAR_CANDIDATES sharing the most of them are scored.
+        # "flask --app app build-similar-recipes" recomputes them all on SIMILAR_WORKERS processes
+        "SIMILAR_RECIPES": 6,
+        "SIMILAR_CANDIDATES": 200,
+        "SIMILAR_SCAN_LIMIT": 2000,
+        "SIMILAR_WORKERS": os.cpu_count() or 1,
+
+        # pantry search: how many missing ingredients are allowed unless the search says (and at most),
+        # and how often each worker's PantryIndex picks up other workers' changes
+        "PANTRY_MISSING": 2,
+        "PANTRY_MAX_MISSING": 5,
+        "PANTRY_REFRESH_SECONDS": 2,
+
+        # add a Server-Timing header (database and render time) to every response,
+        # and log requests slower than this many seconds along with their slowest query's plan
+        "SERVER_TIMING": os.environ.get("SERVER_TIMING", "0") != "0",
+        "SLOW_REQUEST_SECONDS": float(os.environ.get("SLOW_REQUEST_SECONDS", "0.5")),
+
+        # scrypt cost of new password hashes (2**cost rounds, using 2**cost KB of memory each),
+        # threads that hash and check passwords, and how many more logins may wait for one before the rest are turned away
+        "PASSWORD_HASH_COST": int(os.environ.get("PASSWORD_HASH_COST", "15")),
+        "PASSWORD_WORKERS": int(os.environ.get("PASSWORD_WORKERS", str(min(4, os.cpu_count() or 1)))),
+        "PASSWORD_QUEUE_LIMIT": 32,
+
+        # ratings are written by one background thread per worker, which gathers whatever arrives within
+        # RATING_BATCH_SECONDS (at most RATING_BATCH_SIZE) into one transaction; a request gives up after RATING_WRITE_TIMEOUT
+        "RATING_BATCH_SIZE": 200,
+        "RATING_BATCH_SECONDS": 0.005,
+        "RATING_WRITE_TIMEOUT": 10,
+
+        # uploaded photos: where they are kept, the widths they are resized to (with Pillow installed), the processes
+        # that resize them and how long a request waits for a variant that isn't ready; requests (so uploads) are limited to MAX_CONTENT_LENGTH bytes
+        "IMAGE_PATH": os.environ.get("IMAGE_PATH", os.path.join(root_path, "databaseFiles", "images")),
+        "IMAGE_WIDTHS": [320, 640, 1280],
+        "IMAGE_WORKERS": min(2, os.cpu_count() or 1),
+        "IMAGE_RESIZE_TIMEOUT": 30,
+        "MAX_CONTENT_LENGTH": 16 * 1024 * 1024,
+
+        # database maintenance (see Maintenance), every MAINTENANCE_SECONDS (0 turns it off) in whichever worker has been
+        # idle for MAINTENANCE_IDLE_SECONDS: PRAGMA optimize, or a full ANALYZE once MAINTENANCE_ANALYZE_CHANGES changes have been
+        # logged in change_log since the last one, and an incremental vacuum handing back up to MAINTENANCE_VACUUM_PAGES free pages
+        "MAINTENANCE_SECONDS": int(os.environ.get("MAINTENANCE_SECONDS", "3600")),
+        "MAINTENANCE_IDLE_SECONDS": 10,
+        "MAINTENANCE_ANALYZE_CHANGES": 10000,
+        "MAINTENANCE_VACUUM_PAGES": 4096,
+
+        # how many seconds browsers may cache files from static/ (uploaded images are cached for a year, their names change with their content)
+        "SEND_FILE_MAX_AGE_DEFAULT": 3600,
+
+        # most recipes one /api/v1/recipes?ids= request can ask for,
+        # and the smallest API response worth compressing (in bytes)
+        "API_BATCH_SIZE": 100,
+        "API_COMPRESS_MIN_BYTES": 1024,
+    }
+
+# "default" is meant for the development server.
+# "production" is for multi-worker deployments: WAL lets readers carry on while a recipe is being saved,
+# connections are pooled and checked before use, and read-only views get their own pool of read-only connections.
+database_profiles = {
+    "default": {
+        "pragmas": {"busy_timeout": 5000, "foreign_keys": "ON", "auto_vacuum": "INCREMENTAL"},
+        "engine": {},
+        "read_pool": False,
+    },
+    "production": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",     # safe with WAL, only the last commits can be lost on power failure
+            "cache_size": -64000,        # 64 MB page cache per connection
+            "mmap_size": 268435456,      # 256 MB memory-mapped reads
+            "temp_store": "MEMORY",
+            "busy_timeout": 5000,        # wait up to 5 seconds for a lock instead of failing with "database is locked"
+            "foreign_keys": "ON",        # deleting a recipe deletes its ingredients, ratings and the rest (see add_cascading_deletes)
+            "auto_vacuum": "INCREMENTAL",   # for new databases, or the next VACUUM; freed pages are handed back by Maintenance
+        },
+        "engine": {
+            "pool_size": 10,
+            "max_overflow": 20,
+            "pool_timeout": 30,
+            "pool_pre_ping": True,
+            "connect_args": {"cached_statements": 512},   # prepared statements kept per connection
+        },
+        "read_pool": True,
+    },
+}
+
+class RoutingSession(flask_sqlalchemy.session.Session):
+    """
+    Session that sends the queries of views marked with read_only to one of the read engines (replicas,
+    or the read-only pool), and everything else to the primary database.
+    A request keeps using the same read engine throughout, and a user who has just written (see writes)
+    reads from the primary for REPLICA_STICKY_SECONDS so they always see their own changes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and flask.has_request_context() and flask.g.get("read_only"):
+            if "read_bind" not in flask.g:
+                flask.g.read_bind = choose_read_bind()
+            if flask.g.read_bind is not None:
+                return self._db.engines[flask.g.read_bind]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def choose_read_bind():
+    """
+    Pick the bind key of the engine the current read-only request should use, or None for the primary.
+    """
+
+    config = flask.current_app.config
+
+    last_write = flask.session.get("last_write")
+    if last_write is not None and time.time() - last_write < config["REPLICA_STICKY_SECONDS"]:
+        return None
+
+    if len(config["SQLALCHEMY_BINDS"]) == 0:
+        return None
+
+    return random.choice(list(config["SQLALCHEMY_BINDS"]))
+
+database = SQLAlchemy(session_options={"class_": RoutingSession})
+
+pages = flask.Blueprint("pages", __name__, cli_group=None)
+api = flask.Blueprint("api", __name__, url_prefix="/api/v1")
+
+def create_app(config=None):
+    """
+    Build the application. Nothing touches the database here: the schema is created and upgraded
+    by "flask --app app migrate", run once per deployment rather than by every worker.
+    For gunicorn, use "app:create_app()".
+    """
+
+    global recipe_cache, search_cache, card_cache, password_hasher, rating_writer, catalog, pantry_index, image_store, maintenance
+
+    app = flask.Flask(__name__, template_folder="html")
+    app.config.update(default_config(app.root_path))
+    if config is not None:
+        app.config.update(config)
+
+    profile = database_profiles[app.config["DATABASE_PROFILE"]]
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", profile["engine"])
+
+    binds = {}
+    for i in range(len(app.config["DATABASE_REPLICAS"])):
+        binds[f"replica_{i}"] = {"url": app.config["DATABASE_REPLICAS"][i], **profile["engine"]}
+    if len(binds) == 0 and profile["read_pool"]:
+        binds["read"] = {"url": "sqlite:///file:" + app.config["DATABASE_PATH"] + "?mode=ro&uri=true", **profile["engine"]}
+    app.config.setdefault("SQLALCHEMY_BINDS", binds)
+
+    database.init_app(app)
+    with app.app_context():
+        for bind_key, engine in database.engines.items():
+            if engine.dialect.name == "sqlite":
+                # every bind is a read replica or the read-only pool
+                sqlalchemy.event.listen(engine, "connect", functools.partial(set_sqlite_pragmas, pragmas=profile["pragmas"], read_only=bind_key is not None))
+
+    app.register_blueprint(pages)
+    app.register_blueprint(api)
+    recipe_cache = make_cache(app.config, "RECIPE_CACHE")
+    search_cache = make_cache(app.config, "SEARCH_RESULTS_CACHE")
+    card_cache = LRUCache(app.config["CARD_CACHE_SIZE"], app.config["CARD_CACHE_TTL"])
+    app.add_template_global(render_card)
+    app.add_template_global(photo_srcset)
+    if app.config["PRECOMPILE_TEMPLATES"]:
+        # compile them now rather than in the first request that uses each one
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+    password_hasher = PasswordHasher(app.config)
+    rating_writer = RatingWriter(app)
+    catalog = Catalog(app)
+    pantry_index = PantryIndex(app)
+    image_store = ImageStore(app)
+    maintenance = Maintenance(app)
+    instrument(app)
+
+    app.config["STARTUP_SECONDS"] = time.perf_counter() - started_at
+    app.logger.info("App ready in %.1f ms", app.config["STARTUP_SECONDS"] * 1000)
+    return app
+
+def set_sqlite_pragmas(dbapi_connection, connection_record, pragmas, read_only=False):
+    """
+    Apply the profile's pragmas to every new connection.
+    """
+
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        if read_only and name in ["journal_mode", "auto_vacuum"]:
+            continue   # can't be changed from a read-only connection
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+def read_only(view):
+    """
+    Mark a view as only reading from the database, so its queries can go to the read-only connection pool.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        flask.g.read_only = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+def writes(view):
+    """
+    Mark a view as writing to the database. Once it has committed a change (see wrote), the user's next reads go to
+    the primary database for a little while (see RoutingSession), so they see their change even if the replicas are behind.
+    Showing a form or turning a request away leaves the user's reads where they were.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        response = view(*args, **kwargs)
+        if flask.g.get("wrote"):
+            flask.session["last_write"] = time.time()
+        return response
+
+    return wrapper
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(app.root_path, "databaseFiles", "recipes.db")
+def wrote():
+    """
+    Called by a view marked with writes once its change has been committed.
+    """
 
-database = SQLAlchemy(app)
+    flask.g.wrote = True
 
 # /////////////////
 #     Pages
 # /////////////////
 
-@app.route('/')
+@pages.route('/')
+@read_only
 def home_page():
     """
-    Select at most 15 random recipes to display on the main page.
+    Select at most 15 random recipes to display on the main page, from the catalog if it is enabled.
     """
 
     logged_in = False
     if "logged_in_user" in flask.session:
         logged_in = True
 
-    max_id_statement = database.select(Recipe).order_by(Recipe.id.desc())
-    highest_entry = database.session.execute(max_id_statement).first()
-    if highest_entry is None:
-        return flask.render_template("home.html", logged_in=logged_in, results=None)
-    
-    max_id = highest_entry[0].id
-
-    max_num = min(15, max_id+1)
-
-    recipes = []
-    seen = set()
-    for i in range(max_num):
-
-        # find a random id that we haven't seen yet
-        random_id = random.randint(0, max_id)
-        while random_id in seen:
-            random_id = random.randint(0, max_id)
-        seen.add(random_id)
-
-        # add the recipe
-        statement = database.select(Recipe).where(Recipe.id == random_id)
-        result = database.session.execute(statement).first()
-        if result is None:
-            continue
+    current = catalog.current()
+    if current is not None:
+        recipes = current.sample(15)
+    else:
+        recipes = fetch_recipe_cards(recipe_sampler.sample(15))
 
-        recipes.append(result[0])
+    if len(recipes) == 0:
+        return flask.render_template("home.html", logged_in=logged_in, results=None)
 
     return flask.render_template("home.html", logged_in=logged_in, results=recipes)
 
-@app.route('/login', methods=["GET", "POST"])
+@pages.route('/login', methods=["GET", "POST"])
+@writes
 def login_page():
     """
     Show the login page if the user is not logged in.
     For POST, check the email and password and log the user in if they are correct.
+    The password is checked on password_hasher's threads, and a password stored in plaintext
+    (or hashed with an old cost) is rehashed once it has been checked, if the hasher has room for it.
     """
 
     if flask.request.method == "POST":
@@ -75,10 +371,24 @@ def login_page():
             return flask.render_template("login_page.html", error="Email not found.")
         
         result = result[0]  # access the user
-        
-        if result.password != password:
+
+        try:
+            correct, outdated = password_hasher.verify(result.password, password)
+        except HasherBusy:
+            return flask.render_template("login_page.html", error="Too many people are logging in right now, please try again."), 503
+
+        if not correct:
             return flask.render_template("login_page.html", error="Incorrect password.")
-        
+
+        # the password is right, so a busy hasher only means the old hash is kept until a later login
+        if outdated:
+            try:
+                result.password = password_hasher.hash(password)
+                database.session.commit()
+                wrote()
+            except HasherBusy:
+                pass
+
         flask.session["logged_in_user"] = email
 
         flask.flash("Logged in successfully.")
@@ -92,7 +402,8 @@ def login_page():
         return flask.render_template("login_page.html")
     
 
-@app.route('/signup', methods=["GET", "POST"])
+@pages.route('/signup', methods=["GET", "POST"])
+@writes
 def sign_up_page():
     """
     Show the sign up page if the user is not logged in.
@@ -107,19 +418,27 @@ def sign_up_page():
 
         if email != email_confirmation:
             return flask.render_template("signup_page.html", error="Email confirmation does not match.")
+        if not password:
+            return flask.render_template("signup_page.html", error="Please choose a password.")
 
         statement = database.select(User).where(User.email == email)
         result = database.session.execute(statement).first()
         if result is not None:
             return flask.render_template("signup_page.html", error="An account already exists with that email.")
 
+        try:
+            hashed = password_hasher.hash(password)
+        except HasherBusy:
+            return flask.render_template("signup_page.html", error="Too many people are signing up right now, please try again."), 503
+
         user = User()
         user.email = email
         user.username = username
-        user.password = password
+        user.password = hashed
 
         database.session.add(user)
         database.session.commit()
+        wrote()
 
         flask.session["logged_in_user"] = email
         flask.flash("Account created successfully.")
@@ -133,10 +452,11 @@ def sign_up_page():
 
         return flask.render_template("signup_page.html")
 
-@app.route('/account')
+@pages.route('/account')
+@read_only
 def account():
     """
-    Display account information
+    Display account information, how many recipes the user has posted, and those recipes newest first, a page at a time.
     """
 
     if "logged_in_user" not in flask.session:
@@ -152,9 +472,20 @@ def account():
         return flask.redirect("/login")
     result = result[0]
 
-    return flask.render_template("account.html", email=email, username=result.username, password=result.password, logged_in=True)
+    try:
+        recipes, next_cursor = creator_feed(email, flask.current_app.config["SEARCH_PAGE_SIZE"], flask.request.args.get("cursor"))
+    except ValueError:
+        return flask.redirect("/account")
+    recipe_count = database.session.execute(recipe_count_statement, {"email": email}).scalar()
+
+    next_page = None
+    if next_cursor is not None:
+        next_page = flask.url_for("pages.account", cursor=next_cursor)
 
-@app.route('/logout')
+    return flask.render_template("account.html", email=email, username=result.username, logged_in=True,
+                                 recipes=recipes, recipe_count=recipe_count, next_page=next_page)
+
+@pages.route('/logout')
 def logout():
     """
     Remove the currently logged in user from the session and redirect to the home page.
@@ -167,7 +498,8 @@ def logout():
     
     return flask.redirect("/")
 
-@app.route('/create_recipe', methods=["GET", "POST"])
+@pages.route('/create_recipe', methods=["GET", "POST"])
+@writes
 def create_recipe():
     """
     Show the create recipe page, a form, if the user is logged in.
@@ -192,45 +524,37 @@ def create_recipe():
         ingredients = flask.request.form.getlist("items")
         method = flask.request.form.get("instructions")
 
-        if (len(quantities) != len(ingredients)):
-            flask.flash("Error: Each ingredient must have a quantity.")
-            return flask.redirect("/create_recipe")
-
-        # add recipe
-        recipe = Recipe()
-        recipe.id = None   # auto assigned
-        recipe.user_email = flask.session["logged_in_user"]
-        recipe.name = name
-        recipe.type = type
-        recipe.photo = img
-        recipe.date_posted = datetime.datetime.now()
-        recipe.method = method
-
-        database.session.add(recipe)
-        database.session.commit()
-
-        # get the id of the recipe we just added 
-        new_id = recipe.id
-
-        # add ingredients
-        for i in range(len(ingredients)):
-            ingredient = Ingredient()
-            ingredient.recipe_id = new_id
-            ingredient.name = ingredients[i]
-            ingredient.quantity = quantities[i]
-            ingredient.order = i
-            database.session.add(ingredient)
+        fields = {
+            "user_email": flask.session["logged_in_user"],
+            "name": name,
+            "type": type,
+            "photo": img,
+            "method": method,
+        }
 
-        database.session.commit()
+        try:
+            uploaded_photo(fields)
+            new_id, counts = save_recipe(None, fields, ingredients, quantities)
+        except ValueError as error:
+            flask.flash("Error: " + str(error))
+            return flask.redirect("/create_recipe")
 
+        wrote()
         flask.flash("Recipe created successfully.")
         return flask.redirect("/recipe/" + str(new_id))
 
-@app.route('/search', methods=["GET", "POST"])
+search_fields = ["name", "id", "type", "email", "min_rating", "max_rating", "ingredients", "pantry", "missing"]
+
+@pages.route('/search', methods=["GET", "POST"])
+@read_only
 def search():
     """
-    Show the advanced search page
-    For POST, search the database for recipes that match the given criteria/filters
+    Show the advanced search page.
+    The filters are read from the URL (e.g. /search?type=Mexican) so result pages can be bookmarked and cached;
+    a POST of the search form is redirected to the matching URL.
+    Results are shown a page at a time, with a link to the next page.
+    Given a pantry (/search?pantry=eggs,flour,milk&missing=2), it instead shows the recipes that can be made
+    from those ingredients with at most that many more, fewest missing first.
     """
 
     if "logged_in_user" in flask.session:
@@ -238,78 +562,149 @@ def search():
     else:
         logged_in = False
 
-    if flask.request.method == "GET":
+    if flask.request.method == "POST":
+        filters = {field: flask.request.form.get(field, "") for field in search_fields}
+        return flask.redirect(flask.url_for("pages.search", **filters))
+
+    args = flask.request.args
 
+    # no search yet, just show the form
+    if not any(field in args for field in search_fields):
         return flask.render_template("search.html", logged_in=logged_in, results=None)
+
+    try:
+        page_size = args.get("page_size", flask.current_app.config["SEARCH_PAGE_SIZE"], type=int)
+
+        if len(args.get("pantry", "").strip()) != 0:
+            if pantry_index.refresh_due():
+                pantry_index.refresh()
+            ids, missing, next_cursor = pantry_search(args, page_size, args.get("cursor"))
+
+            current = catalog.current()
+            recipes = current.cards(ids) if current is not None else fetch_recipe_cards(ids)
+            return search_results_page(logged_in, recipes, next_cursor, missing)
+
+        query = search_query(args)
+        recipes, next_cursor = advanced_search(query, limit=page_size, cursor=args.get("cursor"))
+    except ValueError:
+        flask.flash("Invalid search.")
+        return flask.redirect("/search")
+
+    return search_results_page(logged_in, recipes, next_cursor)
+
+def search_query(args):
+    """
+    Read the search filters from the URL's arguments. Raises ValueError if a rating isn't a number.
+    """
+
+    query = {}
+    if len(args.get("name", "")) != 0:
+        query["name"] = args["name"]
+    if len(args.get("id", "")) != 0:
+        query["id"] = args["id"]
+    if len(args.get("type", "")) != 0:
+        query["type"] = args["type"]
+    if len(args.get("email", "")) != 0:
+        query["email"] = args["email"]
+    if len(args.get("min_rating", "")) != 0:
+        query["min_rating"] = float(args["min_rating"])
+    if len(args.get("max_rating", "")) != 0:
+        query["max_rating"] = float(args["max_rating"])
+    if len(args.get("ingredients", "")) != 0:
+        query["ingredients"] = args["ingredients"]
+    return query
+
+def search_results_page(logged_in, recipes, next_cursor, missing=None):
+    """
+    Stream a page of search results, with a link to the next page if there is one.
+    missing maps each recipe id to the ingredients it needs that aren't in the pantry, for a pantry search.
+    """
+
+    args = flask.request.args
+
+    next_page = None
+    if next_cursor is not None:
+        next_page = flask.url_for("pages.search", **{**args.to_dict(), "cursor": next_cursor})
+
+    if len(recipes) == 0:
+        recipes = "empty"
+
+    # read the flashed messages now, while the session can still be saved;
+    # the template gets the same messages back when it's streamed
+    flask.get_flashed_messages()
+
+    response = flask.Response(flask.stream_template("search.html", logged_in=logged_in, results=recipes, next_page=next_page, missing=missing))
+    response.cache_control.private = True
+    response.cache_control.max_age = flask.current_app.config["SEARCH_CACHE_SECONDS"]
+    return response
     
-    if flask.request.method == "POST":
-        name = flask.request.form.get("name")
-        id = flask.request.form.get("id")
-        type = flask.request.form.get("type")
-        email = flask.request.form.get("email")
-        min_rating = flask.request.form.get("min_rating")
-        max_rating = flask.request.form.get("max_rating")
-        ingredients = flask.request.form.get("ingredients")
-        
-        query = {}
-        if len(name) != 0:
-            query["name"] = name
-        if len(id) != 0:
-            query["id"] = id
-        if len(type) != 0:
-            query["type"] = type
-        if len(email) != 0:
-            query["email"] = email
-        if len(min_rating) != 0:
-            query["min_rating"] = float(min_rating)
-        if len(max_rating) != 0:
-            query["max_rating"] = float(max_rating)
-        if len(ingredients) != 0:
-            query["ingredients"] = ingredients
-
-        recipes = advanced_search(query)
-        if len(recipes) == 0:
-            recipes = "empty"
-
-        return flask.render_template("search.html", logged_in=logged_in, results=recipes)
-    
-@app.route('/recipe/<recipe_id>')
+@pages.route('/recipe/<recipe_id>')
+@read_only
 def recipe_page(recipe_id):
     """
     Display a recipe with the given id.
     If the user is the owner of the recipe, displays an edit button.
+    The recipe and its ingredients come from recipe_cache, and the page carries an ETag
+    so browsers can revalidate it with a 304 instead of downloading it again.
     """
 
     logged_in = False
     if "logged_in_user" in flask.session:
         logged_in = True
 
-    statement = database.select(Recipe).where(Recipe.id == recipe_id)
-    result = database.session.execute(statement).first()
+    payload = load_recipe_payload(recipe_id)
 
-    if result is None:
+    if payload is None:
         flask.flash("Recipe not found.")
         return flask.redirect("/")
-    
-    recipe: Recipe = result[0]
+
+    similar = fetch_similar_recipes(payload["recipe"]["id"])
+
+    return recipe_response(logged_in, payload, similar)
+
+def recipe_response(logged_in, payload, similar):
+    """
+    Render a recipe page from its payload and similar recipes, or answer 304 if the browser's copy is still current.
+    The ingredient amounts are multiplied by the scale query argument, if there is one.
+    """
+
+    recipe = payload["recipe"]
+
+    scale = flask.request.args.get("scale", 1, type=float)
+    if not 0 < scale <= 100:
+        scale = 1
 
     owned = False
     user = flask.session.get("logged_in_user")
-    if logged_in and user == recipe.user_email:
+    if logged_in and user == recipe["user_email"]:
         owned = True
 
-    statement = database.select(Ingredient).where(Ingredient.recipe_id == recipe_id)
-    result = database.session.execute(statement).all()
-    ingredients = []
-    for row in result:
-        ingredients.append(row[0]) # Take ingredients out of the tuple
+    # the page also depends on who is looking at it (header links, edit button) and on the similar recipes shown
+    shown = ",".join(f"{row.id}:{row.name}:{row.photo}" for row in similar)
+    etag = hashlib.sha1((payload["etag"] + ":" + str(user) + ":" + shown + ":" + str(scale)).encode()).hexdigest()
 
-    # sort by order
-    ingredients.sort(key=lambda x: x.order)
+    # flashed messages are only shown once, so a page with one pending can't be revalidated.
+    # There is no Last-Modified: a date can't tell who is looking, the similar recipes or the scale apart
+    revalidated = False
+    if "_flashes" not in flask.session and flask.request.if_none_match:
+        revalidated = flask.request.if_none_match.contains(etag)
+
+    if revalidated:
+        response = flask.Response(status=304)
+    else:
+        ingredients = payload["ingredients"]
+        if scale != 1:
+            ingredients = [{"name": ingredient["name"], "quantity": scaled_quantity(ingredient, scale)} for ingredient in ingredients]
+        response = flask.make_response(flask.render_template("recipe.html", recipe=recipe, logged_in=logged_in, ingredients=ingredients,
+                                                             rating=payload["rating"], owned=owned, similar=similar, scale=scale))
 
-    return flask.render_template("recipe.html", recipe=recipe, logged_in=logged_in, ingredients=ingredients, owned=owned)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
-@app.route('/edit_recipe/<recipe_id>', methods=["GET", "POST"])
+@pages.route('/edit_recipe/<recipe_id>', methods=["GET", "POST"])
+@writes
 def edit_recipe(recipe_id):
     """
     Display a page that lets the user edit a recipe. Pre-fill the form with the current recipe information.
@@ -318,12 +713,12 @@ def edit_recipe(recipe_id):
 
     statement = database.select(Recipe).where(Recipe.id == recipe_id)
     result = database.session.execute(statement).first()
-    result = result[0] # access the recipe
 
     # check if recipe exists
     if result is None:
         flask.flash("Recipe not found.")
         return flask.redirect("/")
+    result = result[0] # access the recipe
     
     logged_in = False
     if "logged_in_user" in flask.session:
@@ -334,17 +729,12 @@ def edit_recipe(recipe_id):
         flask.flash("You can't edit this recipe.")
         return flask.redirect("/")
     
-    statement = database.select(Ingredient).where(Ingredient.recipe_id == recipe_id)
-
-    all_ingredients = database.session.execute(statement).all()
-    ingredients = []
-    for row in all_ingredients:
-        ingredients.append(row[0]) # Take ingredients out of the tuple
-        
-    ingredients.sort(key=lambda x: x.order)
+    ingredients = database.session.execute(ingredients_statement(recipe_id)).all()   # in order
 
-    first_ingredient = ingredients[0]
-    ingredients.pop(0) # remove the first ingredient
+    # an imported recipe can have no ingredients, which leaves the first row blank
+    first_ingredient = None
+    if len(ingredients) != 0:
+        first_ingredient = ingredients.pop(0) # remove the first ingredient
 
     if len(ingredients) == 0: # no additional ingredients
         ingredients = None
@@ -354,39 +744,28 @@ def edit_recipe(recipe_id):
     
     if flask.request.method == "POST":
 
-        # update the recipe
-        update_statement = database.update(Recipe).where(Recipe.id == recipe_id).values(
-            name = flask.request.form.get("name"),
-            type = flask.request.form.get("type"),
-            photo = flask.request.form.get("image"),
-            method = flask.request.form.get("instructions")
-        )
-
-        database.session.execute(update_statement)
-        database.session.commit()
-
-        # drop all the ingredients
-        delete_statement = database.delete(Ingredient).where(Ingredient.recipe_id == recipe_id)
-        database.session.execute(delete_statement)
-
-        # re-add all the (edited) ingredients 
+        fields = {
+            "name": flask.request.form.get("name"),
+            "type": flask.request.form.get("type"),
+            "photo": flask.request.form.get("image"),
+            "method": flask.request.form.get("instructions"),
+        }
         ingredients = flask.request.form.getlist("items")
         quantities = flask.request.form.getlist("quantities")
 
-        for i in range(len(ingredients)):
-            ingredient = Ingredient()
-            ingredient.recipe_id = recipe_id
-            ingredient.name = ingredients[i]
-            ingredient.quantity = quantities[i]
-            ingredient.order = i
-            database.session.add(ingredient)
-
-        database.session.commit()
+        try:
+            uploaded_photo(fields)
+            save_recipe(result.id, fields, ingredients, quantities)
+        except ValueError as error:
+            flask.flash("Error: " + str(error))
+            return flask.redirect("/edit_recipe/" + recipe_id)
 
+        wrote()
         flask.flash("Recipe updated successfully.")
         return flask.redirect("/recipe/" + recipe_id)
     
-@app.route('/delete_recipe/<recipe_id>')
+@pages.route('/delete_recipe/<recipe_id>')
+@writes
 def delete_recipe(recipe_id):
     """
     Delete the recipe with the given id, if the user is the owner.
@@ -394,11 +773,11 @@ def delete_recipe(recipe_id):
 
     statement = database.select(Recipe).where(Recipe.id == recipe_id)
     result = database.session.execute(statement).first()
-    result = result[0]
 
     if result is None:
         flask.flash("Recipe not found.")
         return flask.redirect("/")
+    result = result[0]
     
     logged_in = False
     if "logged_in_user" in flask.session:
@@ -408,228 +787,3637 @@ def delete_recipe(recipe_id):
         flask.flash("You don't own this recipe.")
         return flask.redirect("/")
     
-    # delete the recipe
+    # delete the recipe; its ingredients, ratings, rating totals, saves, terms and similar recipes go with it (ON DELETE CASCADE)
     delete_statement = database.delete(Recipe).where(Recipe.id == recipe_id)
     database.session.execute(delete_statement)
 
-    # delete the ingredients
-    delete_statement = database.delete(Ingredient).where(Ingredient.recipe_id == recipe_id)
-    database.session.execute(delete_statement)
+    unindex_recipe(recipe_id)
 
     database.session.commit()
+    wrote()
+    recipe_sampler.remove(int(recipe_id))
+    recipe_cache.delete(int(recipe_id))
+    catalog.changed()
+    pantry_index.changed()
 
     flask.flash("Recipe deleted successfully.")
     return flask.redirect("/")
 
-# /////////////////
-#     Functions
-# /////////////////
+@pages.route('/recipe/<recipe_id>/rate', methods=["POST"])
+@writes
+def rate_recipe(recipe_id):
+    """
+    Save the logged in user's rating (1 to 5 stars and an optional comment) of a recipe, replacing any earlier one.
+    Takes the recipe page's form, answered with a redirect back to the recipe,
+    or a JSON body ({"stars": 4, "description": "..."}), answered with the recipe's new average.
+    """
 
-def advanced_search(query):
+    as_json = flask.request.is_json
 
-    search_statement = """SELECT recipes.id, recipes.photo, recipes.name, recipes.user_email, recipes.type, recipes.date_posted, recipes.method, avg_ratings.avg FROM 
-                            recipes 
-                            LEFT OUTER JOIN (SELECT recipe_id, AVG(stars) as avg FROM ratings GROUP BY recipe_id) as avg_ratings
-                            ON recipes.id = avg_ratings.recipe_id
-                            WHERE """
-    if "name" in query:
-        search_statement += "name LIKE :name AND "
-        query["name"] = "%" + query["name"] + "%"
-    if "id" in query:
-        search_statement += "id = :id AND "
-    if "type" in query:
-        search_statement += "type LIKE :type AND "
-        query["type"] = "%" + query["type"] + "%"
-    if "email" in query:
-        search_statement += "user_email = :email AND "
-    if "min_rating" in query:
-        search_statement += "avg_ratings.avg >= :min_rating AND "
-    if "max_rating" in query:
-        search_statement += "avg_ratings.avg <= :max_rating AND "
-    if "ingredients" in query:
-        search_statement += "id IN (SELECT recipe_id FROM ingredients WHERE name LIKE :ingredients) AND "
-        query["ingredients"] = "%" + query["ingredients"] + "%"
+    def fail(message, status):
+        if as_json:
+            return flask.jsonify(error=message), status
+        flask.flash(message)
+        if status == 401:
+            return flask.redirect("/login")
+        return flask.redirect(f"/recipe/{recipe_id}")
 
-    # trim the AND or WHERE
-    if search_statement[-5:] == " AND ":
-        search_statement = search_statement[:-5]
-    if search_statement[-7:] == " WHERE ":
-        search_statement = search_statement[:-7]
+    if "logged_in_user" not in flask.session:
+        return fail("Log in to rate recipes.", 401)
 
-    results = database.session.execute(sqlalchemy.text(search_statement), query).all()
-    return results
+    if as_json:
+        data = flask.request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return fail("Invalid rating.", 400)
+    else:
+        data = flask.request.form
 
-# /////////////////
-#     Tables
-# /////////////////
+    try:
+        recipe_id = int(recipe_id)
+        stars = int(data.get("stars"))
+    except (TypeError, ValueError):
+        return fail("Invalid rating.", 400)
+    if stars < 1 or stars > 5:
+        return fail("Ratings are from 1 to 5 stars.", 400)
 
-class User(database.Model):
-    __tablename__ = "users"
+    description = data.get("description") or None
+    if description is not None and not isinstance(description, str):
+        return fail("Invalid rating.", 400)
 
-    email = database.Column(database.String, primary_key=True)
-    username = database.Column(database.String, nullable=False)
-    password = database.Column(database.String, nullable=False)
+    if database.session.get(Recipe, recipe_id) is None:
+        return fail("Recipe not found.", 404)
+    database.session.rollback()   # don't hold a read transaction open while the writer works
 
-    def __repr__(self):
-        return f"User: {self.username} [{self.email}]"
+    try:
+        rating_writer.submit(recipe_id, flask.session["logged_in_user"], stars, description).result(flask.current_app.config["RATING_WRITE_TIMEOUT"])
+    except concurrent.futures.TimeoutError:
+        return fail("Couldn't save the rating in time, please try again.", 503)
+    except LookupError as error:
+        return fail(str(error), 404)   # the recipe or the user was deleted in the meantime
+    wrote()
 
-class Recipe(database.Model):
-    __tablename__ = "recipes"
+    if not as_json:
+        flask.flash("Thanks for rating this recipe.")
+        return flask.redirect(f"/recipe/{recipe_id}")
 
-    id = database.Column(database.Integer, primary_key=True)
-    user_email = database.Column(database.String, database.ForeignKey("users.email"), nullable=False, index=True)
-    name = database.Column(database.String, nullable=False, index=True)
-    date_posted = database.Column(database.DateTime, nullable=False)
-    type = database.Column(database.String, nullable=False, index=True)
-    photo = database.Column(database.String)
-    method = database.Column(database.String, nullable=False)
+    totals = database.session.get(RatingStats, recipe_id)
+    return flask.jsonify(recipe_id=recipe_id, stars=stars, avg=totals.avg, rating_count=totals.rating_count)
 
-    def __repr__(self):
-        return f"Recipe {self.id}: {self.name} ({self.type})"
-    
-class Ingredient(database.Model):
-    __tablename__ = "ingredients"
+@pages.route('/images/<name>')
+def image(name):
+    """
+    Serve an uploaded photo or one of its resized variants ("<hash>-<width>.jpg").
+    A name's content never changes, so browsers are told to keep it for a year without checking back.
+    """
 
-    recipe_id = database.Column(database.Integer, database.ForeignKey("recipes.id"), primary_key=True)
-    name = database.Column(database.String, primary_key=True)
-    quantity = database.Column(database.String, nullable=False)
-    order = database.Column(database.Integer, nullable=False)
+    match = image_name.fullmatch(name)
+    if match is None:
+        flask.abort(404)
 
-    def __repr__(self):
-        return f"{self.quantity} {self.name} [{self.recipe_id}]"
-    
-class Rating(database.Model):
-    __tablename__ = "ratings"
+    if match["width"] is not None:
+        if match["extension"] != "jpg" or not image_store.resizing() or int(match["width"]) not in image_store.widths:
+            flask.abort(404)
+        try:
+            if not image_store.variant(match["hash"], int(match["width"])):
+                flask.abort(404)
+        except concurrent.futures.TimeoutError:
+            flask.abort(503)
 
-    recipe_id = database.Column(database.Integer, database.ForeignKey("recipes.id"), primary_key=True)
-    user_email = database.Column(database.String, database.ForeignKey("users.email"), primary_key=True)
-    stars = database.Column(database.Integer, nullable=False)
-    description = database.Column(database.String)
+    response = flask.send_from_directory(image_store.path, name, max_age=365 * 86400)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@pages.route('/stats')
+def stats():
+    """
+    Report cache (recipe, search results and rendered card), rating writer and database maintenance counters
+    and how long the worker took to start as JSON.
+    """
+
+    return flask.jsonify(startup_seconds=flask.current_app.config["STARTUP_SECONDS"], recipe_cache=recipe_cache.stats(), search_cache=search_cache.stats(),
+                         card_cache=card_cache.stats(), rating_writer=rating_writer.stats(), maintenance=maintenance.stats())
+
+@pages.route('/metrics')
+def metrics():
+    """
+    Report per-route request, query and render timings (for this worker) in Prometheus' text format.
+    """
 
+    return flask.Response(request_metrics.prometheus(), mimetype="text/plain; version=0.0.4")
 
 # /////////////////
-#     Main
+#     API
 # /////////////////
 
-with app.app_context():
-    database.create_all()
-    
-    # Sample data
-    newUsers = [
-        User(username="bob", email="bob@gmail.com", password="password"),
-        User(username="charlie", email="charlie@gmail.com", password="password"),
-        User(username="alice", email="alice@gmail.com", password="password"),
-        User(username="david", email="david@gmail.com", password="password"),
-        User(username="emma", email="emma@gmail.com", password="password"),
-        User(username="frank", email="frank@gmail.com", password="password"),
-        User(username="grace", email="grace@gmail.com", password="password"),
-        User(username="hannah", email="hannah@gmail.com", password="password"),
-        User(username="ian", email="ian@gmail.com", password="password"),
-        User(username="julia", email="julia@gmail.com", password="password"),
-        User(username="kyle", email="kyle@gmail.com", password="password"),
-        User(username="linda", email="linda@gmail.com", password="password"),
-        User(username="mike", email="mike@gmail.com", password="password"),
-        User(username="nina", email="nina@gmail.com", password="password"),
-        User(username="oscar", email="oscar@gmail.com", password="password"),
-        User(username="paul", email="paul@gmail.com", password="password"),
-        User(username="quincy", email="quincy@gmail.com", password="password"),
-    ]
-
-    date = datetime.date(2024, 1, 1)
-
-    newRecipes = []
-    newIngredients = []
-
-    newRecipes.append( Recipe(id = 1, user_email="bob@gmail.com", name="Baked Ziti", date_posted=date, type="Italian", photo=r"https://www.allrecipes.com/thmb/oXuLKPsb-Wa_LolmP3JpVl7q2ow=/1500x0/filters:no_upscale():max_bytes(150000):strip_icc()/18031-baked-ziti-ii-DDMFS-4x3-45e614088a504a67b9a9dde7001be4ee.jpg", 
-                              method="1. Preheat oven to 350°F.\n2. Cook pasta according to directions.\n3. Mix pasta with sauce and cheese.\n4. Bake for 20 minutes.") )
-    newIngredients.append( Ingredient(recipe_id=1, name="Ziti pasta", quantity="1 box", order=1) )
-    newIngredients.append( Ingredient(recipe_id=1, name="Pasta sauce", quantity="2 cups", order=2) )
-    newIngredients.append( Ingredient(recipe_id=1, name="Mozzarella cheese", quantity="1 oz", order=3) )
-
-    newRecipes.append( Recipe(id=2, user_email="charlie@gmail.com", name="Chicken Tikka Masala", date_posted=date, type="Indian", photo=r"https://www.allrecipes.com/thmb/1ul-jdOz8H4b6BDrRcYOuNmJgt4=/1500x0/filters:no_upscale():max_bytes(150000):strip_icc()/239867chef-johns-chicken-tikka-masala-ddmfs-3X4-0572-e02a25f8c7b745459a9106e9eb13de10.jpg",
-                            method="1. Marinate chicken in yogurt and spices for 1 hour.\n2. Cook chicken in a skillet.\n3. Simmer chicken in spiced tomato cream sauce.\n4. Serve with rice.") )
-    newIngredients.append( Ingredient(recipe_id=2, name="Chicken", quantity="1 lb", order=1) )
-    newIngredients.append( Ingredient(recipe_id=2, name="Yogurt", quantity="1 cup", order=2) )
-    newIngredients.append( Ingredient(recipe_id=2, name="Garam masala", quantity="2 tsp", order=3) )
-    newIngredients.append( Ingredient(recipe_id=2, name="Tomato puree", quantity="1 cup", order=4) )
-    newIngredients.append( Ingredient(recipe_id=2, name="Heavy cream", quantity="1/2 cup", order=5) )
-    newIngredients.append( Ingredient(recipe_id=2, name="Rice", quantity="2 cups", order=6) )
-
-    newRecipes.append( Recipe(id=3, user_email="emma@gmail.com", name="Sushi Rolls", date_posted=date, type="Japanese", photo=r"https://www.sbfoods-worldwide.com/recipes/q78eit00000004lp-img/5_Dragonroll_Wasabi_recipe.jpg",
-                            method="1. Cook sushi rice.\n2. Lay seaweed on bamboo mat.\n3. Spread rice, add fillings, and roll tightly.\n4. Slice into pieces.") )
-    newIngredients.append( Ingredient(recipe_id=3, name="Sushi rice", quantity="1 cup", order=1) )
-    newIngredients.append( Ingredient(recipe_id=3, name="Seaweed sheets", quantity="5 sheets", order=2) )
-    newIngredients.append( Ingredient(recipe_id=3, name="Cucumber", quantity="1, julienned", order=3) )
-    newIngredients.append( Ingredient(recipe_id=3, name="Avocado", quantity="1, sliced", order=4) )
-    newIngredients.append( Ingredient(recipe_id=3, name="Imitation crab", quantity="4 oz", order=5) )
-
-    newRecipes.append( Recipe(id=4, user_email="frank@gmail.com", name="Tacos", date_posted=date, type="Mexican", photo=r"https://www.allrecipes.com/thmb/vG-of0Xa0W0eodSXPWV1KXD009U=/1500x0/filters:no_upscale():max_bytes(150000):strip_icc()/70935-taqueria-style-tacos-mfs-3x2-35-9145991a0ef94ceb8be05ae8d6be4f0f.jpg",
-                            method="1. Cook ground beef with taco seasoning.\n2. Warm tortillas.\n3. Fill tortillas with meat and toppings of choice.\n4. Serve immediately.") )
-    newIngredients.append( Ingredient(recipe_id=4, name="Ground beef", quantity="1 lb", order=1) )
-    newIngredients.append( Ingredient(recipe_id=4, name="Taco seasoning", quantity="1 packet", order=2) )
-    newIngredients.append( Ingredient(recipe_id=4, name="Tortillas", quantity="6 small", order=3) )
-    newIngredients.append( Ingredient(recipe_id=4, name="Lettuce", quantity="1 cup, shredded", order=4) )
-    newIngredients.append( Ingredient(recipe_id=4, name="Cheddar cheese", quantity="1 cup, shredded", order=5) )
-    newIngredients.append( Ingredient(recipe_id=4, name="Sour cream", quantity="1/2 cup", order=6) )
-
-    newRecipes.append( Recipe(id=5, user_email="hannah@gmail.com", name="Pad Thai", date_posted=date, type="Thai", photo=r"https://cdn.apartmenttherapy.info/image/upload/f_jpg,q_auto:eco,c_fill,g_auto,w_1500,ar_4:3/k%2FPhoto%2FRecipes%2F2024-04-pad-thai-190%2Fpad-thai-190-251",
-                            method="1. Soak rice noodles in warm water.\n2. Stir-fry shrimp and tofu.\n3. Add noodles, sauce, and mix well.\n4. Serve with peanuts and lime.") )
-    newIngredients.append( Ingredient(recipe_id=5, name="Rice noodles", quantity="1 package", order=1) )
-    newIngredients.append( Ingredient(recipe_id=5, name="Shrimp", quantity="1/2 lb", order=2) )
-    newIngredients.append( Ingredient(recipe_id=5, name="Tofu", quantity="1/2 lb, cubed", order=3) )
-    newIngredients.append( Ingredient(recipe_id=5, name="Pad Thai sauce", quantity="1/2 cup", order=4) )
-    newIngredients.append( Ingredient(recipe_id=5, name="Peanuts", quantity="1/4 cup, crushed", order=5) )
-    newIngredients.append( Ingredient(recipe_id=5, name="Lime", quantity="1, cut into wedges", order=6) )
-
-    newRecipes.append( Recipe(id=6, user_email="kyle@gmail.com", name="Beef Stroganoff", date_posted=date, type="Russian", photo=r"https://cdn.apartmenttherapy.info/image/upload/f_jpg,q_auto:eco,c_fill,g_auto,w_1500,ar_4:3/k%2FPhoto%2FRecipes%2F2024-03-beef-stroganoff-190%2Fbeef-stroganoff-190-342_1",
-                            method="1. Cook beef strips with onions.\n2. Make sauce with sour cream and broth.\n3. Add beef back to the sauce.\n4. Serve over egg noodles.") )
-    newIngredients.append( Ingredient(recipe_id=6, name="Beef strips", quantity="1 lb", order=1) )
-    newIngredients.append( Ingredient(recipe_id=6, name="Onion", quantity="1, sliced", order=2) )
-    newIngredients.append( Ingredient(recipe_id=6, name="Mushrooms", quantity="1 cup, sliced", order=3) )
-    newIngredients.append( Ingredient(recipe_id=6, name="Sour cream", quantity="1 cup", order=4) )
-    newIngredients.append( Ingredient(recipe_id=6, name="Beef broth", quantity="1/2 cup", order=5) )
-    newIngredients.append( Ingredient(recipe_id=6, name="Egg noodles", quantity="2 cups, cooked", order=6) )
-
-    newRecipes.append( Recipe(id=7, user_email="julia@gmail.com", name="Shrimp Tacos", date_posted=date, type="Mexican", photo=r"https://www.allrecipes.com/thmb/Zn2RPAHWj71aOmYzhiKRbRHu5yU=/1500x0/filters:no_upscale():max_bytes(150000):strip_icc()/280916-shrimp-tacos-with-cilantro-lime-crema-4x3-0389-1b3aec87d6e54bd0b1f06b0e36478124.jpg",
-                            method="1. Season shrimp and cook in a skillet.\n2. Warm tortillas.\n3. Fill tortillas with shrimp and toppings of choice.\n4. Serve with lime.") )
-    newIngredients.append( Ingredient(recipe_id=7, name="Shrimp", quantity="1/2 lb", order=1) )
-    newIngredients.append( Ingredient(recipe_id=7, name="Taco seasoning", quantity="1 tsp", order=2) )
-    newIngredients.append( Ingredient(recipe_id=7, name="Tortillas", quantity="6 small", order=3) )
-    newIngredients.append( Ingredient(recipe_id=7, name="Cabbage", quantity="1 cup, shredded", order=4) )
-    newIngredients.append( Ingredient(recipe_id=7, name="Avocado", quantity="1, sliced", order=5) )
-    newIngredients.append( Ingredient(recipe_id=7, name="Lime", quantity="1, cut into wedges", order=6) )
-
-    newRecipes.append( Recipe(id=8, user_email="nina@gmail.com", name="Chicken Pot Pie", date_posted=date, type="American", photo=r"https://mojo.generalmills.com/api/public/content/tKec_wnrtk-lTBFsG4Vi5A_webp_base.webp?v=495880c8&t=e724eca7b3c24a8aaa6e089ed9e611fd",
-                            method="1. Cook chicken and vegetables in broth.\n2. Add cream and flour to thicken.\n3. Pour into pie crust and cover with another crust.\n4. Bake at 375°F for 45 minutes.") )
-    newIngredients.append( Ingredient(recipe_id=8, name="Chicken", quantity="1 lb, diced", order=1) )
-    newIngredients.append( Ingredient(recipe_id=8, name="Carrots", quantity="1 cup, diced", order=2) )
-    newIngredients.append( Ingredient(recipe_id=8, name="Peas", quantity="1 cup", order=3) )
-    newIngredients.append( Ingredient(recipe_id=8, name="Chicken broth", quantity="2 cups", order=4) )
-    newIngredients.append( Ingredient(recipe_id=8, name="Heavy cream", quantity="1/2 cup", order=5) )
-    newIngredients.append( Ingredient(recipe_id=8, name="Flour", quantity="2 tbsp", order=6) )
-    newIngredients.append( Ingredient(recipe_id=8, name="Pie crust", quantity="2 sheets", order=7) )
-
-    newRecipes.append( Recipe(id=9, user_email="paul@gmail.com", name="Onion Rings", date_posted=date, type="American", photo=r"https://staticcookist.akamaized.net/wp-content/uploads/sites/22/2024/06/cheese-onion-rings.jpg",
-                            method="1. Slice onions into rings.\n2. Dip rings into batter, then coat with breadcrumbs.\n3. Deep-fry until golden brown.\n4. Serve with dipping sauce.") )
-    newIngredients.append( Ingredient(recipe_id=9, name="Onion", quantity="2 large", order=1) )
-    newIngredients.append( Ingredient(recipe_id=9, name="Flour", quantity="1 cup", order=2) )
-    newIngredients.append( Ingredient(recipe_id=9, name="Milk", quantity="1 cup", order=3) )
-    newIngredients.append( Ingredient(recipe_id=9, name="Egg", quantity="1, beaten", order=4) )
-    newIngredients.append( Ingredient(recipe_id=9, name="Breadcrumbs", quantity="1 cup", order=5) )
-    newIngredients.append( Ingredient(recipe_id=9, name="Oil", quantity="2 cups, for frying", order=6) )
-
-    # Uncomment these lines to add the sample data to the database
-
-    # for r in newRecipes:
-    #     database.session.add(r)
-
-    # for i in newIngredients:
-    #     database.session.add(i)
-
-    # for u in newUsers:
-    #     database.session.add(u)
+# what a recipe and a search result are made of in the API; ?fields=name,rating picks some of them (the id always comes along)
+recipe_fields = ["user_email", "name", "date_posted", "type", "photo", "method", "ingredients", "rating"]
+card_fields = ["user_email", "name", "date_posted", "type", "photo", "avg_rating"]
 
-    database.session.commit()
+@api.route('/recipes/<int:recipe_id>')
+@read_only
+def api_recipe(recipe_id):
+    """
+    A recipe with its ingredients and rating totals, as JSON.
+    """
+
+    try:
+        fields = api_fields(recipe_fields)
+    except ValueError as error:
+        return api_error(str(error), 400)
+
+    payload = load_recipe_payload(recipe_id)
+    if payload is None:
+        return api_error("Recipe not found.", 404)
+
+    return api_response(api_recipe_data(payload, fields), version=payload["etag"] + ":" + ",".join(fields))
+
+@api.route('/recipes')
+@read_only
+def api_recipes():
+    """
+    Several recipes at once (/api/v1/recipes?ids=1,2,3, at most API_BATCH_SIZE of them), in the order asked for.
+    Ids that don't exist are listed under "not_found".
+    """
+
+    try:
+        fields = api_fields(recipe_fields)
+    except ValueError as error:
+        return api_error(str(error), 400)
+
+    try:
+        ids = [int(item) for item in flask.request.args.get("ids", "").split(",") if len(item.strip()) != 0]
+    except ValueError:
+        return api_error("Invalid ids.", 400)
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > flask.current_app.config["API_BATCH_SIZE"]:
+        return api_error(f"At most {flask.current_app.config['API_BATCH_SIZE']} recipes can be fetched at once.", 400)
+
+    payloads = load_recipe_payloads(ids)
+    recipes = [api_recipe_data(payloads[recipe_id], fields) for recipe_id in ids if recipe_id in payloads]
+    not_found = [recipe_id for recipe_id in ids if recipe_id not in payloads]
+
+    version = ",".join(payloads[recipe_id]["etag"] if recipe_id in payloads else "-" for recipe_id in ids)
+    return api_response({"recipes": recipes, "not_found": not_found}, version=version + ":" + ",".join(fields))
+
+@api.route('/search')
+@read_only
+def api_search():
+    """
+    Search with the search page's filters, page_size and cursor, as JSON. Results are recipe cards (no method or ingredients);
+    next_cursor fetches the next page, and is null on the last one.
+    With ?pantry=eggs,flour,milk&missing=2 it is a pantry search instead, and each result lists the ingredients it is missing.
+    """
+
+    args = flask.request.args
+
+    try:
+        fields = api_fields(card_fields)
+    except ValueError as error:
+        return api_error(str(error), 400)
+
+    missing = None
+    try:
+        page_size = args.get("page_size", flask.current_app.config["SEARCH_PAGE_SIZE"], type=int)
+
+        if len(args.get("pantry", "").strip()) != 0:
+            if pantry_index.refresh_due():
+                pantry_index.refresh()
+            ids, missing, next_cursor = pantry_search(args, page_size, args.get("cursor"))
+
+            current = catalog.current()
+            cards = current.cards(ids) if current is not None else fetch_recipe_cards(ids)
+        else:
+            cards, next_cursor = advanced_search(search_query(args), limit=page_size, cursor=args.get("cursor"))
+    except ValueError:
+        return api_error("Invalid search.", 400)
+
+    results = [api_card_data(card, fields) for card in cards]
+    if missing is not None:
+        for result in results:
+            result["missing"] = list(missing[result["id"]])
+
+    response = api_response({"results": results, "next_cursor": next_cursor})
+    response.cache_control.no_cache = None
+    response.cache_control.max_age = flask.current_app.config["SEARCH_CACHE_SECONDS"]
+    return response
+
+@api.after_request
+def compress_response(response):
+    """
+    Compress API responses of at least API_COMPRESS_MIN_BYTES with brotli (if the brotli package is installed)
+    or gzip, whichever the client accepts and prefers.
+    """
+
+    response.vary.add("Accept-Encoding")
+
+    if response.status_code != 200 or response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+
+    data = response.get_data()
+    if len(data) < flask.current_app.config["API_COMPRESS_MIN_BYTES"]:
+        return response
+
+    encodings = ["gzip"] if brotli is None else ["br", "gzip"]
+    encoding = flask.request.accept_encodings.best_match(encodings)
+    if encoding is None:
+        return response
+
+    # middling levels: most of the size saving for a fraction of the time of the highest ones
+    if encoding == "br":
+        data = brotli.compress(data, quality=5)
+    else:
+        data = gzip.compress(data, compresslevel=6)
+
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+def api_fields(allowed):
+    """
+    Read the fields asked for with ?fields= (all of allowed if not given). Raises ValueError for an unknown field.
+    """
+
+    if "fields" not in flask.request.args:
+        return allowed
+
+    fields = [field.strip() for field in flask.request.args["fields"].split(",") if len(field.strip()) != 0]
+    for field in fields:
+        if field not in allowed and field != "id":
+            raise ValueError(f"Unknown field: {field}.")
+    return [field for field in allowed if field in fields]
+
+def api_recipe_data(payload, fields):
+    """
+    The fields of a recipe payload (see load_recipe_payload) asked for.
+    """
+
+    data = {"id": payload["recipe"]["id"]}
+    for field in fields:
+        if field in ["ingredients", "rating"]:
+            data[field] = payload[field]
+        else:
+            data[field] = payload["recipe"][field]
+    return data
+
+def api_card_data(card, fields):
+    """
+    The fields of a recipe card (a fetch_recipe_cards row or a CatalogRecipe) asked for.
+    """
+
+    data = {"id": card.id}
+    for field in fields:
+        if field == "avg_rating":
+            data[field] = card.avg
+        elif field == "date_posted":
+            # the same text whether the card came from a query (the stored text) or the catalog (a datetime)
+            data[field] = str(datetime.datetime.fromisoformat(str(card.date_posted)))
+        else:
+            data[field] = getattr(card, field)
+    return data
+
+def api_response(data, version=None):
+    """
+    Answer with data as JSON, or with a 304 if the client already has it.
+    The ETag is made from version, which must change whenever data does, so a revalidated request doesn't build the JSON;
+    without one it is a hash of the JSON. It is weak since the same data may be sent compressed or not (see compress_response).
+    """
+
+    response = None
+    if version is None:
+        response = flask.jsonify(data)
+        etag = hashlib.sha1(response.get_data()).hexdigest()
+    else:
+        etag = hashlib.sha1(version.encode()).hexdigest()
+
+    if flask.request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=304)
+    elif response is None:
+        response = flask.jsonify(data)
+
+    response.set_etag(etag, weak=True)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+def api_error(message, status):
+    """
+    Answer with a JSON error message.
+    """
+
+    return flask.jsonify(error=message), status
+
+# /////////////////
+#     Functions
+# /////////////////
+
+class RecipeSampler:
+    """
+    Keeps a dense list of the ids of every live recipe so that random recipes can be picked
+    without probing the database for ids that may not exist.
+    The list is loaded on first use, updated by create_recipe/delete_recipe and
+    reloaded every SAMPLER_REFRESH_SECONDS to pick up changes made by other workers.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}   # recipe id -> index in self.ids
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        statement = database.select(Recipe.id)
+        self.replace(database.session.execute(statement).scalars().all())
+
+    def replace(self, ids):
+        with self.lock:
+            self.ids = list(ids)
+            self.positions = {recipe_id: i for i, recipe_id in enumerate(self.ids)}
+            self.loaded_at = time.monotonic()
+
+    def add(self, recipe_id):
+        with self.lock:
+            if recipe_id in self.positions:
+                return
+            self.positions[recipe_id] = len(self.ids)
+            self.ids.append(recipe_id)
+
+    def remove(self, recipe_id):
+        with self.lock:
+            index = self.positions.pop(recipe_id, None)
+            if index is None:
+                return
+
+            # move the last id into the hole so the list stays dense
+            last = self.ids.pop()
+            if index < len(self.ids):
+                self.ids[index] = last
+                self.positions[last] = index
+
+    def sample(self, count):
+        """
+        Return at most count distinct recipe ids, chosen at random.
+        """
+
+        if self.stale():
+            self.load()
+
+        with self.lock:
+            return random.sample(self.ids, min(count, len(self.ids)))
+
+    def stale(self):
+        """
+        Whether the list needs to be (re)loaded before sampling.
+        """
+
+        refresh = flask.current_app.config["SAMPLER_REFRESH_SECONDS"]
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > refresh
+
+recipe_sampler = RecipeSampler()
+
+class LRUCache:
+    """
+    In-process cache holding at most max_size entries, each for at most ttl seconds.
+    When it is full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()   # key -> (expires at, value)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            entries = list(self.entries.items())
+
+        lookups = self.hits + self.misses
+        return {"backend": "memory", "size": len(entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups != 0 else 0, "bytes": sum(approximate_size(entry) for entry in entries)}
+
+class RedisCache:
+    """
+    Cache kept in a Redis server (or anything else that speaks the Redis protocol), shared by every worker.
+    Values must be JSON serializable. Redis expires and evicts entries itself, so evictions aren't counted here.
+    """
+
+    def __init__(self, url, ttl, prefix):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The redis package is needed to use a Redis cache (pip install redis).")
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + str(key))
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + str(key), json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + str(key))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        if len(keys) != 0:
+            self.client.delete(*keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses, "evictions": 0, "hit_rate": self.hits / lookups if lookups != 0 else 0}
+
+def make_cache(config, name):
+    """
+    Build the cache configured by the <name>_BACKEND, <name>_SIZE and <name>_TTL settings.
+    The backend is "memory", "redis" (using REDIS_URL) or "none".
+    """
+
+    backend = config[name + "_BACKEND"]
+    ttl = config[name + "_TTL"]
+
+    if backend == "redis":
+        return RedisCache(config["REDIS_URL"], ttl, prefix=name.lower() + ":")
+    if backend == "none":
+        return LRUCache(0, ttl)
+
+    return LRUCache(config[name + "_SIZE"], ttl)
+
+def approximate_size(value):
+    """
+    Roughly how many bytes value takes up in memory, including what it contains.
+    """
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(key) + approximate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approximate_size(item) for item in value)
+    return size
+
+recipe_cache = None   # set up by create_app
+search_cache = None   # set up by create_app
+
+def load_recipe_payload(recipe_id):
+    """
+    Get a recipe, its ingredients (in order) and its rating totals as plain data,
+    from the catalog if it is enabled, or else from recipe_cache if possible.
+    Returns None if the recipe doesn't exist.
+    The create, edit and delete routes and rating_writer remove a recipe from this worker's cache when they change it,
+    and changes made through other workers are caught by fresh_cached_payloads.
+    """
+
+    try:
+        recipe_id = int(recipe_id)
+    except ValueError:
+        return None
+
+    # a recipe missing from the catalog may just have been created by another worker
+    current = catalog.current()
+    if current is not None and recipe_id in current.recipes:
+        return current.payload(recipe_id)
+
+    payload = fresh_cached_payloads([recipe_id]).get(recipe_id)
+    if payload is not None:
+        return payload
+
+    # read before the recipe, so a change committed in between makes the entry look older, not newer
+    change_seq = database.session.execute(change_seq_statement).scalar()
+    result = database.session.execute(recipe_statement(recipe_id)).first()
+    if result is None:
+        return None
+    recipe: Recipe = result[0]
+
+    ingredients = database.session.execute(ingredients_statement(recipe_id)).all()
+
+    payload = recipe_payload(recipe, ingredients, result.avg, result.rating_count)
+    payload["change_seq"] = change_seq
+    recipe_cache.set(recipe_id, payload)
+    return payload
+
+def load_recipe_payloads(ids):
+    """
+    load_recipe_payload for many recipes at once. Those not in the catalog or recipe_cache are fetched together:
+    one query for the recipes and their rating totals, and one for all of their ingredients.
+    Returns the payloads by id; ids that don't exist are left out.
+    """
+
+    payloads = {}
+    current = catalog.current()
+
+    wanted = []
+    for recipe_id in ids:
+        if current is not None and recipe_id in current.recipes:
+            payloads[recipe_id] = current.payload(recipe_id)
+        else:
+            wanted.append(recipe_id)
+
+    payloads.update(fresh_cached_payloads(wanted))
+    wanted = [recipe_id for recipe_id in wanted if recipe_id not in payloads]
+    if len(wanted) == 0:
+        return payloads
+
+    change_seq = database.session.execute(change_seq_statement).scalar()
+    results = database.session.execute(recipes_statement(wanted)).all()
+    if len(results) == 0:
+        return payloads
+
+    ingredients = collections.defaultdict(list)
+    statement = ingredients_statement(None).where(Ingredient.recipe_id.in_([result[0].id for result in results]))
+    for ingredient in database.session.execute(statement):
+        ingredients[ingredient.recipe_id].append(ingredient)
+
+    for result in results:
+        recipe: Recipe = result[0]
+        payload = recipe_payload(recipe, ingredients[recipe.id], result.avg, result.rating_count)
+        payload["change_seq"] = change_seq
+        recipe_cache.set(recipe.id, payload)
+        payloads[recipe.id] = payload
+
+    return payloads
+
+def fresh_cached_payloads(ids):
+    """
+    The recipe_cache entries of the given recipes that are still current. Each entry keeps the last change_log seq from when
+    it was read, and is out of date once change_log has a later change to its recipe, whichever worker made it.
+    Entries expire after RECIPE_CACHE_TTL, long before change_log rows are pruned, so no change they could miss is gone.
+    """
+
+    cached = {}
+    for recipe_id in ids:
+        payload = recipe_cache.get(recipe_id)
+        if payload is not None:
+            cached[recipe_id] = payload
+    if len(cached) == 0:
+        return cached
+
+    latest = dict(database.session.execute(latest_changes_statement, {"ids": list(cached)}).all())
+    return {recipe_id: payload for recipe_id, payload in cached.items() if latest.get(recipe_id, 0) <= payload["change_seq"]}
+
+change_seq_statement = sqlalchemy.text("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'change_log'), 0)")
+
+# read from ix_change_log_recipe_seq, one seek per recipe
+latest_changes_statement = sqlalchemy.text("SELECT recipe_id, MAX(seq) FROM change_log WHERE recipe_id IN :ids GROUP BY recipe_id").bindparams(
+    sqlalchemy.bindparam("ids", expanding=True))
+
+def recipe_statement(recipe_id):
+    """
+    Select a recipe along with its average rating and number of ratings.
+    """
+
+    return (database.select(Recipe, RatingStats.avg, RatingStats.rating_count)
+            .outerjoin(RatingStats, RatingStats.recipe_id == Recipe.id)
+            .where(Recipe.id == recipe_id))
+
+def recipes_statement(ids):
+    """
+    Select several recipes along with their rating totals.
+    """
+
+    return (database.select(Recipe, RatingStats.avg, RatingStats.rating_count)
+            .outerjoin(RatingStats, RatingStats.recipe_id == Recipe.id)
+            .where(Recipe.id.in_(ids)))
+
+def ingredients_statement(recipe_id):
+    """
+    Select a recipe's ingredients in order, with their names as written (or everyone's, for None).
+    """
+
+    # rows from before names were kept as written show the normalized name
+    name = sqlalchemy.func.coalesce(Ingredient.name, IngredientName.name).label("name")
+    statement = (database.select(Ingredient.recipe_id, name, Ingredient.quantity, Ingredient.amount, Ingredient.unit, Ingredient.note)
+                 .join(IngredientName, IngredientName.id == Ingredient.ingredient_id)
+                 .order_by(Ingredient.order))
+    if recipe_id is not None:
+        statement = statement.where(Ingredient.recipe_id == recipe_id)
+    return statement
+
+def recipe_payload(recipe, ingredients, avg, rating_count):
+    """
+    Build the cached form of a recipe from its row (or model), its ingredients and its rating totals.
+    """
+
+    payload = {
+        "recipe": {
+            "id": recipe.id,
+            "user_email": recipe.user_email,
+            "name": recipe.name,
+            "date_posted": str(recipe.date_posted),
+            "type": recipe.type,
+            "photo": recipe.photo,
+            "method": recipe.method,
+        },
+        "ingredients": [{"name": ingredient.name, "quantity": ingredient.quantity, "amount": ingredient.amount, "unit": ingredient.unit, "note": ingredient.note}
+                        for ingredient in ingredients],
+        "rating": {"avg": avg, "count": rating_count or 0},
+    }
+    payload["etag"] = hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    return payload
+
+def fetch_recipe_cards(ids):
+    """
+    Fetch everything needed to display a recipe card (including the average rating)
+    for the given recipe ids in a single query. Rows come back in the same order as ids.
+    """
+
+    if len(ids) == 0:
+        return []
+
+    rows = database.session.execute(recipe_cards_statement, {"ids": list(ids)}).all()
+    return order_cards(ids, rows)
+
+card_cache = None   # set up by create_app
+
+def render_card(recipe):
+    """
+    Render the body of a recipe card (card_body in card.html) for a fetch_recipe_cards row or a CatalogRecipe.
+    Rendered cards are kept in card_cache under everything they show, so a changed recipe or rating
+    gets a new entry and the old one simply ages out; nothing has to be removed when recipes change.
+    """
+
+    key = (recipe.id, recipe.name, recipe.photo, recipe.type, recipe.user_email, recipe.avg)
+    card = card_cache.get(key)
+    if card is None:
+        card = flask.current_app.jinja_env.get_template("card.html").module.card_body(recipe)
+        card_cache.set(key, card)
+    return card
+
+recipe_cards_statement = sqlalchemy.text("""SELECT recipes.id, recipes.photo, recipes.name, recipes.user_email, recipes.type, recipes.date_posted, avg_ratings.avg FROM
+                                            recipes
+                                            LEFT OUTER JOIN rating_stats as avg_ratings
+                                            ON recipes.id = avg_ratings.recipe_id
+                                            WHERE recipes.id IN :ids""").bindparams(sqlalchemy.bindparam("ids", expanding=True))
+
+def order_cards(ids, rows):
+    """
+    Put the rows fetched for ids back in the order of ids.
+    Ids that no longer exist are dropped from the sampler.
+    """
+
+    found = {row.id: row for row in rows}
+
+    cards = []
+    for recipe_id in ids:
+        if recipe_id in found:
+            cards.append(found[recipe_id])
+        else:
+            recipe_sampler.remove(recipe_id)   # deleted by another worker
+
+    return cards
+
+# Creator feed
+
+def creator_feed(email, limit, cursor=None):
+    """
+    A page of a user's recipes as recipe cards, newest first, starting after cursor.
+    The page's ids come from the ix_recipes_user_feed index alone, so only the recipes shown are read.
+    Returns the cards and the cursor for the next page, or None if this is the last page.
+    Raises ValueError if the cursor has been tampered with.
+    """
+
+    if cursor is None:
+        rows = database.session.execute(feed_statement, {"email": email, "limit": limit + 1}).all()
+    else:
+        kind, date_posted, recipe_id = decode_cursor(cursor)
+        if kind != "feed" or not isinstance(date_posted, str) or not isinstance(recipe_id, int):
+            raise ValueError("Invalid cursor.")
+        rows = database.session.execute(feed_after_statement, {"email": email, "date_posted": date_posted, "id": recipe_id, "limit": limit + 1}).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(["feed", rows[-1].date_posted, rows[-1].id])
+
+    ids = [row.id for row in rows]
+    current = catalog.current()
+    return current.cards(ids) if current is not None else fetch_recipe_cards(ids), next_cursor
+
+feed_statement = sqlalchemy.text("""SELECT id, date_posted FROM recipes WHERE user_email = :email
+                                    ORDER BY date_posted DESC, id LIMIT :limit""")
+
+# the index is in (date_posted DESC, id) order, so the next page starts at the cursor's date, after the cursor's id
+feed_after_statement = sqlalchemy.text("""SELECT id, date_posted FROM recipes
+                                          WHERE user_email = :email AND date_posted <= :date_posted AND (date_posted < :date_posted OR id > :id)
+                                          ORDER BY date_posted DESC, id LIMIT :limit""")
+
+recipe_count_statement = sqlalchemy.text("SELECT count(*) FROM recipes WHERE user_email = :email")
+
+def create_user_feed_index():
+    # ix_recipes_user_feed starts with user_email, so the old index on user_email alone is only extra work for writes
+    database.session.execute(sqlalchemy.text("DROP INDEX IF EXISTS ix_recipes_user_email"))
+    database.session.commit()
+    for index in Recipe.__table__.indexes:
+        if index.name == "ix_recipes_user_feed":
+            index.create(database.engine, checkfirst=True)
+
+# Ingredient dictionary
+
+# ingredient names are stored once each in ingredient_names, in a normal form, and referred to by id; each ingredients
+# row also keeps the name as the recipe wrote it, for display. Quantities are split into an amount, a unit and
+# a note when a recipe is saved, so a recipe can be scaled without parsing its quantities again
+
+def ingredient_name(name):
+    """
+    The form an ingredient name is stored in: lowercase, with single spaces.
+    """
+
+    return " ".join(name.lower().split())
+
+def ingredient_ids(names):
+    """
+    Get the id of each of the (normalized) names, adding the ones ingredient_names doesn't have yet. Does not commit.
+    """
+
+    if len(names) == 0:
+        return {}
+
+    statement = database.select(IngredientName.name, IngredientName.id).where(IngredientName.name.in_(set(names)))
+    ids = dict(database.session.execute(statement).all())
+
+    missing = [{"name": name} for name in set(names) if name not in ids]
+    if len(missing) != 0:
+        # another worker may add the same name meanwhile
+        database.session.execute(sqlalchemy.dialects.sqlite.insert(IngredientName).on_conflict_do_nothing(), missing)
+        statement = database.select(IngredientName.name, IngredientName.id).where(IngredientName.name.in_([row["name"] for row in missing]))
+        ids.update(database.session.execute(statement).all())
+
+    return ids
+
+def ingredient_row(recipe_id, ingredient_id, name, quantity, order):
+    """
+    An ingredients row, with the name as written and its quantity parsed.
+    """
+
+    amount, unit, note = parse_quantity(quantity)
+    return {"recipe_id": recipe_id, "ingredient_id": ingredient_id, "name": name.strip(), "quantity": quantity,
+            "amount": amount, "unit": unit, "note": note, "order": order}
+
+def add_ingredient_display_names():
+    """
+    Add the column keeping each ingredient's name as written to databases whose ingredients table was rebuilt
+    by create_ingredient_names before it had one. Their rows only have the normalized name, which is shown instead.
+    """
+
+    columns = database.session.execute(sqlalchemy.text("PRAGMA table_info(ingredients)")).all()
+    if not any(column.name == "name" for column in columns):
+        database.session.execute(sqlalchemy.text("ALTER TABLE ingredients ADD COLUMN name VARCHAR"))
+
+# every spelling of a unit, and the one it is stored as
+units = {
+    "cup": "cup", "cups": "cup", "c": "cup",
+    "tablespoon": "tbsp", "tablespoons": "tbsp", "tbsp": "tbsp", "tbs": "tbsp",
+    "teaspoon": "tsp", "teaspoons": "tsp", "tsp": "tsp",
+    "ounce": "oz", "ounces": "oz", "oz": "oz",
+    "pound": "lb", "pounds": "lb", "lb": "lb", "lbs": "lb",
+    "gram": "g", "grams": "g", "g": "g",
+    "kilogram": "kg", "kilograms": "kg", "kg": "kg",
+    "milliliter": "ml", "milliliters": "ml", "millilitre": "ml", "millilitres": "ml", "ml": "ml",
+    "liter": "l", "liters": "l", "litre": "l", "litres": "l", "l": "l",
+    "pint": "pint", "pints": "pint", "quart": "quart", "quarts": "quart", "gallon": "gallon", "gallons": "gallon",
+    "pinch": "pinch", "pinches": "pinch", "dash": "dash", "dashes": "dash",
+    "clove": "clove", "cloves": "clove", "can": "can", "cans": "can", "slice": "slice", "slices": "slice",
+    "piece": "piece", "pieces": "piece", "stick": "stick", "sticks": "stick", "bunch": "bunch", "bunches": "bunch",
+}
+unit_plurals = {"cup": "cups", "pint": "pints", "quart": "quarts", "gallon": "gallons", "pinch": "pinches", "dash": "dashes", "clove": "cloves",
+                "can": "cans", "slice": "slices", "piece": "pieces", "stick": "sticks", "bunch": "bunches"}
+unicode_fractions = {"½": 0.5, "⅓": 1 / 3, "⅔": 2 / 3, "¼": 0.25, "¾": 0.75, "⅛": 0.125}
+
+quantity_pattern = re.compile(r"\s*(?:(?P<whole>\d+)\s+(?P<numerator>\d+)/(?P<denominator>\d+)|(?P<top>\d+)/(?P<bottom>\d+)|(?P<number>\d*\.?\d+))?"
+                              r"\s*(?P<fraction>[½⅓⅔¼¾⅛])?(?P<rest>.*)", re.DOTALL)
+
+@functools.lru_cache(maxsize=4096)
+def parse_quantity(text):
+    """
+    Split a quantity as written ("1 1/2 cups, chopped") into an amount (1.5), a unit ("cup") and a note ("chopped"),
+    each None if it isn't there. A quantity that doesn't start with a single number ("a pinch", "2-3"),
+    or whose number is too big for a float, is all note.
+    """
+
+    match = quantity_pattern.fullmatch(text)
+    try:
+        if match["whole"] is not None and int(match["denominator"]) != 0:
+            amount = int(match["whole"]) + int(match["numerator"]) / int(match["denominator"])
+        elif match["top"] is not None and int(match["bottom"]) != 0:
+            amount = int(match["top"]) / int(match["bottom"])
+        elif match["number"] is not None:
+            amount = float(match["number"])
+        else:
+            amount = None
+    except (OverflowError, ValueError):   # ValueError: more digits than int() will convert
+        amount = None
+    if match["fraction"] is not None:
+        amount = (amount or 0) + unicode_fractions[match["fraction"]]
+    if amount is not None and not math.isfinite(amount):
+        amount = None
+
+    rest = match["rest"].strip()
+    if amount is None or re.match(r"(-|–|to\s|or\s)\s*\d", rest) or (match["whole"] or match["top"] or "") and re.match(r"/", rest):
+        return None, None, text.strip() or None
+
+    unit = None
+    words = rest.split(None, 1)
+    if len(words) != 0 and words[0].rstrip(".,").lower() in units:
+        unit = units[words[0].rstrip(".,").lower()]
+        rest = words[1] if len(words) > 1 else ""
+
+    return amount, unit, rest.lstrip(",").strip() or None
+
+def format_quantity(amount, unit, note, scale):
+    """
+    Write a parsed quantity out again with its amount multiplied by scale, in kitchen fractions ("1 1/2 cups").
+    """
+
+    value = fractions.Fraction(amount * scale).limit_denominator(8)
+    whole, part = divmod(value.numerator, value.denominator)
+    if value == 0:
+        text = f"{amount * scale:.2g}"
+    elif part == 0:
+        text = str(whole)
+    elif whole == 0:
+        text = f"{part}/{value.denominator}"
+    else:
+        text = f"{whole} {part}/{value.denominator}"
+
+    if unit is not None:
+        text += " " + (unit_plurals.get(unit, unit) if value > 1 else unit)
+    if note is not None:
+        text += " " + note
+    return text
+
+def scaled_quantity(ingredient, scale):
+    """
+    An ingredient's quantity with its amount multiplied by scale. Quantities without an amount,
+    or too big to scale, are left as written.
+    """
+
+    if ingredient["amount"] is None or not math.isfinite(ingredient["amount"] * scale):
+        return ingredient["quantity"]
+    return format_quantity(ingredient["amount"], ingredient["unit"], ingredient["note"], scale)
+
+def create_ingredient_names():
+    """
+    Move ingredient names into ingredient_names and parse every quantity, by rebuilding the ingredients table
+    (SQLite can't change a primary key in place). Names that are the same once normalized are merged,
+    keeping a recipe's first listing, and each row keeps its name as written.
+    """
+
+    if has_ingredient_names():
+        return   # a new database, made with the current tables by initial_schema
+
+    connection = database.session.connection()
+    sqlite_connection = connection.connection.driver_connection
+    sqlite_connection.create_function("ingredient_name", 1, ingredient_name, deterministic=True)
+    for i, part in enumerate(["amount", "unit", "note"]):
+        sqlite_connection.create_function(f"quantity_{part}", 1, lambda text, i=i: parse_quantity(text)[i], deterministic=True)
+
+    IngredientName.__table__.create(connection, checkfirst=True)
+    connection.execute(sqlalchemy.text("INSERT OR IGNORE INTO ingredient_names(name) SELECT DISTINCT ingredient_name(name) FROM ingredients ORDER BY 1"))
+
+    # the table's triggers move with it, and are dropped with it
+    connection.execute(sqlalchemy.text("ALTER TABLE ingredients RENAME TO ingredients_old"))
+    Ingredient.__table__.create(connection)
+    connection.execute(sqlalchemy.text("""INSERT OR IGNORE INTO ingredients(recipe_id, ingredient_id, name, quantity, amount, unit, note, "order")
+                                          SELECT ingredients_old.recipe_id, ingredient_names.id, ingredients_old.name, quantity,
+                                              quantity_amount(quantity), quantity_unit(quantity), quantity_note(quantity), "order"
+                                          FROM ingredients_old JOIN ingredient_names ON ingredient_names.name = ingredient_name(ingredients_old.name)
+                                          WHERE ingredients_old.recipe_id IN (SELECT id FROM recipes)
+                                          ORDER BY ingredients_old.recipe_id, "order\""""))
+    connection.execute(sqlalchemy.text("DROP TABLE ingredients_old"))
+
+    create_generation_triggers("ingredients")
+    create_change_log_triggers("ingredients", "recipe_id")
+    database.session.commit()
+
+    # what earlier migrations left for after the rebuild, on databases that didn't have them yet
+    create_search_index()
+    if database.session.execute(database.select(RecipeTerm.recipe_id).limit(1)).first() is None:
+        build_similar_recipes(flask.current_app.config["SIMILAR_WORKERS"])
+        database.session.commit()
+
+def has_ingredient_names():
+    """
+    Whether the ingredients table refers to ingredient_names, rather than being from before create_ingredient_names
+    (or not there yet).
+    """
+
+    columns = database.session.execute(sqlalchemy.text("PRAGMA table_info(ingredients)")).all()
+    return len(columns) == 0 or any(column.name == "ingredient_id" for column in columns)
+
+# Recipe writes
+
+def save_recipe(recipe_id, fields, names, quantities):
+    """
+    Create a recipe (recipe_id None) or update an existing one, along with its ingredients, in a single transaction.
+    fields holds the recipe's name, type, photo and method (and user_email for a new recipe).
+    Ingredient names are normalized and looked up in (or added to) ingredient_names, and kept as written for display;
+    quantities are parsed.
+    Ingredient rows are diffed against what is stored, so unchanged ones are not rewritten
+    and new ones are inserted with one executemany.
+    Returns the recipe id and the number of rows touched. Raises ValueError if the ingredients are invalid.
+    """
+
+    if len(names) != len(quantities):
+        raise ValueError("Each ingredient must have a quantity.")
+    written = [name.strip() for name in names]
+    names = [ingredient_name(name) for name in names]
+    if len(set(names)) != len(names):
+        raise ValueError("Each ingredient can only be listed once.")
+
+    counts = {"recipes": 1, "inserted": 0, "updated": 0, "deleted": 0}
+
+    try:
+        if recipe_id is None:
+            recipe = Recipe(date_posted=datetime.datetime.now(), **fields)
+            database.session.add(recipe)
+            database.session.flush()   # assigns the id
+            recipe_id = recipe.id
+            existing = {}
+        else:
+            update_statement = database.update(Recipe).where(Recipe.id == recipe_id).values(**fields)
+            database.session.execute(update_statement)
+
+            statement = database.select(Ingredient.ingredient_id, Ingredient.name, Ingredient.quantity, Ingredient.order).where(Ingredient.recipe_id == recipe_id)
+            existing = {row.ingredient_id: (row.name, row.quantity, row.order) for row in database.session.execute(statement)}
+
+        ids = ingredient_ids(names)
+        wanted = {}
+        for i in range(len(names)):
+            wanted[ids[names[i]]] = (written[i], quantities[i], i)
+
+        removed = [ingredient_id for ingredient_id in existing if ingredient_id not in wanted]
+        added = [ingredient_row(recipe_id, ingredient_id, *wanted[ingredient_id])
+                 for ingredient_id in wanted if ingredient_id not in existing]
+        changed = [ingredient_row(recipe_id, ingredient_id, *wanted[ingredient_id])
+                   for ingredient_id in wanted if ingredient_id in existing and existing[ingredient_id] != wanted[ingredient_id]]
+
+        if len(removed) != 0:
+            delete_statement = database.delete(Ingredient).where(Ingredient.recipe_id == recipe_id, Ingredient.ingredient_id.in_(removed))
+            database.session.execute(delete_statement)
+        if len(changed) != 0:
+            database.session.execute(database.update(Ingredient), changed)   # bulk update by primary key
+        if len(added) != 0:
+            database.session.execute(database.insert(Ingredient), added)
+
+        counts["inserted"] = len(added)
+        counts["updated"] = len(changed)
+        counts["deleted"] = len(removed)
+
+        index_recipe(recipe_id)
+        update_similar_recipes(recipe_id, names)
+        database.session.commit()
+    except Exception:
+        database.session.rollback()
+        raise
+
+    recipe_sampler.add(recipe_id)
+    recipe_cache.delete(recipe_id)
+    catalog.changed()
+    pantry_index.changed()
+
+    flask.current_app.logger.info("Saved recipe %s: %s", recipe_id, counts)
+    return recipe_id, counts
+
+def advanced_search(query, limit=None, cursor=None):
+    """
+    Search for recipes matching every filter in query.
+    Name, type and ingredient filters use the recipe_search full-text index when it is available,
+    in which case results are ranked by relevance; otherwise the newest recipes come first.
+    Ingredients can be given as a comma separated list ("chicken, cream"); a recipe must contain all of them.
+
+    At most limit results are returned (never more than SEARCH_MAX_PAGE_SIZE), starting after cursor.
+    Returns the results and the cursor for the next page, or None if this is the last page.
+
+    The ids of each page are kept in search_cache; a cached page only needs its recipe cards fetched
+    (or taken from the catalog).
+    """
+
+    indexed = has_search_index()
+    statement, params, ranked, limit = build_search(query, limit, cursor, indexed)
+
+    # read in the same transaction as the search, so a write can't slip in between;
+    # with the catalog, cached pages are as current as the catalog is
+    current = catalog.current()
+    if current is not None:
+        generations = current.generations()
+    else:
+        generations = database.session.execute(cache_generations_query).all()
+    key = search_cache_key(query, limit, cursor, indexed, generations)
+
+    cached = search_cache.get(key)
+    if cached is not None:
+        if current is not None:
+            return current.cards(cached["ids"]), cached["next_cursor"]
+        return fetch_recipe_cards(cached["ids"]), cached["next_cursor"]
+
+    results = database.session.execute(statement, params).all()
+    results, next_cursor = search_page(results, limit, ranked)
+
+    search_cache.set(key, {"ids": [row.id for row in results], "next_cursor": next_cursor})
+    return results, next_cursor
+
+def search_cache_key(query, limit, cursor, indexed, generations):
+    """
+    Key search_cache by the search's filters in a normal form, its page, and the generation of every table it depends on.
+    Name and type are only case and whitespace insensitive with the full-text index (LIKE matches them as typed),
+    and ingredients can be listed in any order.
+    Results only depend on ratings when filtering by rating: cards always come with the current average.
+    """
+
+    normal = {}
+    for field, value in query.items():
+        if field in ["name", "type"]:
+            normal[field] = " ".join(value.lower().split()) if indexed else value
+        elif field == "ingredients":
+            normal[field] = sorted({ingredient_name(item) for item in value.split(",") if len(item.strip()) != 0})
+        elif field in ["id", "email"]:
+            normal[field] = value.strip()
+        else:
+            normal[field] = value
+
+    tables = ["recipes", "ingredients"]
+    if "min_rating" in query or "max_rating" in query:
+        tables.append("ratings")
+    versions = {name: generation for name, generation in generations if name in tables}
+
+    key = json.dumps([normal, limit, cursor, indexed, versions], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def build_search(query, limit, cursor, indexed):
+    """
+    Build advanced_search's query for one page of results. indexed says whether the full-text index can be used.
+    Returns the statement, its parameters, whether results are ranked by relevance, and the page size.
+    """
+
+    max_page_size = flask.current_app.config["SEARCH_MAX_PAGE_SIZE"]
+    if limit is None or limit > max_page_size:
+        limit = max_page_size
+    limit = max(limit, 1)
+
+    params = {"limit": limit + 1}   # one extra row tells us if there is another page
+    match_terms = []
+    join = ""
+
+    search_statement = """SELECT recipes.id, recipes.photo, recipes.name, recipes.user_email, recipes.type, recipes.date_posted, avg_ratings.avg{score} FROM 
+                            recipes 
+                            {join}
+                            LEFT OUTER JOIN rating_stats as avg_ratings
+                            ON recipes.id = avg_ratings.recipe_id
+                            WHERE """
+    if "name" in query:
+        if indexed:
+            match_terms.append(match_expression("name", query["name"]))
+        else:
+            search_statement += "name LIKE :name AND "
+            params["name"] = "%" + query["name"] + "%"
+    if "id" in query:
+        search_statement += "id = :id AND "
+        params["id"] = query["id"]
+    if "type" in query:
+        if indexed:
+            match_terms.append(match_expression("type", query["type"]))
+        else:
+            search_statement += "type LIKE :type AND "
+            params["type"] = "%" + query["type"] + "%"
+    if "email" in query:
+        search_statement += "user_email = :email AND "
+        params["email"] = query["email"]
+    if "min_rating" in query:
+        search_statement += "avg_ratings.avg >= :min_rating AND "
+        params["min_rating"] = query["min_rating"]
+    if "max_rating" in query:
+        search_statement += "avg_ratings.avg <= :max_rating AND "
+        params["max_rating"] = query["max_rating"]
+    if "ingredients" in query:
+        wanted = [item.strip() for item in query["ingredients"].split(",") if len(item.strip()) != 0]
+        for i in range(len(wanted)):
+            if indexed:
+                match_terms.append(match_expression("ingredients", wanted[i]))
+            else:
+                search_statement += f"id IN (SELECT recipe_id FROM ingredients WHERE ingredient_id IN (SELECT id FROM ingredient_names WHERE name LIKE :ingredient_{i})) AND "
+                params[f"ingredient_{i}"] = "%" + ingredient_name(wanted[i]) + "%"   # in the form names are stored in
+
+    # every text filter is folded into a single MATCH against the full-text index
+    match_terms = [term for term in match_terms if term is not None]
+    ranked = len(match_terms) != 0
+    if ranked:
+        join = """JOIN (SELECT rowid AS recipe_id, bm25(recipe_search, 10.0, 5.0, 1.0) AS score FROM recipe_search WHERE recipe_search MATCH :match) AS matches
+                  ON recipes.id = matches.recipe_id"""
+        params["match"] = " AND ".join(match_terms)
+
+    search_statement = search_statement.format(join=join, score=", matches.score" if ranked else "")
+
+    # keyset pagination: continue right after the last row of the previous page
+    if cursor is not None:
+        kind, value, last_id = decode_cursor(cursor)
+        if kind != ("score" if ranked else "date"):
+            raise ValueError("Cursor is for a different search.")
+        value_types = (int, float) if ranked else str
+        if not isinstance(value, value_types) or isinstance(value, bool) or not isinstance(last_id, int) or isinstance(last_id, bool):
+            raise ValueError("Invalid cursor.")
+        if ranked:
+            search_statement += "(matches.score > :cursor_value OR (matches.score = :cursor_value AND recipes.id > :cursor_id)) AND "
+        else:
+            search_statement += "(recipes.date_posted < :cursor_value OR (recipes.date_posted = :cursor_value AND recipes.id < :cursor_id)) AND "
+        params["cursor_value"] = value
+        params["cursor_id"] = last_id
+
+    # trim the AND or WHERE
+    if search_statement[-5:] == " AND ":
+        search_statement = search_statement[:-5]
+    if search_statement[-7:] == " WHERE ":
+        search_statement = search_statement[:-7]
+
+    if ranked:
+        search_statement += " ORDER BY matches.score, recipes.id"
+    else:
+        search_statement += " ORDER BY recipes.date_posted DESC, recipes.id DESC"
+    search_statement += " LIMIT :limit"
+
+    return sqlalchemy.text(search_statement), params, ranked, limit
+
+def search_page(results, limit, ranked):
+    """
+    Cut the extra row off a page of search results and make the cursor for the next page from its last row.
+    """
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        last = results[-1]
+        if ranked:
+            next_cursor = encode_cursor(["score", last.score, last.id])
+        else:
+            next_cursor = encode_cursor(["date", last.date_posted, last.id])
+
+    return results, next_cursor
+
+def encode_cursor(values):
+    """
+    Pack the sort key of the last result on a page into an opaque string for the URL.
+    """
+
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    """
+    Unpack a cursor made by encode_cursor. Raises ValueError if it has been tampered with.
+    """
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, json.JSONDecodeError):
+        raise ValueError("Invalid cursor.")
+
+    if not isinstance(values, list) or len(values) != 3:
+        raise ValueError("Invalid cursor.")
+
+    return values
+
+def match_expression(column, text):
+    """
+    Turn the text typed into a search box into an FTS5 query on one column of recipe_search.
+    Every word must appear, and words are prefix matched so "chick" still finds "Chicken".
+    Returns None if the text has no searchable words.
+    """
+
+    words = re.findall(r"\w+", text.lower())
+    if len(words) == 0:
+        return None
+
+    return column + " : (" + " AND ".join('"' + word + '"*' for word in words) + ")"
+
+def create_missing_indexes():
+    """
+    create_all() only creates indexes along with new tables,
+    so add any index declared on a model that an existing database doesn't have yet.
+    """
+
+    for table in database.metadata.sorted_tables:
+        if table.name == "ingredients" and not has_ingredient_names():
+            continue   # indexed when create_ingredient_names rebuilds it
+        for index in table.indexes:
+            index.create(database.engine, checkfirst=True)
+
+# Full-text index
+
+search_index_available = None   # unknown until first checked
+
+def has_search_index():
+    """
+    Whether the recipe_search full-text table exists. It won't if this build of SQLite has no FTS5.
+    Checked once per worker.
+    """
+
+    global search_index_available
+
+    if search_index_available is None:
+        search_index_available = database.session.execute(search_index_query).first() is not None
+
+    return search_index_available
+
+search_index_query = sqlalchemy.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'recipe_search'")
+
+def create_search_index():
+    """
+    Create the recipe_search FTS5 table (one row per recipe, rowid = recipe id) and fill it if it is empty.
+    If this build of SQLite doesn't have FTS5, advanced_search falls back to LIKE matching.
+    """
+
+    global search_index_available
+
+    try:
+        database.session.execute(sqlalchemy.text("""CREATE VIRTUAL TABLE IF NOT EXISTS recipe_search
+                                                    USING fts5(name, type, ingredients, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"""))
+    except sqlalchemy.exc.OperationalError:
+        database.session.rollback()
+        search_index_available = False
+        return
+
+    search_index_available = True
+
+    indexed = database.session.execute(sqlalchemy.text("SELECT rowid FROM recipe_search LIMIT 1")).first()
+    if indexed is None and has_ingredient_names():   # otherwise create_ingredient_names fills it
+        rebuild_search_index()
+
+    database.session.commit()
+
+def rebuild_search_index():
+    """
+    Re-index every recipe. Does not commit.
+    """
+
+    database.session.execute(sqlalchemy.text("DELETE FROM recipe_search"))
+    database.session.execute(sqlalchemy.text("""INSERT INTO recipe_search(rowid, name, type, ingredients)
+                                                SELECT recipes.id, recipes.name, recipes.type, group_concat(ingredient_names.name, ' , ') FROM
+                                                recipes
+                                                LEFT OUTER JOIN ingredients ON recipes.id = ingredients.recipe_id
+                                                LEFT OUTER JOIN ingredient_names ON ingredient_names.id = ingredients.ingredient_id
+                                                GROUP BY recipes.id"""))
+
+def index_recipe(recipe_id):
+    """
+    Bring the full-text index up to date with a recipe and its ingredients.
+    Call this before committing a change to a recipe so both are written in the same transaction.
+    """
+
+    if not has_search_index():
+        return
+
+    unindex_recipe(recipe_id)
+    database.session.execute(sqlalchemy.text("""INSERT INTO recipe_search(rowid, name, type, ingredients)
+                                                SELECT recipes.id, recipes.name, recipes.type,
+                                                    (SELECT group_concat(ingredient_names.name, ' , ') FROM ingredients
+                                                     JOIN ingredient_names ON ingredient_names.id = ingredients.ingredient_id WHERE ingredients.recipe_id = recipes.id)
+                                                FROM recipes WHERE recipes.id = :id"""), {"id": recipe_id})
+
+def unindex_recipe(recipe_id):
+    """
+    Remove a recipe from the full-text index. Does not commit.
+    """
+
+    if not has_search_index():
+        return
+
+    database.session.execute(sqlalchemy.text("DELETE FROM recipe_search WHERE rowid = :id"), {"id": recipe_id})
+
+@pages.cli.command("rebuild-search-index")
+def rebuild_search_index_command():
+    """
+    Rebuild the full-text search index from the recipes and ingredients tables.
+    """
+
+    create_search_index()
+    if not has_search_index():
+        print("This SQLite build does not support FTS5; search will use LIKE matching.")
+        return
+
+    rebuild_search_index()
+    database.session.commit()
+    print("Search index rebuilt.")
+
+# Rating aggregates
+
+# an upsert on ratings (see RatingWriter) overrides the conflict handling of the statements in these triggers,
+# so they check for an existing rating_stats row rather than relying on INSERT OR IGNORE
+rating_triggers = {
+    # a new rating adds to its recipe's totals
+    "ratings_after_insert": """CREATE TRIGGER IF NOT EXISTS ratings_after_insert AFTER INSERT ON ratings
+                               BEGIN
+                                   INSERT INTO rating_stats(recipe_id, rating_count, rating_sum, avg)
+                                       SELECT NEW.recipe_id, 0, 0, NULL WHERE NOT EXISTS (SELECT 1 FROM rating_stats WHERE recipe_id = NEW.recipe_id);
+                                   UPDATE rating_stats SET rating_count = rating_count + 1, rating_sum = rating_sum + NEW.stars,
+                                       avg = CAST(rating_sum + NEW.stars AS REAL) / (rating_count + 1)
+                                   WHERE recipe_id = NEW.recipe_id;
+                               END""",
+
+    # a changed rating is removed from the old recipe's totals and added to the new one's
+    "ratings_after_update": """CREATE TRIGGER IF NOT EXISTS ratings_after_update AFTER UPDATE OF recipe_id, stars ON ratings
+                               BEGIN
+                                   UPDATE rating_stats SET rating_count = rating_count - 1, rating_sum = rating_sum - OLD.stars,
+                                       avg = CASE WHEN rating_count = 1 THEN NULL ELSE CAST(rating_sum - OLD.stars AS REAL) / (rating_count - 1) END
+                                   WHERE recipe_id = OLD.recipe_id;
+                                   INSERT INTO rating_stats(recipe_id, rating_count, rating_sum, avg)
+                                       SELECT NEW.recipe_id, 0, 0, NULL WHERE NOT EXISTS (SELECT 1 FROM rating_stats WHERE recipe_id = NEW.recipe_id);
+                                   UPDATE rating_stats SET rating_count = rating_count + 1, rating_sum = rating_sum + NEW.stars,
+                                       avg = CAST(rating_sum + NEW.stars AS REAL) / (rating_count + 1)
+                                   WHERE recipe_id = NEW.recipe_id;
+                                   DELETE FROM rating_stats WHERE recipe_id = OLD.recipe_id AND rating_count = 0;
+                               END""",
+
+    # a deleted rating is taken out of its recipe's totals
+    "ratings_after_delete": """CREATE TRIGGER IF NOT EXISTS ratings_after_delete AFTER DELETE ON ratings
+                               BEGIN
+                                   UPDATE rating_stats SET rating_count = rating_count - 1, rating_sum = rating_sum - OLD.stars,
+                                       avg = CASE WHEN rating_count = 1 THEN NULL ELSE CAST(rating_sum - OLD.stars AS REAL) / (rating_count - 1) END
+                                   WHERE recipe_id = OLD.recipe_id;
+                                   DELETE FROM rating_stats WHERE recipe_id = OLD.recipe_id AND rating_count = 0;
+                               END""",
+}
+
+def create_rating_triggers():
+    """
+    Create the triggers that keep rating_stats in sync with the ratings table.
+    If they didn't exist yet, the aggregates are rebuilt so ratings added before the triggers are counted.
+    """
+
+    statement = sqlalchemy.text("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name IN :names").bindparams(sqlalchemy.bindparam("names", expanding=True))
+    existing = database.session.execute(statement, {"names": list(rating_triggers)}).scalars().all()
+
+    for trigger in rating_triggers.values():
+        database.session.execute(sqlalchemy.text(trigger))
+
+    if len(existing) != len(rating_triggers):
+        rebuild_rating_stats()
+
+    database.session.commit()
+
+def rating_stats_drift():
+    """
+    Compare rating_stats to aggregates computed from scratch over the ratings table.
+    Returns a list of (recipe_id, stored (count, sum), actual (count, sum)) for every recipe that differs.
+    """
+
+    actual_statement = sqlalchemy.text("SELECT recipe_id, COUNT(*), SUM(stars) FROM ratings GROUP BY recipe_id")
+    actual = {row[0]: (row[1], row[2]) for row in database.session.execute(actual_statement)}
+
+    stored_statement = sqlalchemy.text("SELECT recipe_id, rating_count, rating_sum FROM rating_stats")
+    stored = {row[0]: (row[1], row[2]) for row in database.session.execute(stored_statement)}
+
+    drift = []
+    for recipe_id in sorted(set(actual) | set(stored)):
+        if actual.get(recipe_id) != stored.get(recipe_id):
+            drift.append((recipe_id, stored.get(recipe_id), actual.get(recipe_id)))
+
+    return drift
+
+def rebuild_rating_stats():
+    """
+    Recompute every recipe's rating aggregates from the ratings table in bulk. Does not commit.
+    """
+
+    database.session.execute(sqlalchemy.text("DELETE FROM rating_stats"))
+    database.session.execute(sqlalchemy.text("""INSERT INTO rating_stats(recipe_id, rating_count, rating_sum, avg)
+                                                SELECT recipe_id, COUNT(*), SUM(stars), AVG(stars) FROM ratings GROUP BY recipe_id"""))
+
+@pages.cli.command("rebuild-ratings")
+@click.option("--verify-only", is_flag=True, help="Only report drift, don't rebuild.")
+def rebuild_ratings_command(verify_only):
+    """
+    Check the stored rating aggregates against the ratings table and rebuild them.
+    """
+
+    drift = rating_stats_drift()
+    for recipe_id, stored, actual in drift:
+        print(f"Recipe {recipe_id}: stored (count, sum) {stored}, actual {actual}")
+    print(f"{len(drift)} recipe(s) with drifted rating aggregates.")
+
+    if verify_only:
+        return
+
+    rebuild_rating_stats()
+    database.session.commit()
+    print("Rating aggregates rebuilt.")
+
+# Cache generations
+
+# a counter per table, bumped by a trigger whenever one of its rows changes (in any worker),
+# so cached search results can tell they are out of date
+cache_generation_tables = ["recipes", "ingredients", "ratings"]
+
+cache_generations_query = sqlalchemy.text("SELECT name, generation FROM cache_generations")
+
+def create_cache_generations():
+    CacheGeneration.__table__.create(database.engine, checkfirst=True)
+
+    for table in cache_generation_tables:
+        database.session.execute(sqlalchemy.text("INSERT OR IGNORE INTO cache_generations(name, generation) VALUES (:name, 0)"), {"name": table})
+        create_generation_triggers(table)
+
+def create_generation_triggers(table):
+    for event in ["INSERT", "UPDATE", "DELETE"]:
+        database.session.execute(sqlalchemy.text(f"""CREATE TRIGGER IF NOT EXISTS {table}_generation_after_{event.lower()} AFTER {event} ON {table}
+                                                     BEGIN
+                                                         UPDATE cache_generations SET generation = generation + 1 WHERE name = '{table}';
+                                                     END"""))
+
+# Catalog
+
+class CatalogRecipe:
+    """
+    A recipe as kept in the catalog, with everything the home, search and recipe pages show.
+    """
+
+    __slots__ = ["id", "user_email", "name", "type", "photo", "date_posted", "method", "ingredients", "avg", "rating_count"]
+
+    def __init__(self, row, ingredients, avg, rating_count):
+        self.id = row.id
+        self.user_email = sys.intern(row.user_email)
+        self.name = row.name
+        self.type = sys.intern(row.type)
+        self.photo = row.photo
+        self.date_posted = datetime.datetime.fromisoformat(row.date_posted)   # as the Recipe model would give it
+        self.method = row.method
+        self.ingredients = ingredients   # flat (name, quantity, name, quantity, ...), a third the size of a tuple of pairs
+        self.avg = avg
+        self.rating_count = rating_count
+
+    def ingredient_list(self):
+        pairs = iter(self.ingredients)
+        return [CatalogIngredient(name, *quantity) for name, quantity in zip(pairs, pairs)]
+
+CatalogIngredient = collections.namedtuple("CatalogIngredient", ["name", "quantity", "amount", "unit", "note"])
+
+class Catalog:
+    """
+    Every recipe, with its ingredients and rating totals, held in memory by each worker so the read-only pages
+    don't have to query the database for them. Turned on with CATALOG_ENABLED.
+    Similar recipes are not kept: a recipe page still reads its list from similar_recipes.
+
+    It is loaded in the background when first used (pages fall back to the database until then).
+    Triggers record the id of every recipe whose row, ingredients or rating totals change in the change_log table,
+    and the catalog reloads just those recipes: right away after a write from this worker,
+    and every CATALOG_REFRESH_SECONDS to pick up other workers' writes.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.enabled = app.config["CATALOG_ENABLED"]
+        self.refresh_seconds = app.config["CATALOG_REFRESH_SECONDS"]
+        self.keep_seconds = app.config["CHANGE_LOG_KEEP_SECONDS"]
+
+        self.recipes = {}   # recipe id -> CatalogRecipe
+        self.ids = []       # dense list of the ids, for sampling
+        self.positions = {}
+        self.version = 0    # last change_log seq applied
+        self.ready = False
+
+        self.loader = None
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.checked_at = 0
+        self.pruned_at = 0
+
+    def current(self):
+        """
+        Return the catalog, brought up to date if it is due, or None if it is disabled or still loading.
+        """
+
+        if not self.enabled:
+            return None
+
+        if not self.ready:
+            self.start_loading()
+            return None
+
+        if self.refresh_due():
+            self.refresh()
+        return self
+
+    def changed(self):
+        """
+        Called after this worker writes a recipe or rating, so the next read picks the change up.
+        """
+
+        self.dirty = True
+
+    def refresh_due(self):
+        if not self.ready or (self.loader is not None and self.loader.is_alive()):
+            return False
+        return self.dirty or time.monotonic() - self.checked_at > self.refresh_seconds
+
+    def start_loading(self):
+        with self.lock:
+            if self.loader is None or not self.loader.is_alive():
+                self.loader = threading.Thread(target=self.load, name="catalog-loader", daemon=True)
+                self.loader.start()
+
+    def load(self):
+        started = time.monotonic()
+        with self.app.app_context():
+            with database.engine.connect() as connection:
+                version = connection.execute(sqlalchemy.text("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'change_log'), 0)")).scalar()
+                recipes = self.fetch(connection, None)
+
+        with self.lock:
+            self.recipes = recipes
+            self.ids = list(recipes)
+            self.positions = {recipe_id: i for i, recipe_id in enumerate(self.ids)}
+            self.version = version
+            self.checked_at = time.monotonic()
+            self.ready = True
+
+        self.app.logger.info("Catalog loaded %d recipes in %.1fs", len(recipes), time.monotonic() - started)
+
+    def refresh(self):
+        with self.lock:
+            if not self.refresh_due():
+                return   # another thread just did
+            self.dirty = False
+            self.checked_at = time.monotonic()
+            reload = self.apply_changes()
+
+        # the current contents keep being served while everything is reloaded
+        if reload:
+            self.start_loading()
+
+        if time.time() - self.pruned_at > 3600:
+            self.prune()
+
+    def apply_changes(self):
+        """
+        Reload the recipes changed since the last refresh. Returns True if everything should be reloaded instead:
+        when changes not yet seen have been pruned, or after a bulk change such as an import.
+        """
+
+        with self.app.app_context():
+            with database.engine.connect() as connection:
+                oldest = connection.execute(sqlalchemy.text("SELECT MIN(seq) FROM change_log")).scalar()
+                changes = connection.execute(sqlalchemy.text("SELECT seq, recipe_id FROM change_log WHERE seq > :version"), {"version": self.version}).all()
+                if len(changes) == 0:
+                    return False
+
+                changed_ids = {change.recipe_id for change in changes}
+                if oldest > self.version + 1 or len(changed_ids) > max(1000, len(self.recipes) // 10):
+                    return True
+
+                fetched = self.fetch(connection, changed_ids)
+
+        for recipe_id in changed_ids:
+            if recipe_id in fetched:
+                self.put(fetched[recipe_id])
+            else:
+                self.remove(recipe_id)
+        self.version = max(change.seq for change in changes)
+        return False
+
+    def fetch(self, connection, ids):
+        """
+        Read the given recipes (or all of them, for None) into CatalogRecipes.
+        """
+
+        where = ""
+        params = {}
+        if ids is not None:
+            where = "WHERE {column} IN :ids"
+            params["ids"] = list(ids)
+
+        def query(statement, column):
+            statement = sqlalchemy.text(statement.format(where=where.format(column=column)))
+            if ids is not None:
+                statement = statement.bindparams(sqlalchemy.bindparam("ids", expanding=True))
+            return connection.execute(statement, params)
+
+        # ingredient names and quantities repeat a lot, so each distinct name, and each distinct quantity
+        # with its parsed (quantity, amount, unit, note), is only kept once
+        strings = {}
+        ingredients = collections.defaultdict(list)
+        for row in query("""SELECT recipe_id, COALESCE(ingredients.name, ingredient_names.name) AS name, quantity, amount, unit, note FROM ingredients
+                            JOIN ingredient_names ON ingredient_names.id = ingredients.ingredient_id {where} ORDER BY recipe_id, "order\"""", "recipe_id"):
+            name = strings.setdefault(row.name, row.name)
+            quantity = (row.quantity, row.amount, row.unit, row.note)
+            ingredients[row.recipe_id] += (name, strings.setdefault(quantity, quantity))
+
+        ratings = {row.recipe_id: (row.avg, row.rating_count) for row in query("SELECT recipe_id, avg, rating_count FROM rating_stats {where}", "recipe_id")}
+
+        recipes = {}
+        for row in query("SELECT id, user_email, name, type, photo, date_posted, method FROM recipes {where}", "id"):
+            avg, rating_count = ratings.get(row.id, (None, 0))
+            recipes[row.id] = CatalogRecipe(row, tuple(ingredients.get(row.id, ())), avg, rating_count)
+        return recipes
+
+    def put(self, recipe):
+        if recipe.id not in self.recipes:
+            self.positions[recipe.id] = len(self.ids)
+            self.ids.append(recipe.id)
+        self.recipes[recipe.id] = recipe
+
+    def remove(self, recipe_id):
+        if self.recipes.pop(recipe_id, None) is None:
+            return
+
+        # move the last id into the hole so the list stays dense
+        index = self.positions.pop(recipe_id)
+        last = self.ids.pop()
+        if index < len(self.ids):
+            self.ids[index] = last
+            self.positions[last] = index
+
+    def prune(self):
+        """
+        Delete change_log rows older than CHANGE_LOG_KEEP_SECONDS. A worker that falls further behind reloads everything.
+        """
+
+        self.pruned_at = time.time()
+        with self.app.app_context():
+            with database.engine.begin() as connection:
+                connection.execute(sqlalchemy.text("DELETE FROM change_log WHERE changed_at < :cutoff"), {"cutoff": int(time.time()) - self.keep_seconds})
+
+    def sample(self, count):
+        with self.lock:
+            ids = random.sample(self.ids, min(count, len(self.ids)))
+        return self.cards(ids)
+
+    def cards(self, ids):
+        recipes = self.recipes
+        return [recipes[recipe_id] for recipe_id in ids if recipe_id in recipes]
+
+    def payload(self, recipe_id):
+        recipe = self.recipes[recipe_id]
+        return recipe_payload(recipe, recipe.ingredient_list(), recipe.avg, recipe.rating_count)
+
+    def generations(self):
+        """
+        Stand-in for the cache_generations rows when keying search_cache: everything changes with the catalog's version.
+        """
+
+        return [(table, self.version) for table in cache_generation_tables]
+
+catalog = None   # set up by create_app
+
+# the tables whose changes are logged, with their recipe id column
+change_log_tables = [("recipes", "id"), ("ingredients", "recipe_id"), ("rating_stats", "recipe_id")]
+
+def create_change_log():
+    Change.__table__.create(database.engine, checkfirst=True)
+
+    for table, column in change_log_tables:
+        create_change_log_triggers(table, column)
+
+def create_change_log_recipe_index():
+    for index in Change.__table__.indexes:
+        index.create(database.session.connection(), checkfirst=True)
+
+def create_change_log_triggers(table, column):
+    database.session.execute(sqlalchemy.text(f"""CREATE TRIGGER IF NOT EXISTS {table}_log_after_insert AFTER INSERT ON {table}
+                                                 BEGIN
+                                                     INSERT INTO change_log(recipe_id) VALUES (NEW.{column});
+                                                 END"""))
+    database.session.execute(sqlalchemy.text(f"""CREATE TRIGGER IF NOT EXISTS {table}_log_after_update AFTER UPDATE ON {table}
+                                                 BEGIN
+                                                     INSERT INTO change_log(recipe_id) VALUES (NEW.{column});
+                                                     INSERT INTO change_log(recipe_id) SELECT OLD.{column} WHERE OLD.{column} != NEW.{column};
+                                                 END"""))
+    database.session.execute(sqlalchemy.text(f"""CREATE TRIGGER IF NOT EXISTS {table}_log_after_delete AFTER DELETE ON {table}
+                                                 BEGIN
+                                                     INSERT INTO change_log(recipe_id) VALUES (OLD.{column});
+                                                 END"""))
+
+# Rating writes
+
+class RatingWriter:
+    """
+    Writes ratings from a single background thread. Ratings submitted close together are gathered
+    into one transaction, so a burst of ratings for a popular recipe takes SQLite's write lock once
+    instead of once per request. Each rating is an upsert (INSERT ... ON CONFLICT DO UPDATE), so a user
+    rating a recipe again replaces their rating, and the rating_stats triggers update the averages
+    inside the same transaction.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config["RATING_BATCH_SIZE"]
+        self.batch_seconds = app.config["RATING_BATCH_SECONDS"]
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+
+    def submit(self, recipe_id, user_email, stars, description):
+        """
+        Queue a rating to be written. Returns a future that is done once it has been committed.
+        """
+
+        # started on first use rather than in create_app, so each forked worker gets its own thread
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="rating-writer", daemon=True)
+                self.thread.start()
+
+        future = concurrent.futures.Future()
+        self.queue.put((future, {"recipe_id": recipe_id, "user_email": user_email, "stars": stars, "description": description}))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+
+            # give ratings arriving right behind the first one a moment to join its transaction
+            deadline = time.monotonic() + self.batch_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            self.write(batch)
+
+    def write(self, batch):
+        # a user's later rating in the same batch replaces their earlier one
+        rows = {}
+        for future, row in batch:
+            rows[(row["recipe_id"], row["user_email"])] = row
+
+        statement = sqlalchemy.dialects.sqlite.insert(Rating)
+        statement = statement.on_conflict_do_update(index_elements=[Rating.recipe_id, Rating.user_email],
+                                                    set_={"stars": statement.excluded.stars, "description": statement.excluded.description})
+
+        try:
+            with self.app.app_context():
+                with database.engine.begin() as connection:
+                    # a recipe or user deleted since its rating was submitted would fail the whole batch on the foreign key
+                    recipes = set(connection.execute(recipes_found_statement, {"ids": list({row["recipe_id"] for row in rows.values()})}).scalars())
+                    users = set(connection.execute(users_found_statement, {"emails": list({row["user_email"] for row in rows.values()})}).scalars())
+                    errors = {key: LookupError("Recipe not found." if row["recipe_id"] not in recipes else "User not found.")
+                              for key, row in rows.items() if row["recipe_id"] not in recipes or row["user_email"] not in users}
+                    rows = {key: row for key, row in rows.items() if key not in errors}
+                    if len(rows) != 0:
+                        connection.execute(statement, list(rows.values()))
+        except Exception as error:
+            self.failed += len(batch)
+            self.app.logger.exception("Couldn't write %d ratings", len(batch))
+            for future, row in batch:
+                future.set_exception(error)
+            return
+
+        written = sum(1 for future, row in batch if (row["recipe_id"], row["user_email"]) not in errors)
+        self.batches += 1
+        self.written += written
+        self.failed += len(batch) - written
+        for recipe_id in {row["recipe_id"] for row in rows.values()}:
+            recipe_cache.delete(recipe_id)
+        catalog.changed()
+        for future, row in batch:
+            error = errors.get((row["recipe_id"], row["user_email"]))
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "batches": self.batches, "written": self.written, "failed": self.failed,
+                "average_batch": self.written / self.batches if self.batches != 0 else 0}
+
+recipes_found_statement = sqlalchemy.text("SELECT id FROM recipes WHERE id IN :ids").bindparams(sqlalchemy.bindparam("ids", expanding=True))
+
+users_found_statement = sqlalchemy.text("SELECT email FROM users WHERE email IN :emails").bindparams(sqlalchemy.bindparam("emails", expanding=True))
+
+rating_writer = None   # set up by create_app
+
+# Similar recipes
+
+# each recipe's ingredient names are normalized into terms and kept in recipe_terms (a sparse recipe x ingredient matrix);
+# the SIMILAR_RECIPES recipes with the highest Jaccard similarity (shared terms / all terms of the two) go in similar_recipes
+
+def ingredient_term(name):
+    """
+    Normalize an ingredient name so spellings of the same ingredient match ("Tomatoes," -> "tomato").
+    """
+
+    words = []
+    for word in re.findall(r"[a-z0-9]+", name.lower()):
+        if len(word) > 3 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("oes"):
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+            word = word[:-1]
+        words.append(word)
+
+    return " ".join(words)
+
+def recipe_terms(names):
+    return frozenset(term for term in map(ingredient_term, names) if len(term) != 0)
+
+def scanned_terms(terms, frequencies, scan_limit):
+    """
+    The terms of a recipe that candidates are looked for by: rarest first, until the recipes having them add up to scan_limit.
+    Rare ingredients say the most about a recipe, and looking up common ones (salt, water...) would mean scoring most recipes,
+    though they still count toward the scores. frequencies maps each term to the number of recipes that have it.
+    """
+
+    scanned = []
+    total = 0
+    for term in sorted(terms, key=lambda term: (frequencies[term], term)):
+        if len(scanned) != 0 and total + frequencies[term] > scan_limit:
+            break
+        scanned.append(term)
+        total += frequencies[term]
+
+    return scanned
+
+def candidate_recipes(recipe_id, terms, postings, limit):
+    """
+    The ids of at most limit recipes sharing the most of the given terms with a recipe.
+    postings maps each term to the ids of the recipes that have it, in id order,
+    so ties are always broken the same way (by where the candidate was first seen).
+    """
+
+    shared = collections.Counter()
+    for term in terms:
+        shared.update(postings[term])
+    shared.pop(recipe_id, None)
+
+    return [other for other, count in shared.most_common(limit)]
+
+def rank_similar(terms, candidates, vectors):
+    """
+    Score each candidate against terms, as (score, id) pairs, best first. vectors maps each candidate to its terms.
+    """
+
+    return rank_overlaps(len(terms), [(other, len(terms & vectors[other]), len(vectors[other])) for other in candidates])
+
+def rank_overlaps(size, overlaps):
+    """
+    Turn (id, terms shared, terms) of each candidate for a recipe with size terms into (score, id) pairs, best first.
+    """
+
+    scores = sorted((-shared / (size + other_size - shared), other) for other, shared, other_size in overlaps)
+    return [(-score, other) for score, other in scores]
+
+def build_similar_recipes(workers):
+    """
+    Refill recipe_terms from the ingredients table and recompute the similar recipes of every recipe,
+    spread over workers processes. Does not commit.
+    """
+
+    config = flask.current_app.config
+
+    database.session.execute(database.delete(RecipeTerm))
+    strings = {}
+    vectors = collections.defaultdict(set)
+    for row in database.session.execute(database.select(Ingredient.recipe_id, IngredientName.name).join(IngredientName, IngredientName.id == Ingredient.ingredient_id)):
+        term = ingredient_term(row.name)
+        if len(term) != 0:
+            vectors[row.recipe_id].add(strings.setdefault(term, term))
+    vectors = {recipe_id: frozenset(terms) for recipe_id, terms in vectors.items()}
+
+    rows = [{"term": term, "recipe_id": recipe_id} for recipe_id, terms in vectors.items() for term in terms]
+    if len(rows) != 0:
+        database.session.execute(database.insert(RecipeTerm), rows)
+
+    database.session.execute(database.delete(SimilarRecipe))
+    ids = sorted(vectors)
+    chunks = [ids[i:i + 500] for i in range(0, len(ids), 500)]
+    settings = (vectors, config["SIMILAR_RECIPES"], config["SIMILAR_CANDIDATES"], config["SIMILAR_SCAN_LIMIT"])
+
+    def store(rows):
+        if len(rows) != 0:
+            database.session.execute(database.insert(SimilarRecipe), rows)
+
+    if workers > 1 and len(chunks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=start_similar_worker, initargs=settings) as pool:
+            for rows in pool.map(similar_chunk, chunks):
+                store(rows)
+    else:
+        start_similar_worker(*settings)
+        for chunk in chunks:
+            store(similar_chunk(chunk))
+
+    return len(ids)
+
+similar_worker = None   # what similar_chunk works from, in each build_similar_recipes process
+
+def start_similar_worker(vectors, count, candidates, scan_limit):
+    global similar_worker
+
+    postings = collections.defaultdict(list)
+    for recipe_id, terms in vectors.items():
+        for term in terms:
+            postings[term].append(recipe_id)
+
+    frequencies = {term: len(ids) for term, ids in postings.items()}
+    similar_worker = {"vectors": vectors, "postings": postings, "frequencies": frequencies, "count": count, "candidates": candidates, "scan_limit": scan_limit}
+
+def similar_chunk(ids):
+    """
+    The similar_recipes rows of the recipes with the given ids.
+    """
+
+    worker = similar_worker
+    vectors = worker["vectors"]
+
+    rows = []
+    for recipe_id in ids:
+        terms = vectors[recipe_id]
+        scanned = scanned_terms(terms, worker["frequencies"], worker["scan_limit"])
+        candidates = candidate_recipes(recipe_id, scanned, worker["postings"], worker["candidates"])
+        for score, other in rank_similar(terms, candidates, vectors)[:worker["count"]]:
+            rows.append({"recipe_id": recipe_id, "similar_id": other, "score": score})
+
+    return rows
+
+def update_similar_recipes(recipe_id, names):
+    """
+    Store a recipe's terms, recompute its similar recipes, and add it to the lists of the recipes it now beats
+    an entry of. Lists it drops out of are refilled by the next build-similar-recipes.
+    Call this before committing a change to a recipe so both are written in the same transaction.
+    """
+
+    config = flask.current_app.config
+    count = config["SIMILAR_RECIPES"]
+
+    forget_similar_recipes(recipe_id)
+    terms = recipe_terms(names)
+    if len(terms) == 0:
+        return
+    database.session.execute(database.insert(RecipeTerm), [{"term": term, "recipe_id": recipe_id} for term in terms])
+
+    # plain SQL with tuple rows, as the postings can run to SIMILAR_SCAN_LIMIT rows
+    frequencies = dict(database.session.execute(term_frequencies_statement, {"terms": list(terms)}).all())
+    scanned = scanned_terms(terms, frequencies, config["SIMILAR_SCAN_LIMIT"])
+
+    postings = collections.defaultdict(list)
+    for term, other in database.session.execute(postings_statement, {"terms": scanned}):
+        postings[term].append(other)
+
+    candidates = candidate_recipes(recipe_id, scanned, postings, config["SIMILAR_CANDIDATES"])
+    if len(candidates) == 0:
+        return
+
+    overlaps = database.session.execute(overlaps_statement, {"id": recipe_id, "ids": candidates}).all()
+    scores = rank_overlaps(len(terms), overlaps)
+
+    rows = [{"recipe_id": recipe_id, "similar_id": other, "score": score} for score, other in scores[:count]]
+    database.session.execute(database.insert(SimilarRecipe), rows)
+
+    # the other recipes' lists, each trimmed back to count entries (ties go to the lower id, as in build_similar_recipes)
+    lists = {other: (entries, lowest) for other, entries, lowest in database.session.execute(list_sizes_statement, {"ids": candidates})}
+    rows = [{"recipe_id": other, "similar_id": recipe_id, "score": score} for score, other in scores
+            if score > 0 and (other not in lists or lists[other][0] < count or score >= lists[other][1])]
+    if len(rows) == 0:
+        return
+
+    database.session.execute(database.insert(SimilarRecipe), rows)
+    database.session.execute(sqlalchemy.text("""DELETE FROM similar_recipes WHERE rowid IN
+                                                    (SELECT rowid FROM
+                                                        (SELECT rowid, ROW_NUMBER() OVER (PARTITION BY recipe_id ORDER BY score DESC, similar_id) AS position
+                                                         FROM similar_recipes WHERE recipe_id IN :ids)
+                                                     WHERE position > :count)""").bindparams(sqlalchemy.bindparam("ids", expanding=True)),
+                             {"ids": [row["recipe_id"] for row in rows], "count": count})
+
+term_frequencies_statement = sqlalchemy.text("SELECT term, COUNT(*) FROM recipe_terms WHERE term IN :terms GROUP BY term").bindparams(
+    sqlalchemy.bindparam("terms", expanding=True))
+
+postings_statement = sqlalchemy.text("SELECT term, recipe_id FROM recipe_terms WHERE term IN :terms ORDER BY term, recipe_id").bindparams(
+    sqlalchemy.bindparam("terms", expanding=True))
+
+# for each candidate, the terms it shares with the recipe and the terms it has
+overlaps_statement = sqlalchemy.text("""SELECT recipe_id, SUM(term IN (SELECT term FROM recipe_terms WHERE recipe_id = :id)), COUNT(*) FROM
+                                        recipe_terms
+                                        WHERE recipe_id IN :ids
+                                        GROUP BY recipe_id""").bindparams(sqlalchemy.bindparam("ids", expanding=True))
+
+list_sizes_statement = sqlalchemy.text("SELECT recipe_id, COUNT(*), MIN(score) FROM similar_recipes WHERE recipe_id IN :ids GROUP BY recipe_id").bindparams(
+    sqlalchemy.bindparam("ids", expanding=True))
+
+def forget_similar_recipes(recipe_id):
+    """
+    Remove a recipe's terms and take it out of every similar recipes list. Does not commit.
+    """
+
+    database.session.execute(database.delete(RecipeTerm).where(RecipeTerm.recipe_id == recipe_id))
+    database.session.execute(database.delete(SimilarRecipe).where(sqlalchemy.or_(SimilarRecipe.recipe_id == recipe_id, SimilarRecipe.similar_id == recipe_id)))
+
+def fetch_similar_recipes(recipe_id):
+    return database.session.execute(similar_recipes_statement, {"id": recipe_id}).all()
+
+similar_recipes_statement = sqlalchemy.text("""SELECT recipes.id, recipes.name, recipes.photo, recipes.type FROM
+                                               similar_recipes
+                                               JOIN recipes ON recipes.id = similar_recipes.similar_id
+                                               WHERE similar_recipes.recipe_id = :id
+                                               ORDER BY similar_recipes.score DESC, similar_recipes.similar_id""")
+
+def create_similar_recipes():
+    RecipeTerm.__table__.create(database.engine, checkfirst=True)
+    SimilarRecipe.__table__.create(database.engine, checkfirst=True)
+    if has_ingredient_names():   # otherwise create_ingredient_names builds them
+        build_similar_recipes(flask.current_app.config["SIMILAR_WORKERS"])
+
+@pages.cli.command("build-similar-recipes")
+@click.option("--workers", type=int, help="Processes to spread the work over (default: SIMILAR_WORKERS).")
+def build_similar_recipes_command(workers):
+    """
+    Recompute every recipe's similar recipes from the ingredients table.
+    """
+
+    started = time.monotonic()
+    total = build_similar_recipes(workers or flask.current_app.config["SIMILAR_WORKERS"])
+    database.session.commit()
+    print(f"Similar recipes built for {total} recipes in {time.monotonic() - started:.1f}s.")
+
+# Pantry search
+
+class PantryIndex:
+    """
+    Bitmaps for matching a pantry against every recipe. Each recipe has a slot (in id order), and each
+    ingredient term (see ingredient_term) a bitmap of the slots of the recipes that use it: a Python int for
+    common terms, or a sorted array of slots for rare ones, which is turned into an int when a pantry needs it.
+    A search combines the bitmaps of just the pantry's terms into "has at least k of them" masks,
+    a whole-int operation over all recipes at once rather than a loop over them or SQL joins.
+
+    Loaded by the first pantry search in each worker and kept current from the change_log table, like the Catalog.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.refresh_seconds = app.config["PANTRY_REFRESH_SECONDS"]
+
+        self.columns = {}   # term -> bitmap of slots (int) or sorted slots (array)
+        self.sizes = collections.defaultdict(int)   # number of terms -> bitmap of the slots of recipes with that many
+        self.ids = []       # slot -> recipe id, ascending
+        self.slots = {}     # recipe id -> slot
+        self.rows = []      # slot -> the recipe's terms (empty once deleted)
+        self.version = 0    # last change_log seq applied
+        self.loaded = False
+
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.checked_at = 0
+
+    def changed(self):
+        """
+        Called after this worker writes a recipe, so the next search picks the change up.
+        """
+
+        self.dirty = True
+
+    def refresh_due(self):
+        return not self.loaded or self.dirty or time.monotonic() - self.checked_at > self.refresh_seconds
+
+    def refresh(self):
+        """
+        Load the index if it hasn't been yet, or apply the changes logged since it was last brought up to date.
+        """
+
+        with self.lock:
+            if not self.refresh_due():
+                return   # another thread just did
+            self.dirty = False
+            self.checked_at = time.monotonic()
+
+            with self.app.app_context():
+                with database.engine.connect() as connection:
+                    if self.loaded and self.apply_changes(connection):
+                        return
+                    self.load(connection)
+
+    def apply_changes(self, connection):
+        """
+        Update the recipes changed since the last refresh. Returns False if everything should be reloaded instead:
+        when changes not yet seen have been pruned, after a bulk change, or when a recipe's id is lower than the last slot's.
+        """
+
+        oldest = connection.execute(sqlalchemy.text("SELECT MIN(seq) FROM change_log")).scalar()
+        changes = connection.execute(sqlalchemy.text("SELECT seq, recipe_id FROM change_log WHERE seq > :version"), {"version": self.version}).all()
+        if len(changes) == 0:
+            return True
+
+        changed_ids = {change.recipe_id for change in changes}
+        if oldest > self.version + 1 or len(changed_ids) > max(1000, len(self.slots) // 10):
+            return False
+
+        terms = self.fetch(connection, changed_ids)
+        for recipe_id in sorted(changed_ids):
+            if not self.put(recipe_id, terms.get(recipe_id, ())):
+                return False
+
+        self.version = max(change.seq for change in changes)
+        return True
+
+    def load(self, connection):
+        started = time.monotonic()
+        version = connection.execute(sqlalchemy.text("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'change_log'), 0)")).scalar()
+        terms = self.fetch(connection, None)
+
+        self.ids = sorted(terms)
+        self.slots = {recipe_id: slot for slot, recipe_id in enumerate(self.ids)}
+
+        postings = collections.defaultdict(list)
+        sizes = collections.defaultdict(list)
+        for slot, recipe_id in enumerate(self.ids):
+            for term in terms[recipe_id]:
+                postings[term].append(slot)
+            sizes[len(terms[recipe_id])].append(slot)
+
+        self.rows = [tuple(terms[recipe_id]) for recipe_id in self.ids]
+
+        # an int bitmap costs a bit per recipe, an array 32 bits per recipe that has the term
+        self.columns = {}
+        for term, slots in postings.items():
+            if len(slots) * 32 > len(self.ids):
+                self.columns[term] = bitmap(slots, len(self.ids))
+            else:
+                self.columns[term] = array.array("I", slots)
+        self.sizes = collections.defaultdict(int, {size: bitmap(slots, len(self.ids)) for size, slots in sizes.items()})
+
+        self.version = version
+        self.loaded = True
+        self.app.logger.info("Pantry index loaded %d recipes and %d ingredients in %.1fs", len(self.ids), len(self.columns), time.monotonic() - started)
+
+    def fetch(self, connection, ids):
+        """
+        Read the terms of the given recipes (or all of them, for None).
+        """
+
+        if ids is None:
+            rows = connection.execute(sqlalchemy.text("SELECT recipe_id, term FROM recipe_terms"))
+        else:
+            rows = connection.execute(sqlalchemy.text("SELECT recipe_id, term FROM recipe_terms WHERE recipe_id IN :ids")
+                                      .bindparams(sqlalchemy.bindparam("ids", expanding=True)), {"ids": list(ids)})
+
+        # each distinct term is only kept once
+        strings = {}
+        terms = collections.defaultdict(list)
+        for recipe_id, term in rows:
+            terms[recipe_id].append(strings.setdefault(term, term))
+        return terms
+
+    def put(self, recipe_id, terms):
+        """
+        Store a recipe's terms, replacing what was there; a recipe with none (or that was deleted) is cleared.
+        Returns False if it is new and its id is lower than the last slot's, as slots have to stay in id order.
+        """
+
+        slot = self.slots.get(recipe_id)
+        if slot is None:
+            if len(terms) == 0:
+                return True
+            if len(self.ids) != 0 and recipe_id < self.ids[-1]:
+                return False
+            slot = len(self.ids)
+            self.ids.append(recipe_id)
+            self.slots[recipe_id] = slot
+            self.rows.append(())
+        else:
+            self.clear(slot)
+            if len(terms) == 0:
+                return True
+
+        for term in terms:
+            column = self.columns.setdefault(term, array.array("I"))
+            if isinstance(column, int):
+                self.columns[term] = column | (1 << slot)
+            else:
+                column.insert(bisect.bisect_left(column, slot), slot)
+
+        self.rows[slot] = tuple(terms)
+        self.sizes[len(terms)] |= 1 << slot
+        return True
+
+    def clear(self, slot):
+        row = self.rows[slot]
+        self.sizes[len(row)] &= ~(1 << slot)
+        for term in row:
+            column = self.columns[term]
+            if isinstance(column, int):
+                self.columns[term] = column & ~(1 << slot)
+            else:
+                column.pop(bisect.bisect_left(column, slot))
+        self.rows[slot] = ()
+
+    def match(self, pantry, allowed_missing, limit, after=None):
+        """
+        Find the recipes that use something from the pantry (a list of ingredient names) and need at most
+        allowed_missing ingredients more. Best first: fewest missing, then most of the pantry used, then lowest id.
+        Results come after the sort key after. Returns at most limit (sort key, recipe id, missing terms) tuples
+        and whether there are more.
+        """
+
+        pantry = recipe_terms(pantry)
+        terms = [term for term in pantry if term in self.columns]
+
+        # at_least[k]: the recipes having at least k of the pantry's terms
+        at_least = [-1] + [0] * len(terms)
+        for i, term in enumerate(terms):
+            column = self.columns[term]
+            if not isinstance(column, int):
+                column = bitmap(column, len(self.ids))
+            for k in range(i + 1, 0, -1):
+                at_least[k] |= at_least[k - 1] & column
+        at_least.append(0)
+
+        results = []
+        for missing in range(allowed_missing + 1):
+            for used in range(len(terms), 0, -1):
+                if after is not None and (missing, -used) < tuple(after[:2]):
+                    continue
+
+                # recipes using exactly used of the pantry's terms, out of used + missing
+                group = at_least[used] & ~at_least[used + 1] & self.sizes.get(used + missing, 0)
+                if after is not None and (missing, -used) == tuple(after[:2]):
+                    start = bisect.bisect_right(self.ids, after[2])
+                    group = group >> start << start
+
+                while group != 0:
+                    lowest = group & -group
+                    slot = lowest.bit_length() - 1
+                    group ^= lowest
+                    if len(results) == limit:
+                        return results, True
+                    results.append(((missing, -used, self.ids[slot]), self.ids[slot], [term for term in self.rows[slot] if term not in pantry]))
+
+        return results, False
+
+def bitmap(slots, length):
+    """
+    Turn a list of slots into an int with those bits set.
+    """
+
+    data = bytearray((length >> 3) + 1)
+    for slot in slots:
+        data[slot >> 3] |= 1 << (slot & 7)
+    return int.from_bytes(data, "little")
+
+pantry_index = None   # set up by create_app
+
+def pantry_search(args, limit, cursor):
+    """
+    Pantry search mode of the search page: recipes that can be made from the comma separated ingredients in args["pantry"]
+    with at most args["missing"] more (see PantryIndex.match). Returns the matching recipe ids, the missing ingredients
+    of each, and the cursor for the next page (or None). Raises ValueError if missing isn't a number.
+    """
+
+    config = flask.current_app.config
+    pantry = [item for item in args["pantry"].split(",") if len(item.strip()) != 0]
+    allowed_missing = min(max(int(args.get("missing") or config["PANTRY_MISSING"]), 0), config["PANTRY_MAX_MISSING"])
+    limit = min(limit or config["SEARCH_PAGE_SIZE"], config["SEARCH_MAX_PAGE_SIZE"])
+    after = None
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        if not all(isinstance(value, int) for value in after):
+            raise ValueError("Invalid cursor.")
+
+    results, more = pantry_index.match(pantry, allowed_missing, limit, after)
+
+    next_cursor = None
+    if more:
+        next_cursor = encode_cursor(list(results[-1][0]))
+    return [recipe_id for key, recipe_id, missing in results], {recipe_id: missing for key, recipe_id, missing in results}, next_cursor
+
+# Images
+
+# uploaded photos are kept in IMAGE_PATH under a hash of their content (e.g. "<hash>.png"), so a URL's content never
+# changes and browsers can keep it for good. With Pillow installed each one also gets a JPEG resized to every width
+# in IMAGE_WIDTHS ("<hash>-640.jpg"), which the templates offer through srcset (see photo_srcset)
+
+image_name = re.compile(r"(?P<hash>[0-9a-f]{32})(?:-(?P<width>[0-9]+))?\.(?P<extension>jpg|png|gif|webp)")
+local_photo = re.compile(r"/images/(?P<hash>[0-9a-f]{32})\.(?:jpg|png|gif|webp)")
+
+class ImageStore:
+    """
+    Stores uploaded images on disk and makes their resized variants in a pool of IMAGE_WORKERS processes,
+    so resizing doesn't hold up the worker's requests. Variants are made in the background after an upload,
+    or on the spot if one is asked for before its background job has got to it.
+    """
+
+    def __init__(self, app):
+        self.path = app.config["IMAGE_PATH"]
+        self.widths = app.config["IMAGE_WIDTHS"]
+        self.workers = app.config["IMAGE_WORKERS"]
+        self.timeout = app.config["IMAGE_RESIZE_TIMEOUT"]
+
+        self.pool = None   # started on first use
+        self.lock = threading.Lock()
+
+    def resizing(self):
+        return Image is not None and len(self.widths) != 0
+
+    def submit(self, path, widths):
+        """
+        Queue make_image_variants, starting the pool if need be, or a new one if a process of the last one died.
+        """
+
+        with self.lock:
+            if self.pool is None:
+                # spawned rather than forked: forking copies the locks of this process' other threads as they are
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            pool = self.pool
+
+        try:
+            return pool.submit(make_image_variants, path, widths)
+        except concurrent.futures.BrokenExecutor:
+            with self.lock:
+                if self.pool is pool:
+                    self.pool = None
+            return self.submit(path, widths)
+
+    def save(self, data):
+        """
+        Store an uploaded image and start making its variants. Returns the URL to use as a recipe's photo.
+        Raises ValueError if it isn't a JPEG, PNG, GIF or WebP image.
+        """
+
+        extension = image_type(data)
+        if extension is None:
+            raise ValueError("Photos must be JPEG, PNG, GIF or WebP images.")
+
+        name = hashlib.sha256(data).hexdigest()[:32] + "." + extension
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            os.makedirs(self.path, exist_ok=True)
+            write_file(path, data)
+
+        if self.resizing():
+            self.submit(path, self.widths)
+        return "/images/" + name
+
+    def original(self, image_hash):
+        """
+        The path of the uploaded image with this hash, or None if there isn't one.
+        """
+
+        for extension in ["jpg", "png", "gif", "webp"]:
+            path = os.path.join(self.path, f"{image_hash}.{extension}")
+            if os.path.exists(path):
+                return path
+        return None
+
+    def variant(self, image_hash, width):
+        """
+        Make sure the variant of an image at this width exists. Returns False if there is no such image.
+        """
+
+        if os.path.exists(os.path.join(self.path, f"{image_hash}-{width}.jpg")):
+            return True
+
+        original = self.original(image_hash)
+        if original is None:
+            return False
+
+        self.submit(original, [width]).result(self.timeout)
+        return True
+
+image_store = None   # set up by create_app
+
+def image_type(data):
+    """
+    The file extension for an image, going by its first bytes, or None if it isn't one of the supported types.
+    """
+
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data[:6] in [b"GIF87a", b"GIF89a"]:
+        return "gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def write_file(path, data):
+    """
+    Write a file so that readers only ever see all of it: it is written under a temporary name and then renamed.
+    """
+
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+def make_image_variants(path, widths):
+    """
+    Save an image scaled down to each width (never up) as "<hash>-<width>.jpg" next to it. Runs in ImageStore's processes.
+    """
+
+    folder, name = os.path.split(path)
+    image_hash = name.split(".")[0]
+
+    with Image.open(path) as image:
+        image.seek(0)   # first frame of an animation
+        image = image.convert("RGBA")
+        flat = Image.new("RGB", image.size, (255, 255, 255))   # transparent parts become white
+        flat.paste(image, mask=image)
+
+    for width in widths:
+        target = os.path.join(folder, f"{image_hash}-{width}.jpg")
+        if os.path.exists(target):
+            continue
+
+        resized = flat.copy()
+        resized.thumbnail((width, width * 4))
+        output = io.BytesIO()
+        resized.save(output, "JPEG", quality=82, optimize=True, progressive=True)
+        write_file(target, output.getvalue())
+
+def photo_srcset(photo):
+    """
+    The srcset listing a photo's resized variants, for the templates.
+    None for photos linked from other sites, and when variants aren't being made.
+    """
+
+    match = local_photo.fullmatch(photo or "")
+    if match is None or not image_store.resizing():
+        return None
+    return ", ".join(f"/images/{match['hash']}-{width}.jpg {width}w" for width in image_store.widths)
+
+def uploaded_photo(fields):
+    """
+    If a photo file came with the recipe form, store it and make it the recipe's photo in place of the link.
+    Raises ValueError if it isn't a supported image.
+    """
+
+    upload = flask.request.files.get("upload")
+    if upload is not None and upload.filename:
+        fields["photo"] = image_store.save(upload.read())
+
+@pages.cli.command("download-photos")
+@click.option("--threads", default=8, help="Photos downloaded at once.")
+def download_photos_command(threads):
+    """
+    Copy the photos recipes link from other sites into the image store and point the recipes at the copies,
+    so pages stop loading full size images from those sites. Photos that can't be downloaded keep their links.
+    Workers may go on showing the old links until their recipe caches expire.
+    """
+
+    urls = database.session.execute(database.select(Recipe.photo).where(Recipe.photo.like("http%")).distinct()).scalars().all()
+    database.session.rollback()
+    limit = flask.current_app.config["MAX_CONTENT_LENGTH"]
+
+    def download(url):
+        try:
+            with urllib.request.urlopen(url, timeout=10) as response:
+                data = response.read(limit + 1)
+            if len(data) > limit:
+                return None
+            return image_store.save(data)
+        except (OSError, ValueError, http.client.HTTPException):
+            return None
+
+    copied = 0
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        for url, photo in zip(urls, pool.map(download, urls)):
+            if photo is None:
+                continue
+            database.session.execute(database.update(Recipe).where(Recipe.photo == url).values(photo=photo))
+            database.session.commit()
+            copied += 1
+
+    # wait for the variants to be made
+    if image_store.pool is not None:
+        image_store.pool.shutdown()
+
+    click.echo(f"Copied {copied} of {len(urls)} photos.")
+
+# Import / export
+
+recipe_columns = ["id", "user_email", "name", "type", "photo", "date_posted", "method", "ingredients"]
+
+def read_records(path, format):
+    """
+    Stream records from a JSONL or CSV file one at a time.
+    In CSV files the ingredients column holds a JSON list.
+    """
+
+    with open(path, newline="", encoding="utf-8") as file:
+        if format == "csv":
+            for row in csv.DictReader(file):
+                if "ingredients" in row:
+                    row["ingredients"] = json.loads(row["ingredients"] or "[]")
+                yield row
+        else:
+            for line in file:
+                if len(line.strip()) != 0:
+                    yield json.loads(line)
+
+def file_format(path, format):
+    if format is not None:
+        return format
+    if path.lower().endswith(".csv"):
+        return "csv"
+    return "jsonl"
+
+def drop_indexes(tables):
+    """
+    Drop the secondary indexes on the given tables and return the SQL needed to create them again.
+    """
+
+    statement = sqlalchemy.text("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN :tables").bindparams(sqlalchemy.bindparam("tables", expanding=True))
+    indexes = database.session.execute(statement, {"tables": tables}).all()
+
+    for index in indexes:
+        database.session.execute(sqlalchemy.text(f'DROP INDEX "{index.name}"'))
+    database.session.commit()
+
+    return [index.sql for index in indexes]
+
+def restore_indexes(index_sql):
+    for sql in index_sql:
+        database.session.execute(sqlalchemy.text(sql.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1)))
+    database.session.commit()
+
+def load_checkpoint(checkpoint, source):
+    """
+    Read an import checkpoint. A checkpoint written for a different file is ignored.
+    """
+
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return {"source": source, "records": 0, "indexes": None}
+
+    with open(checkpoint) as file:
+        state = json.load(file)
+
+    if state.get("source") != source:
+        return {"source": source, "records": 0, "indexes": None}
+
+    return state
+
+def save_checkpoint(checkpoint, state):
+    if checkpoint is None:
+        return
+
+    # write then rename so a crash never leaves a half-written checkpoint
+    with open(checkpoint + ".tmp", "w") as file:
+        json.dump(state, file)
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+def insert_recipe_batch(records):
+    """
+    Insert a batch of recipe records and their ingredients. Does not commit.
+    """
+
+    recipes = []
+    for record in records:
+        date_posted = record.get("date_posted")
+        recipes.append({
+            "id": int(record["id"]) if record.get("id") not in (None, "") else None,
+            "user_email": record["user_email"],
+            "name": record["name"],
+            "type": record["type"],
+            "photo": record.get("photo") or None,
+            "date_posted": datetime.datetime.fromisoformat(date_posted) if date_posted else datetime.datetime.now(),
+            "method": record["method"],
+        })
+
+    # recipes without an id get one from the database, returned in the same order
+    insert_statement = database.insert(Recipe).returning(Recipe.id, sort_by_parameter_order=True)
+    ids = database.session.execute(insert_statement, recipes).scalars().all()
+
+    names = {}
+    for record in records:
+        for ingredient in record.get("ingredients") or []:
+            names[ingredient["name"]] = ingredient_name(ingredient["name"])
+    name_ids = ingredient_ids(list(set(names.values())))
+
+    ingredients = []
+    for recipe_id, record in zip(ids, records):
+        listed = set()
+        for i, ingredient in enumerate(record.get("ingredients") or []):
+            ingredient_id = name_ids[names[ingredient["name"]]]
+            if ingredient_id not in listed:   # names that only differ in case or spacing are one ingredient
+                listed.add(ingredient_id)
+                ingredients.append(ingredient_row(recipe_id, ingredient_id, ingredient["name"], ingredient["quantity"], i))
+
+    if len(ingredients) != 0:
+        database.session.execute(database.insert(Ingredient), ingredients)
+
+    return len(recipes) + len(ingredients)
+
+def insert_user_batch(records):
+    """
+    Insert a batch of user records. Does not commit.
+    Plaintext passwords are hashed; ones that are already hashed are kept as they are.
+    """
+
+    passwords = password_hasher.hash_many([record["password"] for record in records])
+    users = [{"email": records[i]["email"], "username": records[i]["username"], "password": passwords[i]} for i in range(len(records))]
+    database.session.execute(database.insert(User), users)
+    return len(users)
+
+def import_records(path, format, batch_size, checkpoint, tables, insert_batch, rebuild_indexes):
+    """
+    Stream records from path into the database, batch_size records per transaction.
+    After every batch the number of records done is saved to the checkpoint file,
+    so an interrupted import run again with the same checkpoint carries on where it stopped.
+    """
+
+    source = os.path.abspath(path)
+    state = load_checkpoint(checkpoint, source)
+    skip = state["records"]
+    if skip != 0:
+        print(f"Resuming after {skip} records.")
+
+    # indexes are dropped for the load and rebuilt once at the end, which is much faster than
+    # updating them row by row; their SQL is kept in the checkpoint in case the import is interrupted
+    if rebuild_indexes and state["indexes"] is None:
+        state["indexes"] = drop_indexes(tables)
+        save_checkpoint(checkpoint, state)
+
+    started = time.monotonic()
+    rows = 0
+    batch = []
+
+    def flush():
+        nonlocal rows
+        try:
+            rows += insert_batch(batch)
+            database.session.commit()
+        except Exception:
+            database.session.rollback()
+            raise
+
+        state["records"] += len(batch)
+        save_checkpoint(checkpoint, state)
+        batch.clear()
+
+        elapsed = time.monotonic() - started
+        print(f"{state['records']} records imported ({rows / max(elapsed, 1e-9):.0f} rows/sec)")
+
+    for i, record in enumerate(read_records(path, format)):
+        if i < skip:
+            continue
+        batch.append(record)
+        if len(batch) >= batch_size:
+            flush()
+
+    if len(batch) != 0:
+        flush()
+
+    if state["indexes"] is not None:
+        print("Rebuilding indexes...")
+        restore_indexes(state["indexes"])
+        state["indexes"] = None
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    elapsed = time.monotonic() - started
+    print(f"Done: {rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/sec).")
+
+def import_options(command):
+    command = click.option("--format", type=click.Choice(["jsonl", "csv"]), help="File format (default: from the file extension).")(command)
+    command = click.option("--batch-size", default=1000, show_default=True, help="Records per transaction.")(command)
+    command = click.option("--checkpoint", type=click.Path(), help="File used to resume an interrupted import.")(command)
+    command = click.option("--rebuild-indexes/--keep-indexes", default=True, show_default=True, help="Drop indexes during the load and rebuild them after.")(command)
+    return click.argument("path", type=click.Path(exists=True, dir_okay=False))(command)
+
+@pages.cli.command("import-recipes")
+@import_options
+def import_recipes_command(path, format, batch_size, checkpoint, rebuild_indexes):
+    """
+    Load recipes (with their ingredients) from a JSONL or CSV file.
+    """
+
+    import_records(path, file_format(path, format), batch_size, checkpoint, ["recipes", "ingredients"], insert_recipe_batch, rebuild_indexes)
+
+    if has_search_index():
+        print("Rebuilding search index...")
+        rebuild_search_index()
+        database.session.commit()
+
+    print("Rebuilding similar recipes...")
+    build_similar_recipes(flask.current_app.config["SIMILAR_WORKERS"])
+    database.session.commit()
+
+@pages.cli.command("import-users")
+@import_options
+def import_users_command(path, format, batch_size, checkpoint, rebuild_indexes):
+    """
+    Load users from a JSONL or CSV file.
+    """
+
+    import_records(path, file_format(path, format), batch_size, checkpoint, ["users"], insert_user_batch, rebuild_indexes)
+
+@pages.cli.command("export-recipes")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+@click.option("--format", type=click.Choice(["jsonl", "csv"]), help="File format (default: from the file extension).")
+@click.option("--batch-size", default=1000, show_default=True, help="Recipes read per query.")
+def export_recipes_command(path, format, batch_size):
+    """
+    Write every recipe (with its ingredients) to a JSONL or CSV file, reading batch_size recipes at a time.
+    """
+
+    format = file_format(path, format)
+    started = time.monotonic()
+    count = 0
+    last_id = -1
+
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = None
+        if format == "csv":
+            writer = csv.DictWriter(file, fieldnames=recipe_columns)
+            writer.writeheader()
+
+        while True:
+            # keyset pagination keeps every batch an index range scan
+            statement = database.select(Recipe.id, Recipe.user_email, Recipe.name, Recipe.type, Recipe.photo, Recipe.date_posted, Recipe.method) \
+                                .where(Recipe.id > last_id).order_by(Recipe.id).limit(batch_size)
+            recipes = database.session.execute(statement).all()
+            if len(recipes) == 0:
+                break
+            last_id = recipes[-1].id
+
+            statement = ingredients_statement(None).where(Ingredient.recipe_id.in_([recipe.id for recipe in recipes]))
+            ingredients = {}
+            for row in database.session.execute(statement):
+                ingredients.setdefault(row.recipe_id, []).append({"name": row.name, "quantity": row.quantity})
+
+            for recipe in recipes:
+                record = recipe._asdict()
+                record["date_posted"] = recipe.date_posted.isoformat()
+                record["ingredients"] = ingredients.get(recipe.id, [])
+
+                if writer is not None:
+                    record["ingredients"] = json.dumps(record["ingredients"])
+                    writer.writerow(record)
+                else:
+                    file.write(json.dumps(record) + "\n")
+
+            count += len(recipes)
+            elapsed = time.monotonic() - started
+            print(f"{count} recipes exported ({count / max(elapsed, 1e-9):.0f} recipes/sec)")
+
+    print(f"Done: {count} recipes written to {path}.")
+
+# Passwords
+
+class HasherBusy(Exception):
+    """
+    Raised when too many passwords are already waiting to be hashed or checked.
+    """
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords on a pool of PASSWORD_WORKERS threads (hashlib's KDFs release the GIL), so however
+    many threads the server handles requests on, at most that many hashes use the CPU at once. The pool's queue
+    is bounded: PASSWORD_QUEUE_LIMIT more can wait, and beyond that HasherBusy is raised instead of queueing forever.
+    submit hands the work over and returns a future; run also waits for it, as a synchronous view has to.
+    """
+
+    def __init__(self, config):
+        self.cost = config["PASSWORD_HASH_COST"]
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=config["PASSWORD_WORKERS"], thread_name_prefix="password")
+        self.slots = threading.BoundedSemaphore(config["PASSWORD_WORKERS"] + config["PASSWORD_QUEUE_LIMIT"])
+
+    def submit(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self.pool.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())   # its slot frees up once it has run
+        return future
+
+    def run(self, function, *args):
+        return self.submit(function, *args).result()
+
+    def hash(self, password):
+        return self.run(hash_password, password, self.cost)
+
+    def verify(self, stored, password):
+        """
+        Check password against a stored hash (or a legacy plaintext password).
+        Returns whether it is correct and whether the stored value should be replaced by a new hash.
+        """
+
+        return self.run(check_password, stored, password, self.cost)
+
+    def hash_many(self, passwords):
+        """
+        Hash a batch of passwords (e.g. for an import) on PASSWORD_WORKERS threads, leaving ones that are already hashed alone.
+        """
+
+        return list(self.pool.map(lambda password: password if is_password_hash(password) else hash_password(password, self.cost), passwords))
+
+password_hasher = None   # set up by create_app
+
+def hash_password(password, cost):
+    """
+    Hash a password with a random salt. The result records the algorithm and its parameters:
+    "scrypt$<cost>$<r>$<p>$<salt>$<hash>", or "pbkdf2_sha256$<iterations>$<salt>$<hash>"
+    on Python builds whose OpenSSL has no scrypt.
+    """
+
+    salt = os.urandom(16)
+    if hasattr(hashlib, "scrypt"):
+        digest = scrypt(password, salt, cost, 8, 1)
+        return f"scrypt${cost}$8$1${encode_bytes(salt)}${encode_bytes(digest)}"
+
+    iterations = pbkdf2_iterations(cost)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${encode_bytes(salt)}${encode_bytes(digest)}"
+
+def check_password(stored, password, cost):
+    """
+    Compare password to what hash_password stored, in constant time.
+    Returns (correct, outdated), where outdated means stored is plaintext or was hashed with other settings.
+    A missing password (None, from a form without the field) is never correct.
+    """
+
+    if password is None:
+        return False, False
+
+    parts = stored.split("$")
+
+    if parts[0] == "scrypt" and len(parts) == 6:
+        stored_cost, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+        digest = scrypt(password, decode_bytes(parts[4]), stored_cost, r, p)
+        correct = hmac.compare_digest(digest, decode_bytes(parts[5]))
+        return correct, stored_cost != cost
+
+    if parts[0] == "pbkdf2_sha256" and len(parts) == 4:
+        iterations = int(parts[1])
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode(), decode_bytes(parts[2]), iterations)
+        correct = hmac.compare_digest(digest, decode_bytes(parts[3]))
+        return correct, hasattr(hashlib, "scrypt") or iterations != pbkdf2_iterations(cost)
+
+    # stored before passwords were hashed
+    return hmac.compare_digest(stored.encode(), password.encode()), True
+
+def is_password_hash(value):
+    return value.startswith("scrypt$") or value.startswith("pbkdf2_sha256$")
+
+def scrypt(password, salt, cost, r, p):
+    n = 2 ** cost
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * r * (n + p + 2), dklen=32)
+
+def pbkdf2_iterations(cost):
+    """
+    PBKDF2 iterations taking about as long as scrypt at cost (600,000 at the default cost of 15).
+    """
+
+    return max(1, int(600000 * 2 ** (cost - 15)))
+
+def encode_bytes(value):
+    return base64.b64encode(value).decode().rstrip("=")
+
+def decode_bytes(value):
+    return base64.b64decode(value + "=" * (-len(value) % 4))
+
+@pages.cli.command("rehash-passwords")
+@click.option("--batch-size", default=100, show_default=True, help="Users updated per transaction.")
+def rehash_passwords_command(batch_size):
+    """
+    Hash every password still stored in plaintext, instead of waiting for each user to log in.
+    """
+
+    count = 0
+    last_email = ""
+    while True:
+        statement = database.select(User.email, User.password).where(User.email > last_email).order_by(User.email).limit(batch_size)
+        rows = database.session.execute(statement).all()
+        if len(rows) == 0:
+            break
+        last_email = rows[-1].email
+
+        plaintext = [row for row in rows if not is_password_hash(row.password)]
+        if len(plaintext) != 0:
+            passwords = password_hasher.hash_many([row.password for row in plaintext])
+            updates = [{"email": plaintext[i].email, "password": passwords[i]} for i in range(len(plaintext))]
+            database.session.execute(database.update(User), updates)   # bulk update by primary key
+            database.session.commit()
+            count += len(updates)
+
+    print(f"Hashed {count} plaintext passwords.")
+
+# Instrumentation
+
+class RequestMetrics:
+    """
+    Per-route totals collected by the request hooks below: request count and a latency histogram,
+    database queries and time, and template render time. Each worker keeps its own.
+    """
+
+    buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def record(self, route, seconds, queries, query_seconds, render_seconds):
+        with self.lock:
+            totals = self.routes.get(route)
+            if totals is None:
+                totals = {"requests": 0, "seconds": 0.0, "queries": 0, "query_seconds": 0.0, "render_seconds": 0.0, "buckets": [0] * len(self.buckets)}
+                self.routes[route] = totals
+
+            totals["requests"] += 1
+            totals["seconds"] += seconds
+            totals["queries"] += queries
+            totals["query_seconds"] += query_seconds
+            totals["render_seconds"] += render_seconds
+            for i in range(len(self.buckets)):
+                if seconds <= self.buckets[i]:
+                    totals["buckets"][i] += 1
+
+    def prometheus(self):
+        with self.lock:
+            routes = [(prometheus_label("route", route), dict(totals, buckets=list(totals["buckets"])))
+                      for route, totals in sorted(self.routes.items())]
+
+        # every sample of a metric has to be listed together, under its TYPE line
+        lines = ["# TYPE fresh_recipes_request_seconds histogram"]
+        for label, totals in routes:
+            for i in range(len(self.buckets)):
+                lines.append(f'fresh_recipes_request_seconds_bucket{{{label},le="{self.buckets[i]}"}} {totals["buckets"][i]}')
+            lines.append(f'fresh_recipes_request_seconds_bucket{{{label},le="+Inf"}} {totals["requests"]}')
+            lines.append(f'fresh_recipes_request_seconds_sum{{{label}}} {totals["seconds"]}')
+            lines.append(f'fresh_recipes_request_seconds_count{{{label}}} {totals["requests"]}')
+
+        for name, key in [("db_queries_total", "queries"), ("db_seconds_total", "query_seconds"), ("render_seconds_total", "render_seconds")]:
+            lines.append(f"# TYPE fresh_recipes_{name} counter")
+            for label, totals in routes:
+                lines.append(f"fresh_recipes_{name}{{{label}}} {totals[key]}")
+
+        caches = {"recipe": recipe_cache.stats(), "search": search_cache.stats(), "card": card_cache.stats()}
+        lines.append("# TYPE fresh_recipes_cache_total counter")
+        for cache, cache_stats in caches.items():
+            for counter in ["hits", "misses", "evictions"]:
+                lines.append(f'fresh_recipes_cache_total{{cache="{cache}",counter="{counter}"}} {cache_stats[counter]}')
+
+        lines.append("# TYPE fresh_recipes_cache_bytes gauge")
+        for cache, cache_stats in caches.items():
+            if "bytes" in cache_stats:
+                lines.append(f'fresh_recipes_cache_bytes{{cache="{cache}"}} {cache_stats["bytes"]}')
+
+        lines.append("# TYPE fresh_recipes_startup_seconds gauge")
+        lines.append(f'fresh_recipes_startup_seconds {flask.current_app.config["STARTUP_SECONDS"]}')
+
+        return "\n".join(lines) + "\n"
+
+def prometheus_label(name, value):
+    """
+    Format a label for the prometheus text format.
+    """
+    value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{name}="{value}"'
+
+
+request_metrics = RequestMetrics()
+
+def instrument(app):
+    """
+    Hook the app's engines, templates and requests up to request_metrics.
+    """
+
+    with app.app_context():
+        for engine in database.engines.values():
+            sqlalchemy.event.listen(engine, "before_cursor_execute", before_query)
+            sqlalchemy.event.listen(engine, "after_cursor_execute", after_query)
+
+    flask.before_render_template.connect(before_render, app)
+    flask.template_rendered.connect(after_render, app)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+def before_query(connection, cursor, statement, parameters, context, executemany):
+    if flask.has_request_context() and "started" in flask.g:
+        flask.g.query_started = time.perf_counter()
+
+def after_query(connection, cursor, statement, parameters, context, executemany):
+    if not flask.has_request_context() or "query_started" not in flask.g or flask.g.get("explaining"):
+        return
+
+    seconds = time.perf_counter() - flask.g.query_started
+    flask.g.queries += 1
+    flask.g.query_seconds += seconds
+    if flask.g.slowest_query is None or seconds > flask.g.slowest_query[0]:
+        flask.g.slowest_query = (seconds, statement, parameters, connection.engine)
+
+def before_render(sender, template, context, **extra):
+    if "started" in flask.g:
+        flask.g.render_started = time.perf_counter()
+
+def after_render(sender, template, context, **extra):
+    if "render_started" in flask.g:
+        flask.g.render_seconds += time.perf_counter() - flask.g.render_started
+
+def start_request():
+    flask.g.started = time.perf_counter()
+    flask.g.queries = 0
+    flask.g.query_seconds = 0.0
+    flask.g.render_seconds = 0.0
+    flask.g.slowest_query = None
+
+def finish_request(response):
+    if "started" not in flask.g:
+        return response
+
+    seconds = time.perf_counter() - flask.g.started
+    route = flask.request.url_rule.rule if flask.request.url_rule is not None else "unmatched"
+    request_metrics.record(route, seconds, flask.g.queries, flask.g.query_seconds, flask.g.render_seconds)
+
+    config = flask.current_app.config
+    if config["SERVER_TIMING"]:
+        response.headers["Server-Timing"] = (f'db;dur={flask.g.query_seconds * 1000:.2f};desc="{flask.g.queries} queries", '
+                                             f'render;dur={flask.g.render_seconds * 1000:.2f}, total;dur={seconds * 1000:.2f}')
+
+    if seconds >= config["SLOW_REQUEST_SECONDS"]:
+        log_slow_request(route, seconds)
+
+    return response
+
+def log_slow_request(route, seconds):
+    """
+    Log a slow request with its slowest statement and that statement's query plan.
+    """
+
+    message = f"Slow request {flask.request.method} {flask.request.full_path} ({route}): {seconds * 1000:.1f} ms, " \
+              f"{flask.g.queries} queries in {flask.g.query_seconds * 1000:.1f} ms, render {flask.g.render_seconds * 1000:.1f} ms"
+
+    if flask.g.slowest_query is not None:
+        query_seconds, statement, parameters, engine = flask.g.slowest_query
+        message += f"\nSlowest statement ({query_seconds * 1000:.1f} ms): {statement}"
+
+        # the async engines (see asgi.py) can't be used from here
+        if statement.lstrip().upper().startswith("SELECT") and not engine.dialect.is_async:
+            flask.g.explaining = True
+            try:
+                with engine.connect() as connection:
+                    plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+                message += "\nQuery plan:\n" + "\n".join("  " + row[-1] for row in plan)
+            except sqlalchemy.exc.DBAPIError:
+                pass
+            finally:
+                flask.g.explaining = False
+
+    flask.current_app.logger.warning(message)
+
+# Query plans
+
+# statements whose plans the pages rely on, with example parameters, and what each plan must (and must not) say;
+# "{email}" is replaced by some user who has recipes
+query_plan_checks = [
+    ("creator feed", feed_statement, {"email": "{email}", "limit": 31},
+     ["USING COVERING INDEX ix_recipes_user_feed"], ["TEMP B-TREE"]),
+    ("creator feed, next page", feed_after_statement, {"email": "{email}", "date_posted": "9999", "id": 0, "limit": 31},
+     ["USING COVERING INDEX ix_recipes_user_feed"], ["TEMP B-TREE"]),
+    ("recipe count", recipe_count_statement, {"email": "{email}"},
+     ["USING COVERING INDEX ix_recipes_user_feed"], []),
+    ("recipe cards", recipe_cards_statement, {"ids": [1, 2, 3]},
+     ["USING INTEGER PRIMARY KEY"], ["SCAN recipes"]),
+]
+
+def query_plan(statement, params):
+    """
+    The EXPLAIN QUERY PLAN of a statement run with params, one line per step.
+    """
+
+    compiled = statement.bindparams(**params).compile(database.engine, compile_kwargs={"render_postcompile": True})
+    connection = database.session.connection()
+    # EXPLAIN doesn't read the database, so a pooled connection would plan against the schema it last saw;
+    # a real read first picks up indexes other connections have added or dropped since
+    connection.exec_driver_sql("SELECT count(*) FROM sqlite_master").all()
+    rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + compiled.string, tuple(compiled.params[key] for key in compiled.positiontup)).all()
+    return "\n".join(row[-1] for row in rows)
+
+@pages.cli.command("check-query-plans")
+def check_query_plans_command():
+    """
+    EXPLAIN the statements in query_plan_checks and fail if a plan doesn't use the index it should,
+    e.g. after a schema change or an ANALYZE that changed the planner's mind.
+    """
+
+    email = database.session.execute(sqlalchemy.text("SELECT user_email FROM recipes LIMIT 1")).scalar() or "nobody@example.com"
+
+    failed = 0
+    for name, statement, params, expected, unexpected in query_plan_checks:
+        params = {key: email if value == "{email}" else value for key, value in params.items()}
+        plan = query_plan(statement, params)
+
+        ok = all(text in plan for text in expected) and not any(text in plan for text in unexpected)
+        if not ok:
+            failed += 1
+        click.echo(f"{'ok' if ok else 'FAILED'}: {name}\n" + "\n".join("  " + line for line in plan.splitlines()))
+
+    if failed != 0:
+        raise click.ClickException(f"{failed} query plans aren't using the indexes they should.")
+
+# Maintenance
+
+# the tables whose rows belong to a recipe, and are deleted along with it
+cascade_tables = ["ingredients", "ratings", "rating_stats", "recipe_terms", "similar_recipes", "saved_recipes"]
+
+def add_cascading_deletes():
+    """
+    Rebuild the tables whose rows belong to a recipe so that deleting the recipe deletes them too
+    (SQLite can't change a foreign key in place). Rows whose recipe or user is already gone are left out.
+    """
+
+    connection = database.session.connection()
+    for name in cascade_tables:
+        if not has_cascading_deletes(name):
+            rebuild_table(connection, database.metadata.tables[name])
+
+    # the tables' triggers were dropped with the old tables
+    create_rating_triggers()
+    for table in cache_generation_tables:
+        create_generation_triggers(table)
+    for table, column in change_log_tables:
+        create_change_log_triggers(table, column)
+
+def has_cascading_deletes(name):
+    """
+    Whether every foreign key from the table to recipes is ON DELETE CASCADE (or the table isn't there).
+    """
+
+    keys = database.session.execute(sqlalchemy.text(f"PRAGMA foreign_key_list({name})")).all()
+    return all(key.on_delete == "CASCADE" for key in keys if key.table == "recipes")
+
+def rebuild_table(connection, table):
+    """
+    Recreate a table from its model, with its indexes but not its triggers, keeping the rows whose foreign keys
+    still point at something. Columns the model has gained since (added by later migrations) are left empty.
+    """
+
+    indexes = connection.execute(sqlalchemy.text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :name AND sql IS NOT NULL"),
+                                 {"name": table.name}).scalars().all()
+    for index in indexes:
+        connection.execute(sqlalchemy.text(f"DROP INDEX {index}"))
+
+    connection.execute(sqlalchemy.text(f"ALTER TABLE {table.name} RENAME TO {table.name}_old"))
+    table.create(connection)
+    present = {row.name for row in connection.execute(sqlalchemy.text(f"PRAGMA table_info({table.name}_old)"))}
+    columns = ", ".join(f'"{column.name}"' for column in table.columns if column.name in present)
+    # EXISTS rather than IN, which the planner can turn into probing the old table's primary key with every pair of parent keys
+    kept = " AND ".join(f'EXISTS (SELECT 1 FROM {key.column.table.name} AS parent WHERE parent."{key.column.name}" = old."{key.parent.name}")'
+                        for key in table.foreign_keys)
+    connection.execute(sqlalchemy.text(f"INSERT INTO {table.name}({columns}) SELECT {columns} FROM {table.name}_old AS old WHERE {kept or 1}"))
+    connection.execute(sqlalchemy.text(f"DROP TABLE {table.name}_old"))
+
+def add_saved_recipes_cascade():
+    """
+    Give saved_recipes (left by an earlier version, before it had a model) the cascading delete that
+    add_cascading_deletes gave the other tables, or create it on databases that never had it.
+    """
+
+    connection = database.session.connection()
+    if not has_cascading_deletes("saved_recipes"):
+        rebuild_table(connection, SavedRecipe.__table__)
+    SavedRecipe.__table__.create(connection, checkfirst=True)
+
+def create_maintenance_runs():
+    MaintenanceRun.__table__.create(database.session.connection(), checkfirst=True)
+    database.session.execute(sqlalchemy.text("INSERT OR IGNORE INTO maintenance_runs(name, started_at, analyzed_seq, freed_pages) VALUES ('database', 0, 0, 0)"))
+
+# rows whose recipe, user or ingredients are gone, in the order clean-orphans deletes them
+# (ratings before rating_stats, as deleting a rating updates its recipe's totals)
+orphan_checks = [
+    ("ratings", "recipe_id NOT IN (SELECT id FROM recipes) OR user_email NOT IN (SELECT email FROM users)"),
+    ("rating_stats", "recipe_id NOT IN (SELECT id FROM recipes)"),
+    ("saved_recipes", "recipe_id NOT IN (SELECT id FROM recipes) OR user_email NOT IN (SELECT email FROM users)"),
+    ("ingredients", "recipe_id NOT IN (SELECT id FROM recipes)"),
+    ("ingredient_names", "id NOT IN (SELECT ingredient_id FROM ingredients)"),
+    ("recipe_terms", "recipe_id NOT IN (SELECT id FROM recipes)"),
+    ("similar_recipes", "recipe_id NOT IN (SELECT id FROM recipes) OR similar_id NOT IN (SELECT id FROM recipes)"),
+    ("recipe_search", "rowid NOT IN (SELECT id FROM recipes)"),
+]
+
+@pages.cli.command("clean-orphans")
+@click.option("--dry-run", is_flag=True, help="Only count them, don't delete anything.")
+def clean_orphans_command(dry_run):
+    """
+    Delete what recipes deleted before foreign keys were enforced left behind (ingredients, ratings, rating totals,
+    saved recipes, terms, similar recipes and search index entries), and ingredient names no recipe uses any more.
+    Then report any foreign key that still points nowhere.
+    """
+
+    for table, condition in orphan_checks:
+        if table == "recipe_search" and not has_search_index():
+            continue
+        if dry_run:
+            count = database.session.execute(sqlalchemy.text(f"SELECT COUNT(*) FROM {table} WHERE {condition}")).scalar()
+        else:
+            count = database.session.execute(sqlalchemy.text(f"DELETE FROM {table} WHERE {condition}")).rowcount
+        print(f"{table}: {count} orphaned row(s){'' if dry_run else ' deleted'}.")
+    database.session.commit()
+
+    violations = collections.Counter((row[0], row[2]) for row in database.session.execute(sqlalchemy.text("PRAGMA foreign_key_check")))
+    for (table, parent), count in sorted(violations.items()):
+        print(f"{table}: {count} row(s) referring to missing {parent} rows.")
+
+class Maintenance:
+    """
+    Runs run_maintenance from a background thread every MAINTENANCE_SECONDS, once the worker has had no requests for
+    MAINTENANCE_IDLE_SECONDS, or anyway when a run is a whole interval overdue, so a site that is never idle still gets it.
+    Workers take turns through the maintenance_runs row, so each run happens in only one of them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config["MAINTENANCE_SECONDS"]
+        self.idle_seconds = app.config["MAINTENANCE_IDLE_SECONDS"]
+        self.thread = None
+        self.lock = threading.Lock()
+        self.last_request = time.monotonic()
+
+        self.runs = 0
+        self.failed = 0
+
+        if self.interval > 0:
+            app.before_request(self.request_started)
+
+    def request_started(self):
+        self.last_request = time.monotonic()
+
+        # started on first use rather than in create_app, so each forked worker gets its own thread
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self.run, name="maintenance", daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(min(self.idle_seconds, self.interval))
+            idle = time.monotonic() - self.last_request >= self.idle_seconds
+            try:
+                with self.app.app_context():
+                    if self.claim(self.interval if idle else 2 * self.interval):
+                        report = run_maintenance(self.app.config["MAINTENANCE_ANALYZE_CHANGES"], self.app.config["MAINTENANCE_VACUUM_PAGES"])
+                        self.runs += 1
+                        self.app.logger.info("Database maintenance: %s", report)
+            except Exception:
+                self.failed += 1
+                self.app.logger.exception("Database maintenance failed")
+
+    def claim(self, interval):
+        """
+        Take the next run if the last one started at least interval seconds ago and no other worker just took it.
+        """
+
+        cutoff = int(time.time()) - interval
+        with database.engine.connect() as connection:
+            started_at = connection.execute(sqlalchemy.text("SELECT started_at FROM maintenance_runs WHERE name = 'database'")).scalar()
+        if started_at is None or started_at > cutoff:
+            return False
+
+        # checked before writing, so workers that aren't due don't take the write lock every few seconds
+        with database.engine.begin() as connection:
+            claimed = connection.execute(sqlalchemy.text("UPDATE maintenance_runs SET started_at = :now WHERE name = 'database' AND started_at <= :cutoff"),
+                                         {"now": int(time.time()), "cutoff": cutoff})
+            return claimed.rowcount == 1
+
+    def stats(self):
+        with self.app.app_context():
+            with database.engine.connect() as connection:
+                return {"runs": self.runs, "failed": self.failed, **maintenance_status(connection)}
+
+maintenance = None   # set up by create_app
+
+def run_maintenance(analyze_changes, vacuum_pages, full=False):
+    """
+    Bring the query planner's statistics up to date (a full ANALYZE once analyze_changes changes have been logged since the last one,
+    PRAGMA optimize otherwise) and hand up to vacuum_pages free pages back to the file system, or with full, ANALYZE and VACUUM.
+    Each statement commits on its own, so the write lock is only held for one step at a time. Returns maintenance_status.
+    """
+
+    started = time.monotonic()
+    with database.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        status = maintenance_status(connection)
+        page_count = status["page_count"]
+
+        if full or not status["analyzed"] or status["changes_since_analyze"] >= analyze_changes:
+            connection.exec_driver_sql("ANALYZE")
+            connection.execute(sqlalchemy.text("UPDATE maintenance_runs SET analyzed_at = :now, analyzed_seq = :seq WHERE name = 'database'"),
+                               {"now": int(time.time()), "seq": status["change_seq"]})
+        else:
+            # re-analyzes only the tables whose row counts have moved a lot, sampling at most 1000 rows of each index
+            # (0x10002: look at every table, not only those this connection has queried, as of SQLite 3.46)
+            connection.exec_driver_sql("PRAGMA analysis_limit = 1000")
+            connection.exec_driver_sql("PRAGMA optimize = 0x10002")
+
+        if full:
+            connection.exec_driver_sql("VACUUM")   # also switches the database to auto_vacuum = INCREMENTAL
+        elif status["incremental_vacuum"]:
+            # sqlite3 only runs the pragma's first step, which frees one page, so it is repeated,
+            # in transactions of at most 256 pages so writers aren't held up for long
+            remaining = min(vacuum_pages, status["free_pages"])
+            while remaining > 0:
+                connection.exec_driver_sql("BEGIN IMMEDIATE")
+                for i in range(min(256, remaining)):
+                    connection.exec_driver_sql("PRAGMA incremental_vacuum(1)")
+                connection.exec_driver_sql("COMMIT")
+                remaining -= 256
+
+        freed_pages = page_count - connection.exec_driver_sql("PRAGMA page_count").scalar()
+        connection.execute(sqlalchemy.text("UPDATE maintenance_runs SET finished_at = :now, seconds = :seconds, freed_pages = :freed WHERE name = 'database'"),
+                           {"now": int(time.time()), "seconds": time.monotonic() - started, "freed": freed_pages})
+
+        return maintenance_status(connection)
+
+def maintenance_status(connection):
+    """
+    What the last maintenance run did, how much space is free, and how many changes have been logged since the planner statistics were gathered.
+    """
+
+    run = connection.execute(sqlalchemy.text("SELECT finished_at, seconds, analyzed_at, analyzed_seq, freed_pages FROM maintenance_runs WHERE name = 'database'")).first()
+    seq = connection.execute(sqlalchemy.text("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'change_log'), 0)")).scalar()
+
+    def pragma(name):
+        return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+    return {
+        "last_run": run.finished_at,
+        "last_run_seconds": run.seconds,
+        "freed_pages": run.freed_pages,
+        "page_count": pragma("page_count"),
+        "free_pages": pragma("freelist_count"),
+        "page_size": pragma("page_size"),
+        "incremental_vacuum": pragma("auto_vacuum") == 2,
+        "analyzed": connection.execute(sqlalchemy.text("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")).first() is not None,
+        "analyzed_at": run.analyzed_at,
+        "change_seq": seq,
+        "changes_since_analyze": seq - run.analyzed_seq,
+    }
+
+@pages.cli.command("maintain")
+@click.option("--full", is_flag=True, help="Run a full ANALYZE and VACUUM. VACUUM rewrites the whole file and blocks writers while it runs.")
+def maintain_command(full):
+    """
+    Run the scheduled database maintenance now, and report free pages and how fresh the planner statistics are.
+    A database made before auto_vacuum was turned on needs one run with --full before free pages can be handed back incrementally.
+    """
+
+    config = flask.current_app.config
+    status = run_maintenance(config["MAINTENANCE_ANALYZE_CHANGES"], config["MAINTENANCE_VACUUM_PAGES"], full=full)
+    print(f"Freed {status['freed_pages']} pages ({status['freed_pages'] * status['page_size'] // 1024} KB) in {status['last_run_seconds']:.2f}s; "
+          f"{status['free_pages']} of {status['page_count']} pages still free.")
+    print(f"{status['changes_since_analyze']} change(s) logged since the planner statistics were gathered.")
+    if not status["incremental_vacuum"]:
+        print("auto_vacuum is off for this database, so free pages are only handed back by maintain --full.")
+
+# Replicas
+
+@pages.cli.command("copy-replica")
+@click.argument("path", type=click.Path(dir_okay=False))
+def copy_replica_command(path):
+    """
+    Copy the primary SQLite database to path, e.g. to try out DATABASE_REPLICAS locally.
+    Uses SQLite's online backup, so it's safe while the app is running.
+    """
+
+    database_path = flask.current_app.config["DATABASE_PATH"]
+    source = sqlite3.connect(database_path)
+    target = sqlite3.connect(path)
+    with target:
+        source.backup(target)
+    target.close()
+    source.close()
+
+    print(f"Copied {database_path} to {path}. Use DATABASE_REPLICAS=sqlite:///{os.path.abspath(path)}")
+
+# Migrations
+
+def initial_schema():
+    database.create_all()
+    create_missing_indexes()
+    create_search_index()
+    create_rating_triggers()
+
+def replace_rating_triggers():
+    for name in rating_triggers:
+        database.session.execute(sqlalchemy.text(f"DROP TRIGGER IF EXISTS {name}"))
+    for trigger in rating_triggers.values():
+        database.session.execute(sqlalchemy.text(trigger))
+
+# each entry upgrades the schema by one version; the version a database is at is kept in PRAGMA user_version
+migrations = [
+    initial_schema,
+    replace_rating_triggers,
+    create_cache_generations,
+    create_change_log,
+    create_similar_recipes,
+    create_user_feed_index,
+    create_ingredient_names,
+    add_cascading_deletes,
+    create_maintenance_runs,
+    create_change_log_recipe_index,
+    add_ingredient_display_names,
+    add_saved_recipes_cascade,
+]
+
+def migrate_database():
+    """
+    Apply every migration the database hasn't had yet. Returns the number applied.
+    """
+
+    version = database.session.execute(sqlalchemy.text("PRAGMA user_version")).scalar()
+
+    for i in range(version, len(migrations)):
+        started = time.monotonic()
+        migrations[i]()
+        database.session.execute(sqlalchemy.text(f"PRAGMA user_version = {i + 1}"))
+        database.session.commit()
+        print(f"Applied migration {i + 1} ({migrations[i].__name__}) in {time.monotonic() - started:.2f}s")
+
+    return len(migrations) - version
+
+@pages.cli.command("migrate")
+def migrate_command():
+    """
+    Create or upgrade the database schema. Run this once before starting the workers.
+    """
+
+    applied = migrate_database()
+    if applied == 0:
+        print("Database is up to date.")
+
+# /////////////////
+#     Tables
+# /////////////////
+
+class User(database.Model):
+    __tablename__ = "users"
+
+    email = database.Column(database.String, primary_key=True)
+    username = database.Column(database.String, nullable=False)
+    password = database.Column(database.String, nullable=False)
+
+    def __repr__(self):
+        return f"User: {self.username} [{self.email}]"
+
+class Recipe(database.Model):
+    __tablename__ = "recipes"
+
+    id = database.Column(database.Integer, primary_key=True)
+    user_email = database.Column(database.String, database.ForeignKey("users.email"), nullable=False)
+    name = database.Column(database.String, nullable=False, index=True)
+    date_posted = database.Column(database.DateTime, nullable=False, index=True)
+    type = database.Column(database.String, nullable=False, index=True)
+    photo = database.Column(database.String)
+    method = database.Column(database.String, nullable=False)
+
+    # a user's recipes newest first, read from the index alone (see creator_feed); also serves lookups by user_email
+    __table_args__ = (database.Index("ix_recipes_user_feed", "user_email", sqlalchemy.text("date_posted DESC"), "id"),)
+
+    def __repr__(self):
+        return f"Recipe {self.id}: {self.name} ({self.type})"
+    
+class IngredientName(database.Model):
+    __tablename__ = "ingredient_names"
+
+    id = database.Column(database.Integer, primary_key=True)
+    name = database.Column(database.String, nullable=False, unique=True)   # see ingredient_name
+
+    def __repr__(self):
+        return f"Ingredient {self.id}: {self.name}"
+
+class Ingredient(database.Model):
+    __tablename__ = "ingredients"
+
+    recipe_id = database.Column(database.Integer, database.ForeignKey("recipes.id", ondelete="CASCADE"), primary_key=True)
+    ingredient_id = database.Column(database.Integer, database.ForeignKey("ingredient_names.id"), primary_key=True, index=True)
+    name = database.Column(database.String)   # as written; None on rows from before it was kept, which show ingredient_names.name
+    quantity = database.Column(database.String, nullable=False)   # as written
+    amount = database.Column(database.Float)    # the quantity split up by parse_quantity
+    unit = database.Column(database.String)
+    note = database.Column(database.String)
+    order = database.Column(database.Integer, nullable=False)
+
+    def __repr__(self):
+        return f"{self.quantity} #{self.ingredient_id} [{self.recipe_id}]"
+    
+class SavedRecipe(database.Model):
+    __tablename__ = "saved_recipes"   # from an earlier version; nothing reads it now, but its rows are kept
+
+    recipe_id = database.Column(database.Integer, database.ForeignKey("recipes.id", ondelete="CASCADE"), primary_key=True)
+    user_email = database.Column(database.String, database.ForeignKey("users.email"), primary_key=True)
+
+class Rating(database.Model):
+    __tablename__ = "ratings"
+
+    recipe_id = database.Column(database.Integer, database.ForeignKey("recipes.id", ondelete="CASCADE"), primary_key=True)
+    user_email = database.Column(database.String, database.ForeignKey("users.email"), primary_key=True)
+    stars = database.Column(database.Integer, nullable=False)
+    description = database.Column(database.String)
+
+class Change(database.Model):
+    __tablename__ = "change_log"
+    __table_args__ = (
+        database.Index("ix_change_log_recipe_seq", "recipe_id", "seq"),   # a recipe's latest change (see fresh_cached_payloads)
+        {"sqlite_autoincrement": True},   # never reuse a seq, even after pruning
+    )
+
+    seq = database.Column(database.Integer, primary_key=True)
+    recipe_id = database.Column(database.Integer, nullable=False)
+    changed_at = database.Column(database.Integer, nullable=False, server_default=sqlalchemy.text("(CAST(strftime('%s', 'now') AS INTEGER))"))
+
+class RecipeTerm(database.Model):
+    """
+    The normalized ingredient names of each recipe (see ingredient_term).
+    """
+    __tablename__ = "recipe_terms"
+
+    term = database.Column(database.String, primary_key=True)
+    recipe_id = database.Column(database.Integer, database.ForeignKey("recipes.id", ondelete="CASCADE"), primary_key=True, index=True)
+
+class SimilarRecipe(database.Model):
+    __tablename__ = "similar_recipes"
+
+    recipe_id = database.Column(database.Integer, database.ForeignKey("recipes.id", ondelete="CASCADE"), primary_key=True)
+    similar_id = database.Column(database.Integer, database.ForeignKey("recipes.id", ondelete="CASCADE"), primary_key=True, index=True)
+    score = database.Column(database.Float, nullable=False)
+
+class CacheGeneration(database.Model):
+    __tablename__ = "cache_generations"
+
+    name = database.Column(database.String, primary_key=True)
+    generation = database.Column(database.Integer, nullable=False, default=0)
+
+class RatingStats(database.Model):
+    """
+    Per-recipe rating aggregates, kept up to date by triggers on the ratings table.
+    """
+    __tablename__ = "rating_stats"
+
+    recipe_id = database.Column(database.Integer, database.ForeignKey("recipes.id", ondelete="CASCADE"), primary_key=True)
+    rating_count = database.Column(database.Integer, nullable=False)
+    rating_sum = database.Column(database.Integer, nullable=False)
+    avg = database.Column(database.Float, index=True)
+
+class MaintenanceRun(database.Model):
+    """
+    What the scheduled maintenance (see Maintenance) last did. A single row, which also lets workers take turns running it.
+    """
+    __tablename__ = "maintenance_runs"
+
+    name = database.Column(database.String, primary_key=True)
+    started_at = database.Column(database.Integer, nullable=False, default=0)
+    finished_at = database.Column(database.Integer)
+    seconds = database.Column(database.Float)
+    analyzed_at = database.Column(database.Integer)    # last full ANALYZE
+    analyzed_seq = database.Column(database.Integer, nullable=False, default=0)   # the change_log seq it was run at
+    freed_pages = database.Column(database.Integer, nullable=False, default=0)    # by the last run
+
+
+# /////////////////
+#     Main
+# /////////////////
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    app = create_app()
+    with app.app_context():
+        migrate_database()
+    app.run(debug=True)
@@ -0,0 +1,392 @@
+"""
+ASGI entry point for Fresh Recipes.
+
+    uvicorn --factory --workers 4 asgi:create_asgi_app
+    gunicorn -w 4 -k uvicorn.workers.UvicornWorker "asgi:create_asgi_app()"
+
+The read-only pages (home, recipe and search) are served by the async views below. They query SQLite through
+SQLAlchemy's asyncio engine (aiosqlite), so a single worker can have many page loads waiting on the database at once.
+They share their SQL, templates, caches and read/write routing with the views in app.py.
+Every other route (and the search form's POST) goes to the regular Flask app, which runs in a thread pool.
+
+Needs the aiosqlite and asgiref packages (pip install aiosqlite asgiref).
+"""
+
+import asyncio
+import functools
+import io
+import sys
+
+import flask
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+import werkzeug.exceptions
+from asgiref.wsgi import WsgiToAsgi
+
+import app as fresh_recipes
+
+send_size = 16384   # bytes of a streamed response sent to the server at a time
+
+# /////////////////
+#     Setup
+# /////////////////
+
+class AsyncReads:
+    """
+    ASGI application that runs the async views on the event loop and hands everything else to the Flask app.
+    Each async view runs inside a normal Flask request context, so the session, flashed messages, url_for,
+    templates and the before/after request hooks work the same as in the sync views.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        self.engines = async_engines(app)
+        self.views = {
+            "pages.home_page": home_page,
+            "pages.recipe_page": recipe_page,
+            "pages.search": search,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+
+        if scope["type"] != "http" or scope["method"] not in ["GET", "HEAD"]:
+            await self.wsgi(scope, receive, send)
+            return
+
+        environ = wsgi_environ(scope)
+        try:
+            endpoint, view_args = self.app.url_map.bind_to_environ(environ).match()
+        except werkzeug.exceptions.HTTPException:
+            endpoint = None
+
+        if endpoint not in self.views:
+            await self.wsgi(scope, receive, send)
+            return
+
+        await self.serve(self.views[endpoint], environ, send)
+
+    async def serve(self, view, environ, send):
+        """
+        Dispatch a request to an async view the way Flask's full_dispatch_request does, and send the response.
+        """
+
+        app = self.app
+        with app.request_context(environ):
+            try:
+                try:
+                    response = app.preprocess_request()
+                    if response is None:
+                        flask.g.read_only = True
+                        response = await view(self.engines, **flask.request.view_args)
+                except Exception as error:
+                    response = app.handle_user_exception(error)
+                response = app.finalize_request(response)
+            except Exception as error:
+                response = app.handle_exception(error)
+
+            started = {}
+            def start_response(status, headers, exc_info=None):
+                started["status"] = int(status.split(" ", 1)[0])
+                started["headers"] = [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in headers]
+
+            # streamed templates (search results) render as the body is iterated, so that stays inside the request context;
+            # they yield many tiny pieces, which are sent on in blocks of at least send_size bytes
+            body = response(environ, start_response)
+            try:
+                await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+                pending = []
+                pending_size = 0
+                for chunk in body:
+                    pending.append(chunk)
+                    pending_size += len(chunk)
+                    if pending_size >= send_size:
+                        await send({"type": "http.response.body", "body": b"".join(pending), "more_body": True})
+                        pending = []
+                        pending_size = 0
+                await send({"type": "http.response.body", "body": b"".join(pending)})
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                for engine in self.engines.values():
+                    await engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+def create_asgi_app(config=None):
+    """
+    Build the Flask app with app.create_app and wrap it for an ASGI server.
+    """
+
+    return AsyncReads(fresh_recipes.create_app(config))
+
+def wsgi_environ(scope):
+    """
+    Build the WSGI environ of a bodiless HTTP request from its ASGI scope.
+    """
+
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if path.startswith(root_path):
+        path = path[len(root_path):]
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode("utf8").decode("latin1"),
+        "PATH_INFO": path.encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_PROTOCOL": "HTTP/" + scope["http_version"],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"] = server[0]
+    environ["SERVER_PORT"] = str(server[1])
+    if scope.get("client") is not None:
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name not in ["CONTENT_TYPE", "CONTENT_LENGTH"]:
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value   # repeated headers are joined, as in WSGI
+        environ[name] = value
+
+    return environ
+
+def async_engines(app):
+    """
+    Make an asyncio engine for the primary database (key None) and for each of the app's read binds,
+    with the same profile pragmas, pool settings and query instrumentation as the sync engines.
+    """
+
+    profile = fresh_recipes.database_profiles[app.config["DATABASE_PROFILE"]]
+
+    targets = {None: {"url": app.config["SQLALCHEMY_DATABASE_URI"], **app.config["SQLALCHEMY_ENGINE_OPTIONS"]}}
+    for bind_key, bind in app.config["SQLALCHEMY_BINDS"].items():
+        if isinstance(bind, str):
+            bind = {"url": bind}
+        targets[bind_key] = bind
+
+    engines = {}
+    for bind_key, options in targets.items():
+        options = dict(options)
+        url = sqlalchemy.make_url(options.pop("url"))
+        if url.drivername == "sqlite":
+            url = url.set(drivername="sqlite+aiosqlite")
+
+        engine = sqlalchemy.ext.asyncio.create_async_engine(url, **options)
+        if engine.dialect.name == "sqlite":
+            sqlalchemy.event.listen(engine.sync_engine, "connect", functools.partial(fresh_recipes.set_sqlite_pragmas, pragmas=profile["pragmas"], read_only=bind_key is not None))
+        sqlalchemy.event.listen(engine.sync_engine, "before_cursor_execute", fresh_recipes.before_query)
+        sqlalchemy.event.listen(engine.sync_engine, "after_cursor_execute", fresh_recipes.after_query)
+        engines[bind_key] = engine
+
+    return engines
+
+def read_connection(engines):
+    """
+    Connect to the engine the current request should read from (see app.choose_read_bind).
+    """
+
+    return engines[fresh_recipes.choose_read_bind()].connect()
+
+# /////////////////
+#     Pages
+# /////////////////
+
+async def home_page(engines):
+    """
+    Async version of app.home_page.
+    """
+
+    logged_in = "logged_in_user" in flask.session
+
+    catalog = await current_catalog()
+    if catalog is not None:
+        recipes = catalog.sample(15)
+    else:
+        async with read_connection(engines) as connection:
+            sampler = fresh_recipes.recipe_sampler
+            if sampler.stale():
+                result = await connection.execute(sqlalchemy.select(fresh_recipes.Recipe.id))
+                sampler.replace(result.scalars().all())
+
+            recipes = await fetch_recipe_cards(connection, sampler.sample(15))
+
+    if len(recipes) == 0:
+        return flask.render_template("home.html", logged_in=logged_in, results=None)
+
+    return flask.render_template("home.html", logged_in=logged_in, results=recipes)
+
+async def search(engines):
+    """
+    Async version of app.search, for GET requests.
+    """
+
+    logged_in = "logged_in_user" in flask.session
+    args = flask.request.args
+
+    # no search yet, just show the form
+    if not any(field in args for field in fresh_recipes.search_fields):
+        return flask.render_template("search.html", logged_in=logged_in, results=None)
+
+    try:
+        page_size = args.get("page_size", flask.current_app.config["SEARCH_PAGE_SIZE"], type=int)
+
+        if len(args.get("pantry", "").strip()) != 0:
+            pantry_index = fresh_recipes.pantry_index
+            if pantry_index.refresh_due():
+                await asyncio.to_thread(pantry_index.refresh)
+            ids, missing, next_cursor = fresh_recipes.pantry_search(args, page_size, args.get("cursor"))
+
+            catalog = await current_catalog()
+            if catalog is not None:
+                recipes = catalog.cards(ids)
+            else:
+                async with read_connection(engines) as connection:
+                    recipes = await fetch_recipe_cards(connection, ids)
+            return fresh_recipes.search_results_page(logged_in, recipes, next_cursor, missing)
+
+        query = fresh_recipes.search_query(args)
+
+        async with read_connection(engines) as connection:
+            recipes, next_cursor = await advanced_search(connection, query, page_size, args.get("cursor"))
+    except ValueError:
+        flask.flash("Invalid search.")
+        return flask.redirect("/search")
+
+    return fresh_recipes.search_results_page(logged_in, recipes, next_cursor)
+
+async def recipe_page(engines, recipe_id):
+    """
+    Async version of app.recipe_page.
+    """
+
+    logged_in = "logged_in_user" in flask.session
+
+    payload = await load_recipe_payload(engines, recipe_id)
+
+    if payload is None:
+        flask.flash("Recipe not found.")
+        return flask.redirect("/")
+
+    async with read_connection(engines) as connection:
+        similar = (await connection.execute(fresh_recipes.similar_recipes_statement, {"id": payload["recipe"]["id"]})).all()
+
+    return fresh_recipes.recipe_response(logged_in, payload, similar)
+
+# /////////////////
+#     Functions
+# /////////////////
+
+async def fetch_recipe_cards(connection, ids):
+    """
+    Async version of app.fetch_recipe_cards.
+    """
+
+    if len(ids) == 0:
+        return []
+
+    rows = (await connection.execute(fresh_recipes.recipe_cards_statement, {"ids": list(ids)})).all()
+    return fresh_recipes.order_cards(ids, rows)
+
+async def advanced_search(connection, query, limit, cursor):
+    """
+    Async version of app.advanced_search, sharing its search_cache.
+    """
+
+    indexed = await has_search_index(connection)
+    statement, params, ranked, limit = fresh_recipes.build_search(query, limit, cursor, indexed)
+
+    catalog = await current_catalog()
+    if catalog is not None:
+        generations = catalog.generations()
+    else:
+        generations = (await connection.execute(fresh_recipes.cache_generations_query)).all()
+    key = fresh_recipes.search_cache_key(query, limit, cursor, indexed, generations)
+
+    cached = fresh_recipes.search_cache.get(key)
+    if cached is not None:
+        if catalog is not None:
+            return catalog.cards(cached["ids"]), cached["next_cursor"]
+        return await fetch_recipe_cards(connection, cached["ids"]), cached["next_cursor"]
+
+    results = (await connection.execute(statement, params)).all()
+    results, next_cursor = fresh_recipes.search_page(results, limit, ranked)
+
+    fresh_recipes.search_cache.set(key, {"ids": [row.id for row in results], "next_cursor": next_cursor})
+    return results, next_cursor
+
+async def load_recipe_payload(engines, recipe_id):
+    """
+    Async version of app.load_recipe_payload, sharing its recipe_cache.
+    """
+
+    try:
+        recipe_id = int(recipe_id)
+    except ValueError:
+        return None
+
+    catalog = await current_catalog()
+    if catalog is not None and recipe_id in catalog.recipes:
+        return catalog.payload(recipe_id)
+
+    payload = fresh_recipes.recipe_cache.get(recipe_id)
+
+    async with read_connection(engines) as connection:
+        # the same check as app.fresh_cached_payloads
+        if payload is not None:
+            latest = (await connection.execute(fresh_recipes.latest_changes_statement, {"ids": [recipe_id]})).first()
+            if latest is None or latest[1] <= payload["change_seq"]:
+                return payload
+
+        change_seq = (await connection.execute(fresh_recipes.change_seq_statement)).scalar()
+        recipe = (await connection.execute(fresh_recipes.recipe_statement(recipe_id))).first()
+        if recipe is None:
+            return None
+
+        ingredients = (await connection.execute(fresh_recipes.ingredients_statement(recipe_id))).all()
+
+    payload = fresh_recipes.recipe_payload(recipe, ingredients, recipe.avg, recipe.rating_count)
+    payload["change_seq"] = change_seq
+    fresh_recipes.recipe_cache.set(recipe_id, payload)
+    return payload
+
+async def current_catalog():
+    """
+    Async version of app.Catalog.current: a due refresh runs on a thread, as it queries the database.
+    """
+
+    catalog = fresh_recipes.catalog
+    if catalog.refresh_due():
+        await asyncio.to_thread(catalog.refresh)
+    return catalog.current()
+
+async def has_search_index(connection):
+    """
+    Async version of app.has_search_index.
+    """
+
+    if fresh_recipes.search_index_available is None:
+        fresh_recipes.search_index_available = (await connection.execute(fresh_recipes.search_index_query)).first() is not None
+
+    return fresh_recipes.search_index_available
@@ -0,0 +1,687 @@
+"""
+Benchmarks for Fresh Recipes.
+
+Generate a synthetic corpus, then measure every route against it:
+
+    python bench.py generate bench.db --recipes 10000
+    python bench.py run bench.db --save-baseline bench_baseline.json
+    python bench.py run bench.db --baseline bench_baseline.json
+
+"run" drives the routes through the Flask test client and reports p50/p95/p99 latency, throughput
+and queries per request for each scenario. With --baseline it exits with an error if a scenario got
+slower (or started running more queries) than the stored baseline allows.
+
+"load" sends concurrent HTTP requests to a running server instead:
+
+    DATABASE_PATH=bench.db gunicorn -w 4 "app:create_app()"
+    python bench.py load bench.db --url http://localhost:8000 --concurrency 32 --requests 5000
+
+"servers" starts the sync deployment (gunicorn running app.py) and then the async one (uvicorn running asgi.py)
+with the same number of workers, and puts each under the same load (needs gunicorn, uvicorn, aiosqlite and asgiref):
+
+    python bench.py servers bench.db --workers 2 --concurrency 64 --requests 5000
+
+"logins" measures how many passwords can be checked per second (and per core) at a given scrypt cost,
+which bounds the login rate a worker can sustain:
+
+    python bench.py logins --cost 15 --threads 1 2 4
+
+"ratings" rates a single recipe from many threads at once through the rating endpoint, then checks that the
+recipe's rating totals still match its ratings exactly:
+
+    python bench.py ratings bench.db --threads 32 --requests 5000
+
+"catalog" loads the in-memory catalog (CATALOG_ENABLED) and reports its load time and memory, scaled to 100k recipes,
+then runs the home, recipe and search scenarios with it turned off and on:
+
+    python bench.py catalog bench.db --requests 200
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import itertools
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+
+import sqlalchemy
+
+import app as fresh_recipes
+
+# /////////////////
+#     Corpus
+# /////////////////
+
+cuisines = ["Italian", "Mexican", "Indian", "Japanese", "Thai", "Chinese", "French", "Greek", "American", "Russian",
+            "Korean", "Vietnamese", "Spanish", "Moroccan", "Lebanese", "Ethiopian", "Brazilian", "Peruvian", "German", "Turkish"]
+
+dishes = ["Stew", "Curry", "Tacos", "Salad", "Soup", "Pie", "Pasta", "Stir Fry", "Casserole", "Skewers",
+          "Bowl", "Sandwich", "Rolls", "Dumplings", "Roast", "Burger", "Risotto", "Noodles", "Wrap", "Bake"]
+
+adjectives = ["Spicy", "Creamy", "Smoky", "Crispy", "Garlic", "Lemon", "Herbed", "Classic", "Easy", "Grilled",
+              "Sweet", "Tangy", "Rustic", "Quick", "Hearty", "Roasted", "Braised", "Honey", "Golden", "Fresh"]
+
+base_ingredients = ["chicken", "beef", "pork", "shrimp", "tofu", "salmon", "rice", "pasta", "noodles", "potato",
+                    "onion", "garlic", "tomato", "carrot", "pepper", "mushroom", "spinach", "cabbage", "lettuce", "cucumber",
+                    "avocado", "lime", "lemon", "cilantro", "basil", "parsley", "ginger", "cumin", "paprika", "chili",
+                    "butter", "cream", "milk", "yogurt", "cheddar", "mozzarella", "parmesan", "egg", "flour", "sugar",
+                    "honey", "soy sauce", "olive oil", "vinegar", "broth", "beans", "corn", "peas", "lentils", "chickpeas"]
+
+ingredient_modifiers = ["", "", "", "fresh ", "chopped ", "ground ", "dried ", "smoked ", "red ", "green "]
+
+units = ["1 cup", "2 cups", "1/2 cup", "1 tbsp", "2 tbsp", "1 tsp", "1 lb", "1/2 lb", "4 oz", "1", "2", "1, sliced", "1 can"]
+
+def ingredient_vocabulary():
+    """
+    Every ingredient name the generator can use. Names are drawn with a skewed distribution,
+    so a few (onion, garlic, ...) show up in many recipes and most are rare, like real recipes.
+    """
+
+    return [modifier + name for name in base_ingredients for modifier in sorted(set(ingredient_modifiers))]
+
+def skewed_choice(rng, items):
+    """
+    Pick from items with a Zipf-like bias towards the start of the list.
+    """
+
+    index = int(rng.paretovariate(1.2)) - 1
+    return items[index % len(items)]
+
+def ingredient_count(rng):
+    # most recipes have 5-12 ingredients, a few have many more
+    return max(1, min(30, int(rng.gauss(8, 3))))
+
+def rating_count(rng):
+    # most recipes have no or few ratings, a few popular ones have hundreds
+    if rng.random() < 0.4:
+        return 0
+    return min(500, int(rng.expovariate(1 / 6)) + 1)
+
+def stars(rng):
+    return rng.choices([1, 2, 3, 4, 5], weights=[5, 7, 15, 35, 38])[0]
+
+def generate_corpus(path, recipe_total, user_total, seed, batch_size=10000):
+    """
+    Create a database at path holding recipe_total synthetic recipes with their ingredients, ratings, terms and similar recipes.
+    The schema comes from the app's migrations, so the corpus has the same tables, indexes and triggers.
+    """
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    app = fresh_recipes.create_app(database_config(path))
+    with app.app_context():
+        fresh_recipes.migrate_database()
+        fresh_recipes.database.engine.dispose()
+
+    rng = random.Random(seed)
+    vocabulary = ingredient_vocabulary()
+    emails = [f"user{i}@example.com" for i in range(user_total)]
+    started_on = datetime.datetime(2022, 1, 1)
+    started = time.monotonic()
+
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA journal_mode = MEMORY")
+
+    connection.executemany("INSERT INTO users(email, username, password) VALUES (?, ?, ?)",
+                           [(email, email.split("@")[0], "password") for email in emails + ["bench@example.com"]])
+    connection.executemany("INSERT INTO ingredient_names(id, name) VALUES (?, ?)",
+                           [(i + 1, fresh_recipes.ingredient_name(name)) for i, name in enumerate(vocabulary)])
+    name_ids = {name: i + 1 for i, name in enumerate(vocabulary)}
+
+    recipe_id = 0
+    while recipe_id < recipe_total:
+        recipes = []
+        ingredients = []
+        ratings = []
+
+        for i in range(min(batch_size, recipe_total - recipe_id)):
+            recipe_id += 1
+            names = []
+            wanted = ingredient_count(rng)
+            while len(names) < wanted:
+                name = skewed_choice(rng, vocabulary)
+                if name not in names:
+                    names.append(name)
+                if len(names) == len(vocabulary):
+                    break
+
+            title = f"{rng.choice(adjectives)} {names[0].title()} {rng.choice(dishes)}"
+            posted = started_on + datetime.timedelta(seconds=rng.randrange(3 * 365 * 24 * 3600))
+            method = "\n".join(f"{step}. " + " ".join(rng.choices(names + ["stir", "cook", "serve", "season", "bake"], k=12))
+                               for step in range(1, rng.randint(3, 9)))
+            recipes.append((recipe_id, rng.choice(emails), title, str(posted), rng.choice(cuisines), None, method))
+
+            for order, name in enumerate(names):
+                quantity = rng.choice(units)
+                ingredients.append((recipe_id, name_ids[name], name, quantity, *fresh_recipes.parse_quantity(quantity), order))
+
+            for email in rng.sample(emails, min(rating_count(rng), len(emails))):
+                ratings.append((recipe_id, email, stars(rng), None))
+
+        connection.executemany("INSERT INTO recipes(id, user_email, name, date_posted, type, photo, method) VALUES (?, ?, ?, ?, ?, ?, ?)", recipes)
+        connection.executemany('INSERT INTO ingredients(recipe_id, ingredient_id, name, quantity, amount, unit, note, "order") VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               ingredients)
+        connection.executemany("INSERT INTO ratings(recipe_id, user_email, stars, description) VALUES (?, ?, ?, ?)", ratings)
+        connection.commit()
+
+        elapsed = time.monotonic() - started
+        print(f"{recipe_id} recipes generated ({recipe_id / max(elapsed, 1e-9):.0f}/sec)")
+
+    connection.close()
+
+    with app.app_context():
+        if fresh_recipes.has_search_index():
+            print("Building search index...")
+            fresh_recipes.rebuild_search_index()
+        # pantry search matches on recipe_terms, and recipe pages list similar_recipes; both are derived tables
+        print("Building recipe terms and similar recipes...")
+        fresh_recipes.build_similar_recipes(app.config["SIMILAR_WORKERS"])
+        fresh_recipes.database.session.execute(sqlalchemy.text("ANALYZE"))
+        fresh_recipes.database.session.commit()
+
+    print(f"Done in {time.monotonic() - started:.1f}s.")
+
+def database_config(path):
+    path = os.path.abspath(path)
+    return {"DATABASE_PATH": path, "SQLALCHEMY_DATABASE_URI": "sqlite:///" + path}
+
+# /////////////////
+#     Scenarios
+# /////////////////
+
+class Corpus:
+    """
+    Values taken from a generated database, used to build realistic requests.
+    """
+
+    def __init__(self, path):
+        connection = sqlite3.connect(path)
+        self.ids = [row[0] for row in connection.execute("SELECT id FROM recipes")]
+        self.emails = [row[0] for row in connection.execute("SELECT DISTINCT user_email FROM recipes LIMIT 1000")]
+        self.types = [row[0] for row in connection.execute("SELECT DISTINCT type FROM recipes LIMIT 100")]
+        self.words = sorted({word for row in connection.execute("SELECT name FROM recipes LIMIT 1000") for word in row[0].split()})
+        self.ingredients = [row[0] for row in connection.execute("SELECT name FROM ingredient_names LIMIT 500")]
+        connection.close()
+
+        if len(self.ids) == 0:
+            raise SystemExit("The corpus is empty; run 'python bench.py generate' first.")
+
+search_filters = ["name", "id", "type", "email", "min_rating", "max_rating", "ingredients"]
+
+def search_values(rng, corpus, filters):
+    values = {field: "" for field in search_filters}
+    for field in filters:
+        if field == "name":
+            values["name"] = rng.choice(corpus.words)
+        elif field == "id":
+            values["id"] = str(rng.choice(corpus.ids))
+        elif field == "type":
+            values["type"] = rng.choice(corpus.types)
+        elif field == "email":
+            values["email"] = rng.choice(corpus.emails)
+        elif field == "min_rating":
+            values["min_rating"] = str(rng.choice([2, 3, 4]))
+        elif field == "max_rating":
+            values["max_rating"] = str(rng.choice([3, 4, 5]))
+        elif field == "ingredients":
+            values["ingredients"] = ", ".join(rng.sample(corpus.ingredients, rng.randint(1, 2)))
+    return values
+
+def read_paths(rng, corpus, count):
+    """
+    A mix of GET requests like real traffic: mostly recipe pages, then the home page and searches.
+    """
+
+    paths = []
+    for i in range(count):
+        kind = rng.choices(["recipe", "home", "search"], weights=[6, 2, 2])[0]
+        if kind == "recipe":
+            paths.append(f"/recipe/{rng.choice(corpus.ids)}")
+        elif kind == "home":
+            paths.append("/")
+        else:
+            filters = rng.sample(["name", "type", "ingredients", "min_rating"], rng.randint(1, 2))
+            paths.append("/search?" + urllib.parse.urlencode(search_values(rng, corpus, filters)))
+    return paths
+
+def scenarios(rng, corpus):
+    """
+    Every scenario as (name, function(client) -> response).
+    Searches cover every combination of advanced_search's filters.
+    """
+
+    result = [
+        ("home", lambda client: client.get("/")),
+        ("recipe", lambda client: client.get(f"/recipe/{rng.choice(corpus.ids)}")),
+    ]
+
+    for size in range(len(search_filters) + 1):
+        for filters in itertools.combinations(search_filters, size):
+            name = "search[" + ",".join(filters) + "]"
+            result.append((name, lambda client, filters=filters: client.get("/search?" + urllib.parse.urlencode(search_values(rng, corpus, filters)))))
+
+    result.append(("search[pantry]", lambda client: client.get("/search?" + urllib.parse.urlencode(
+        {"pantry": ", ".join(rng.sample(corpus.ingredients, min(15, len(corpus.ingredients)))), "missing": 2}))))
+
+    result.append(("api[recipes]", lambda client: client.get("/api/v1/recipes?" + urllib.parse.urlencode(
+        {"ids": ",".join(str(recipe_id) for recipe_id in rng.sample(corpus.ids, min(20, len(corpus.ids)))), "fields": "name,type,rating"}),
+        headers={"Accept-Encoding": "gzip"})))
+
+    created = []
+
+    def create(client):
+        names = rng.sample(corpus.ingredients, min(8, len(corpus.ingredients)))
+        response = client.post("/create_recipe", data={
+            "name": f"Bench {rng.choice(dishes)}", "type": rng.choice(corpus.types), "image": "",
+            "items": names, "quantities": [rng.choice(units) for name in names], "instructions": "1. Cook.\n2. Serve.",
+        })
+        created.append(response.location.rsplit("/", 1)[-1])
+        return response
+
+    def edit(client):
+        if len(created) == 0:
+            create(client)
+        names = rng.sample(corpus.ingredients, min(8, len(corpus.ingredients)))
+        return client.post(f"/edit_recipe/{rng.choice(created)}", data={
+            "name": f"Edited {rng.choice(dishes)}", "type": rng.choice(corpus.types), "image": "",
+            "items": names, "quantities": [rng.choice(units) for name in names], "instructions": "1. Cook.\n2. Serve.",
+        })
+
+    result.append(("create_recipe", create))
+    result.append(("edit_recipe", edit))
+    return result
+
+# /////////////////
+#     Measuring
+# /////////////////
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(latencies, elapsed, queries):
+    return {
+        "requests": len(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "throughput": len(latencies) / max(elapsed, 1e-9),
+        "queries_per_request": queries / max(len(latencies), 1),
+    }
+
+def print_results(results):
+    print(f"{'scenario':<60} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>9} {'queries':>8}")
+    for name, result in results.items():
+        print(f"{name:<60} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['throughput']:>9.1f} {result['queries_per_request']:>8.1f}")
+
+def run_benchmark(path, requests, seed, only, config=None):
+    """
+    Run every scenario requests times through the Flask test client.
+    """
+
+    app = fresh_recipes.create_app({**database_config(path), **(config or {})})
+    if app.config["CATALOG_ENABLED"]:
+        fresh_recipes.catalog.load()
+    corpus = Corpus(path)
+    rng = random.Random(seed)
+
+    queries = 0
+    def count_query(*args):
+        nonlocal queries
+        queries += 1
+
+    with app.app_context():
+        for engine in fresh_recipes.database.engines.values():
+            sqlalchemy.event.listen(engine, "before_cursor_execute", count_query)
+
+    client = app.test_client()
+    client.post("/login", data={"email": "bench@example.com", "password": "password"})
+
+    results = {}
+    for name, scenario in scenarios(rng, corpus):
+        if only is not None and only not in name:
+            continue
+
+        latencies = []
+        queries = 0
+        started = time.perf_counter()
+        for i in range(requests):
+            request_started = time.perf_counter()
+            response = scenario(client)
+            response.get_data()   # search pages are streamed
+            response.close()
+            latencies.append(time.perf_counter() - request_started)
+        results[name] = summarize(latencies, time.perf_counter() - started, queries)
+
+    return results
+
+def run_catalog(path, requests, seed):
+    """
+    Measure the in-memory catalog: how long it takes to load, how much memory it holds (scaled to 100k recipes),
+    and the read pages with it turned off and on.
+    """
+
+    app = fresh_recipes.create_app({**database_config(path), "CATALOG_ENABLED": True})
+
+    started = time.perf_counter()
+    fresh_recipes.catalog.load()
+    elapsed = time.perf_counter() - started
+
+    # loaded again under tracemalloc, which slows it down too much to time
+    fresh_recipes.catalog.recipes = {}
+    tracemalloc.start()
+    fresh_recipes.catalog.load()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    count = len(fresh_recipes.catalog.recipes)
+    print(f"Loaded {count} recipes in {elapsed:.2f}s: {size / 2**20:.1f} MiB held, {size / max(count, 1) * 100000 / 2**20:.0f} MiB per 100k recipes (peak {peak / 2**20:.1f} MiB)")
+
+    results = {}
+    for enabled in [False, True]:
+        for only in ["home", "recipe", "search[name]"]:
+            for name, result in run_benchmark(path, requests, seed, only, {"CATALOG_ENABLED": enabled}).items():
+                results[f"{name} catalog={'on' if enabled else 'off'}"] = result
+
+    return results
+
+def run_load(path, url, concurrency, requests, seed):
+    """
+    Send a mix of GET requests to a running server from concurrency threads.
+    """
+
+    corpus = Corpus(path)
+    paths = read_paths(random.Random(seed), corpus, requests)
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def fetch(path):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url.rstrip("/") + path, timeout=60) as response:
+                response.read()
+        except Exception:
+            with lock:
+                errors += 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(fetch, paths))
+    elapsed = time.perf_counter() - started
+
+    if len(latencies) == 0:
+        raise SystemExit(f"Every request to {url} failed.")
+
+    result = summarize(latencies, elapsed, 0)
+    result["errors"] = errors
+    return {f"http[{url}, concurrency={concurrency}]": result}
+
+def run_servers(path, workers, concurrency, requests, seed):
+    """
+    Run the same load against the sync (WSGI) and async (ASGI) deployments, each with workers worker processes.
+    """
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    url = f"http://127.0.0.1:{port}"
+
+    servers = [
+        ("wsgi", [sys.executable, "-m", "gunicorn", "--workers", str(workers), "--bind", f"127.0.0.1:{port}", "app:create_app()"]),
+        ("asgi", [sys.executable, "-m", "uvicorn", "--factory", "--workers", str(workers), "--port", str(port), "--log-level", "warning", "asgi:create_asgi_app"]),
+    ]
+
+    environment = dict(os.environ, DATABASE_PATH=os.path.abspath(path))
+    results = {}
+    for name, command in servers:
+        print(f"Starting the {name} server: {' '.join(command)}")
+        server = subprocess.Popen(command, env=environment, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+        try:
+            wait_for_server(url, server)
+            for result in run_load(path, url, concurrency, requests, seed).values():
+                results[f"{name}[workers={workers}, concurrency={concurrency}]"] = result
+        finally:
+            server.terminate()
+            server.wait()
+
+    return results
+
+def wait_for_server(url, server, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"The server exited with code {server.returncode}.")
+        try:
+            with urllib.request.urlopen(url + "/search", timeout=1) as response:
+                response.read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f"The server at {url} didn't start within {timeout} seconds.")
+
+def run_logins(cost, seconds, thread_counts):
+    """
+    Check a password over and over from each number of threads in thread_counts, for seconds seconds each.
+    """
+
+    stored = fresh_recipes.hash_password("correct horse battery staple", cost)
+    cores = os.cpu_count() or 1
+
+    results = {}
+    for threads in thread_counts:
+        latencies = []
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+
+        def check():
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                fresh_recipes.check_password(stored, "correct horse battery staple", cost)
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=check) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        result = summarize(latencies, time.perf_counter() - started, 0)
+        result["per_core"] = result["throughput"] / min(threads, cores)
+        results[f"logins[cost={cost}, threads={threads}]"] = result
+        print(f"threads={threads}: {result['throughput']:.1f} logins/sec, {result['per_core']:.1f} per core ({cores} cores)")
+
+    return results
+
+def run_rating_hammer(path, threads, requests, users, batch_size, seed):
+    """
+    Post requests ratings of one recipe from threads threads, each rating as its own share of users raters,
+    and verify the ratings and rating_stats rows afterwards.
+    """
+
+    if users < threads:
+        raise SystemExit("Use at least as many users as threads.")
+
+    app = fresh_recipes.create_app({**database_config(path), "RATING_BATCH_SIZE": batch_size})
+    recipe_id = Corpus(path).ids[0]
+    emails = [f"rater{i}@example.com" for i in range(users)]
+
+    # ratings refer to their user, so the raters have to exist first
+    connection = sqlite3.connect(path)
+    connection.executemany("INSERT OR IGNORE INTO users(email, username, password) VALUES (?, ?, ?)",
+                           [(email, email.split("@")[0], "password") for email in emails])
+    connection.commit()
+    connection.close()
+
+    expected = {}   # each rater belongs to one thread, so their last rating is known
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def hammer(thread_index):
+        nonlocal errors
+        rng = random.Random(seed + thread_index)
+        raters = emails[thread_index::threads]
+        client = app.test_client()
+
+        for i in range(requests // threads):
+            email = rng.choice(raters)
+            stars = rng.randint(1, 5)
+            with client.session_transaction() as session:
+                session["logged_in_user"] = email
+
+            started = time.perf_counter()
+            response = client.post(f"/recipe/{recipe_id}/rate", json={"stars": stars})
+            seconds = time.perf_counter() - started
+
+            with lock:
+                if response.status_code == 200:
+                    expected[email] = stars
+                    latencies.append(seconds)
+                else:
+                    errors += 1
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=hammer, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    connection = sqlite3.connect(path)
+    stored = dict(connection.execute("SELECT user_email, stars FROM ratings WHERE recipe_id = ? AND user_email LIKE 'rater%@example.com'", (recipe_id,)))
+    count, total = connection.execute("SELECT COUNT(*), SUM(stars) FROM ratings WHERE recipe_id = ?", (recipe_id,)).fetchone()
+    stats = connection.execute("SELECT rating_count, rating_sum FROM rating_stats WHERE recipe_id = ?", (recipe_id,)).fetchone()
+    connection.close()
+
+    problems = [f"{email}: expected {stars} stars, stored {stored.get(email)}" for email, stars in expected.items() if stored.get(email) != stars]
+    if stats != (count, total):
+        problems.append(f"rating_stats has {stats}, the ratings table has {(count, total)}")
+
+    writer = fresh_recipes.rating_writer.stats()
+    print(f"{len(latencies)} ratings of recipe {recipe_id} in {elapsed:.1f}s, {errors} errors, "
+          f"{writer['batches']} transactions ({writer['average_batch']:.1f} ratings each)")
+    for problem in problems:
+        print("INCONSISTENT " + problem)
+    if len(problems) != 0 or errors != 0:
+        sys.exit(1)
+    print("Ratings and totals are consistent.")
+
+    return {f"ratings[threads={threads}, batch_size={batch_size}]": summarize(latencies, elapsed, 0)}
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    List the scenarios whose p95 latency grew by more than tolerance, or that run more queries, than in baseline.
+    """
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']:.2f} ms -> {result['p95_ms']:.2f} ms")
+        if result["queries_per_request"] > before["queries_per_request"] + 0.01:
+            regressions.append(f"{name}: queries/request {before['queries_per_request']:.1f} -> {result['queries_per_request']:.1f}")
+    return regressions
+
+def finish(results, arguments):
+    print_results(results)
+
+    if arguments.save_baseline is not None:
+        with open(arguments.save_baseline, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        print(f"Baseline saved to {arguments.save_baseline}.")
+
+    if arguments.baseline is not None:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare_to_baseline(results, baseline, arguments.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if len(regressions) != 0:
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+# /////////////////
+#     Main
+# /////////////////
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for Fresh Recipes.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="Create a synthetic corpus.")
+    generate.add_argument("database")
+    generate.add_argument("--recipes", type=int, default=10000)
+    generate.add_argument("--users", type=int, default=None, help="Default: one per 10 recipes.")
+    generate.add_argument("--seed", type=int, default=1)
+
+    for name, help in [("run", "Measure every route through the Flask test client."), ("load", "Send concurrent HTTP requests to a running server."),
+                       ("servers", "Compare the sync and async deployments under the same HTTP load."),
+                       ("ratings", "Rate one recipe from many threads and check the totals stay consistent."),
+                       ("catalog", "Measure the in-memory catalog's load time and memory, and the read pages with and without it.")]:
+        command = commands.add_parser(name, help=help)
+        command.add_argument("database")
+        command.add_argument("--requests", type=int, default=20 if name in ["run", "catalog"] else 2000, help="Requests per scenario (run, catalog) or in total (load, servers, ratings).")
+        command.add_argument("--seed", type=int, default=1)
+        command.add_argument("--save-baseline", help="Store the results in this file.")
+        command.add_argument("--baseline", help="Fail if the results are worse than this stored baseline.")
+        command.add_argument("--tolerance", type=float, default=0.25, help="Allowed p95 slowdown against the baseline (0.25 = 25%%).")
+
+    commands.choices["run"].add_argument("--only", help="Only run scenarios whose name contains this.")
+    commands.choices["load"].add_argument("--url", required=True)
+    commands.choices["load"].add_argument("--concurrency", type=int, default=16)
+    commands.choices["servers"].add_argument("--workers", type=int, default=2, help="Worker processes for each server.")
+    commands.choices["servers"].add_argument("--concurrency", type=int, default=64)
+    commands.choices["ratings"].add_argument("--threads", type=int, default=32)
+    commands.choices["ratings"].add_argument("--users", type=int, default=500, help="Distinct raters.")
+    commands.choices["ratings"].add_argument("--batch-size", type=int, default=200, help="RATING_BATCH_SIZE (1 turns coalescing off).")
+
+    logins = commands.add_parser("logins", help="Measure password checks per second at a scrypt cost.")
+    logins.add_argument("--cost", type=int, default=15, help="scrypt cost (2**cost rounds), as PASSWORD_HASH_COST.")
+    logins.add_argument("--seconds", type=float, default=5)
+    logins.add_argument("--threads", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    logins.add_argument("--save-baseline", help="Store the results in this file.")
+    logins.add_argument("--baseline", help="Fail if the results are worse than this stored baseline.")
+    logins.add_argument("--tolerance", type=float, default=0.25, help="Allowed p95 slowdown against the baseline (0.25 = 25%%).")
+
+    arguments = parser.parse_args()
+
+    if arguments.command == "generate":
+        users = arguments.users if arguments.users is not None else max(10, arguments.recipes // 10)
+        generate_corpus(arguments.database, arguments.recipes, users, arguments.seed)
+    elif arguments.command == "run":
+        finish(run_benchmark(arguments.database, arguments.requests, arguments.seed, arguments.only), arguments)
+    elif arguments.command == "load":
+        finish(run_load(arguments.database, arguments.url, arguments.concurrency, arguments.requests, arguments.seed), arguments)
+    elif arguments.command == "servers":
+        finish(run_servers(arguments.database, arguments.workers, arguments.concurrency, arguments.requests, arguments.seed), arguments)
+    elif arguments.command == "ratings":
+        finish(run_rating_hammer(arguments.database, arguments.threads, arguments.requests, arguments.users, arguments.batch_size, arguments.seed), arguments)
+    elif arguments.command == "catalog":
+        finish(run_catalog(arguments.database, arguments.requests, arguments.seed), arguments)
+    elif arguments.command == "logins":
+        finish(run_logins(arguments.cost, arguments.seconds, arguments.threads), arguments)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as fresh_recipes
+
+@pytest.fixture
+def app(tmp_path):
+    """
+    The application on a new database in a temporary directory, migrated to the current schema.
+    """
+
+    path = tmp_path / "recipes.db"
+    app = fresh_recipes.create_app({"TESTING": True, "DATABASE_PATH": str(path), "SQLALCHEMY_DATABASE_URI": f"sqlite:///{path}",
+                                    "MAINTENANCE_SECONDS": 0})
+    with app.app_context():
+        fresh_recipes.migrate_database()
+
+    yield app
+
+    with app.app_context():
+        fresh_recipes.database.engine.dispose()
+
+def add_users(app, emails):
+    with app.app_context():
+        fresh_recipes.database.session.add_all(fresh_recipes.User(email=email, username=email.split("@")[0], password="password")
+                                               for email in emails)
+        fresh_recipes.database.session.commit()
+
+def add_recipes(app, email, count):
+    """
+    Add count recipes by email, a day apart. Returns their ids.
+    """
+
+    with app.app_context():
+        recipes = [fresh_recipes.Recipe(user_email=email, name=f"Recipe {i}", type="Italian", method="Cook it.",
+                                        date_posted=datetime.datetime(2024, 1, 1) + datetime.timedelta(days=i))
+                   for i in range(count)]
+        fresh_recipes.database.session.add_all(recipes)
+        fresh_recipes.database.session.commit()
+        return [recipe.id for recipe in recipes]
@@ -0,0 +1,42 @@
+import pytest
+
+import app as fresh_recipes
+from conftest import add_recipes, add_users
+
+@pytest.fixture
+def email(app):
+    """
+    A user with some recipes, next to another user's, so the planner has rows to choose between.
+    """
+
+    add_users(app, ["cook@example.com", "other@example.com"])
+    add_recipes(app, "cook@example.com", 30)
+    add_recipes(app, "other@example.com", 30)
+    return "cook@example.com"
+
+@pytest.mark.parametrize("statement, params", [
+    (fresh_recipes.feed_statement, {"limit": 31}),
+    (fresh_recipes.feed_after_statement, {"date_posted": "9999", "id": 0, "limit": 31}),
+], ids=["first page", "next page"])
+def test_feed_reads_the_covering_index_in_order(app, email, statement, params):
+    with app.app_context():
+        plan = fresh_recipes.query_plan(statement, {"email": email, **params})
+
+    assert "USING COVERING INDEX ix_recipes_user_feed" in plan
+    assert "USE TEMP B-TREE" not in plan   # no sort: the index is already newest first
+
+@pytest.mark.parametrize("check", fresh_recipes.query_plan_checks, ids=lambda check: check[0])
+def test_check_query_plans(app, email, check):
+    """
+    Every statement check-query-plans covers uses the index it should.
+    """
+
+    name, statement, params, expected, unexpected = check
+    params = {key: email if value == "{email}" else value for key, value in params.items()}
+    with app.app_context():
+        plan = fresh_recipes.query_plan(statement, params)
+
+    for text in expected:
+        assert text in plan
+    for text in unexpected:
+        assert text not in plan
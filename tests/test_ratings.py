@@ -0,0 +1,78 @@
+import random
+import threading
+
+import sqlalchemy
+
+import app as fresh_recipes
+from conftest import add_recipes, add_users
+
+THREADS = 8
+REQUESTS = 25   # per thread
+RATERS = 3      # per thread
+
+def test_concurrent_ratings_of_one_recipe(app):
+    """
+    Rate one recipe from many threads at once through the rating endpoint. Each rater belongs to one thread,
+    so their last accepted rating is known: it must be the one stored, and rating_stats must match the ratings table.
+    """
+
+    emails = [f"rater{i}@example.com" for i in range(THREADS * RATERS)]
+    add_users(app, emails + ["owner@example.com"])
+    recipe_id = add_recipes(app, "owner@example.com", 1)[0]
+
+    expected = {}
+    failures = []
+    start = threading.Barrier(THREADS)
+
+    def hammer(thread_index):
+        rng = random.Random(thread_index)
+        raters = emails[thread_index::THREADS]
+        client = app.test_client()
+        start.wait()
+
+        for i in range(REQUESTS):
+            email = rng.choice(raters)
+            stars = rng.randint(1, 5)
+            with client.session_transaction() as session:
+                session["logged_in_user"] = email
+
+            response = client.post(f"/recipe/{recipe_id}/rate", json={"stars": stars})
+            if response.status_code == 200:
+                expected[email] = stars
+            else:
+                failures.append((email, response.status_code, response.get_data(as_text=True)))
+
+    workers = [threading.Thread(target=hammer, args=(i,)) for i in range(THREADS)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert failures == []
+
+    with app.app_context():
+        session = fresh_recipes.database.session
+        stored = dict(session.execute(sqlalchemy.text("SELECT user_email, stars FROM ratings WHERE recipe_id = :id"), {"id": recipe_id}).all())
+        count, total = session.execute(sqlalchemy.text("SELECT COUNT(*), SUM(stars) FROM ratings WHERE recipe_id = :id"), {"id": recipe_id}).one()
+        stats = session.execute(sqlalchemy.text("SELECT rating_count, rating_sum FROM rating_stats WHERE recipe_id = :id"), {"id": recipe_id}).one()
+
+    assert stored == expected
+    assert tuple(stats) == (count, total) == (len(expected), sum(expected.values()))
+
+def test_rating_of_a_missing_user_fails_alone(app):
+    """
+    A rating whose user is gone is turned away without failing the other ratings written in the same batch.
+    """
+
+    add_users(app, ["owner@example.com", "rater@example.com"])
+    recipe_id = add_recipes(app, "owner@example.com", 1)[0]
+
+    app.config["RATING_BATCH_SECONDS"] = 0.2
+    writer = fresh_recipes.RatingWriter(app)
+    written = writer.submit(recipe_id, "rater@example.com", 4, None)
+    missing = writer.submit(recipe_id, "gone@example.com", 2, None)
+
+    assert written.result(5) is None
+    assert isinstance(missing.exception(5), LookupError)
+    with app.app_context():
+        assert fresh_recipes.database.session.execute(sqlalchemy.text("SELECT user_email, stars FROM ratings")).all() == [("rater@example.com", 4)]